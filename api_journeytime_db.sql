@@ -72,6 +72,24 @@ CREATE TABLE `calendar_dates` (
 
 /*Data for the table `calendar_dates` */
 
+/*Table structure for table `gtfs_load_history` */
+
+DROP TABLE IF EXISTS `gtfs_load_history`;
+
+CREATE TABLE `gtfs_load_history` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `started_at` datetime NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `elapsed_s` float NOT NULL,
+  `rows_loaded` int NOT NULL,
+  `peak_rss_mb` float DEFAULT NULL,
+  `report` text NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `idx_gtfs_load_history` (`started_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+/*Data for the table `gtfs_load_history` */
+
 /*Table structure for table `jt_user` */
 
 DROP TABLE IF EXISTS `jt_user`;
@@ -90,6 +108,49 @@ CREATE TABLE `jt_user` (
 
 /*Data for the table `jt_user` */
 
+/*Table structure for table `pattern_trips` */
+
+DROP TABLE IF EXISTS `pattern_trips`;
+
+CREATE TABLE `pattern_trips` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `trip_key` int NOT NULL,
+  `pattern_key` int NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_pattern_trip` (`trip_key`,`pattern_key`),
+  KEY `idx_pattern_trip_pattern` (`pattern_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='Trip -> trip pattern, built by the loader from stop_times';
+
+/*Data for the table `pattern_trips` */
+
+/*Table structure for table `route_keys` */
+
+DROP TABLE IF EXISTS `route_keys`;
+
+CREATE TABLE `route_keys` (
+  `route_key` int NOT NULL COMMENT 'Dense integer key, assigned by the loader (never reassigned).',
+  `route_id` varchar(32) NOT NULL,
+  PRIMARY KEY (`route_key`),
+  UNIQUE KEY `route_id` (`route_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+/*Data for the table `route_keys` */
+
+/*Table structure for table `route_names` */
+
+DROP TABLE IF EXISTS `route_names`;
+
+CREATE TABLE `route_names` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `route_key` int NOT NULL,
+  `short_name` varchar(32) NOT NULL COMMENT 'Route short name, upper case without whitespace.',
+  `long_name_tokens` varchar(128) NOT NULL COMMENT 'Lower case words of the route long name, space separated.',
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_route_name` (`short_name`,`route_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='Normalized route names, built by the loader from routes';
+
+/*Data for the table `route_names` */
+
 /*Table structure for table `routes` */
 
 DROP TABLE IF EXISTS `routes`;
@@ -97,50 +158,79 @@ DROP TABLE IF EXISTS `routes`;
 CREATE TABLE `routes` (
   `id` int NOT NULL AUTO_INCREMENT,
   `route_id` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL,
+  `route_key` int NOT NULL,
   `agency_id` varchar(32) NOT NULL,
   `route_short_name` varchar(32) NOT NULL,
   `route_long_name` varchar(128) NOT NULL,
   `route_type` int NOT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `route_id` (`route_id`)
+  UNIQUE KEY `route_id` (`route_id`),
+  UNIQUE KEY `route_key` (`route_key`)
 ) ENGINE=InnoDB AUTO_INCREMENT=464 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 /*Data for the table `routes` */
 
+/*Table structure for table `shape_keys` */
+
+DROP TABLE IF EXISTS `shape_keys`;
+
+CREATE TABLE `shape_keys` (
+  `shape_key` int NOT NULL COMMENT 'Dense integer key, assigned by the loader (never reassigned).',
+  `shape_id` varchar(32) NOT NULL,
+  PRIMARY KEY (`shape_key`),
+  UNIQUE KEY `shape_id` (`shape_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+/*Data for the table `shape_keys` */
+
 /*Table structure for table `shapes` */
 
 DROP TABLE IF EXISTS `shapes`;
 
 CREATE TABLE `shapes` (
   `id` int NOT NULL AUTO_INCREMENT,
-  `shape_id` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL,
+  `shape_key` int NOT NULL,
   `shape_pt_lat` double NOT NULL,
   `shape_pt_lon` double NOT NULL,
   `shape_pt_sequence` double NOT NULL,
   `shape_dist_traveled` double NOT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `idx_shape` (`shape_id`,`shape_pt_lat`,`shape_pt_lon`,`shape_pt_sequence`)
+  UNIQUE KEY `idx_shape` (`shape_key`,`shape_pt_lat`,`shape_pt_lon`,`shape_pt_sequence`)
 ) ENGINE=InnoDB AUTO_INCREMENT=851913 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 /*Data for the table `shapes` */
 
+/*Table structure for table `stop_keys` */
+
+DROP TABLE IF EXISTS `stop_keys`;
+
+CREATE TABLE `stop_keys` (
+  `stop_key` int NOT NULL COMMENT 'Dense integer key, assigned by the loader (never reassigned).',
+  `stop_id` varchar(16) NOT NULL,
+  PRIMARY KEY (`stop_key`),
+  UNIQUE KEY `stop_id` (`stop_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+/*Data for the table `stop_keys` */
+
 /*Table structure for table `stop_times` */
 
 DROP TABLE IF EXISTS `stop_times`;
 
 CREATE TABLE `stop_times` (
   `id` int NOT NULL AUTO_INCREMENT,
-  `trip_id` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL COMMENT 'Identifies a trip.',
-  `arrival_time` time NOT NULL COMMENT 'Arrival time at a specific stop for a specific trip on a route. If there are not separate times for arrival and departure at a stop, enter the same value for arrival_time and departure_time. For times occurring after midnight on the service day, enter the time as a value greater than 24:00:00 in HH:MM:SS local time for the day on which the trip schedule begins.\n\nScheduled stops where the vehicle strictly adheres to the specified arrival and departure times are timepoints. If this stop is not a timepoint, it is recommended to provide an estimated or interpolated time. If this is not available, arrival_time can be left empty. Further, indicate that interpolated times are provided with timepoint=0. If interpolated times are indicated with timepoint=0, then time points must be indicated with timepoint=1. Provide arrival times for all stops that are time points. An arrival time must be specified for the first and the last stop in a trip.',
-  `departure_time` time NOT NULL COMMENT 'Departure time from a specific stop for a specific trip on a route. For times occurring after midnight on the service day, enter the time as a value greater than 24:00:00 in HH:MM:SS local time for the day on which the trip schedule begins. If there are not separate times for arrival and departure at a stop, enter the same value for arrival_time and departure_time. See the arrival_time description for more details about using timepoints correctly.\n\nThe departure_time field should specify time values whenever possible, including non-binding estimated or interpolated times between timepoints.',
-  `stop_id` varchar(16) NOT NULL COMMENT 'Identifies the serviced stop. All stops serviced during a trip must have a record in stop_times.txt. Referenced locations must be stops, not stations or station entrances. A stop may be serviced multiple times in the same trip, and multiple trips and routes may service the same stop.',
+  `trip_key` int NOT NULL COMMENT 'Identifies a trip (trip_keys).',
+  `arrival_time` int NOT NULL COMMENT 'Stored as seconds after midnight. Arrival time at a specific stop for a specific trip on a route. If there are not separate times for arrival and departure at a stop, enter the same value for arrival_time and departure_time. For times occurring after midnight on the service day, enter the time as a value greater than 24:00:00 in HH:MM:SS local time for the day on which the trip schedule begins.\n\nScheduled stops where the vehicle strictly adheres to the specified arrival and departure times are timepoints. If this stop is not a timepoint, it is recommended to provide an estimated or interpolated time. If this is not available, arrival_time can be left empty. Further, indicate that interpolated times are provided with timepoint=0. If interpolated times are indicated with timepoint=0, then time points must be indicated with timepoint=1. Provide arrival times for all stops that are time points. An arrival time must be specified for the first and the last stop in a trip.',
+  `departure_time` int NOT NULL COMMENT 'Stored as seconds after midnight. Departure time from a specific stop for a specific trip on a route. For times occurring after midnight on the service day, enter the time as a value greater than 24:00:00 in HH:MM:SS local time for the day on which the trip schedule begins. If there are not separate times for arrival and departure at a stop, enter the same value for arrival_time and departure_time. See the arrival_time description for more details about using timepoints correctly.\n\nThe departure_time field should specify time values whenever possible, including non-binding estimated or interpolated times between timepoints.',
+  `stop_key` int NOT NULL COMMENT '(stop_keys) Identifies the serviced stop. All stops serviced during a trip must have a record in stop_times.txt. Referenced locations must be stops, not stations or station entrances. A stop may be serviced multiple times in the same trip, and multiple trips and routes may service the same stop.',
   `stop_sequence` smallint NOT NULL COMMENT 'Order of stops for a particular trip. The values must increase along the trip but do not need to be consecutive.Example: The first location on the trip could have a stop_sequence=1, the second location on the trip could have a stop_sequence=23, the third location could have a stop_sequence=40, and so on.',
   `stop_headsign` varchar(64) NOT NULL COMMENT 'Text that appears on signage identifying the trip''s destination to riders. This field overrides the default trips.trip_headsign when the headsign changes between stops. If the headsign is displayed for an entire trip, use trips.trip_headsign instead.\n\nA stop_headsign value specified for one stop_time does not apply to subsequent stop_times in the same trip. If you want to override the trip_headsign for multiple stop_times in the same trip, the stop_headsign value must be repeated in each stop_time row.',
   `pickup_type` smallint NOT NULL COMMENT 'Indicates pickup method. Valid options are:\n\n0 or empty - Regularly scheduled pickup.\n1 - No pickup available.\n2 - Must phone agency to arrange pickup.\n3 - Must coordinate with driver to arrange pickup.',
   `drop_off_type` smallint NOT NULL COMMENT 'Indicates drop off method. Valid options are:\n\n0 or empty - Regularly scheduled drop off.\n1 - No drop off available.\n2 - Must phone agency to arrange drop off.\n3 - Must coordinate with driver to arrange drop off.',
   `shape_dist_traveled` double NOT NULL COMMENT 'Actual distance traveled along the associated shape, from the first stop to the stop specified in this record. This field specifies how much of the shape to draw between any two stops during a trip. Must be in the same units used in shapes.txt. Values used for shape_dist_traveled must increase along with stop_sequence; they cannot be used to show reverse travel along a route.Example: If a bus travels a distance of 5.25 kilometers from the start of the shape to the stop, shape_dist_traveled=5.25.',
   PRIMARY KEY (`id`),
-  UNIQUE KEY `idx_stop_time` (`trip_id`,`arrival_time`,`departure_time`,`stop_id`,`stop_sequence`)
+  UNIQUE KEY `idx_stop_time` (`trip_key`,`arrival_time`,`departure_time`,`stop_key`,`stop_sequence`),
+  KEY `idx_stop_time_stop` (`stop_key`,`arrival_time`)
 ) ENGINE=InnoDB AUTO_INCREMENT=3346583 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='*** Initial Post-Import Data Type Review Complete, TK, 22/06/20';
 
 /*Data for the table `stop_times` */
@@ -152,6 +242,7 @@ DROP TABLE IF EXISTS `stops`;
 CREATE TABLE `stops` (
   `id` int NOT NULL AUTO_INCREMENT,
   `stop_id` varchar(16) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL COMMENT 'Identifies a stop, station, or station entrance.\\n\\nThe term "station entrance" refers to both station entrances and station exits. Stops, stations or station entrances are collectively referred to as locations. Multiple routes may use the same stop.',
+  `stop_key` int NOT NULL COMMENT '(stop_keys)',
   `stop_name` varchar(64) NOT NULL COMMENT 'Name of the location. Use a name that people will understand in the local and tourist vernacular.\n\nWhen the location is a boarding area (location_type=4), the stop_name should contains the name of the boarding area as displayed by the agency. It could be just one letter (like on some European intercity railway stations), or text like “Wheelchair boarding area” (NYC’s Subway) or “Head of short trains” (Paris’ RER).\n\nConditionally Required:\n• Required for locations which are stops (location_type=0), stations (location_type=1) or entrances/exits (location_type=2).\n• Optional for locations which are generic nodes (location_type=3) or boarding areas (location_type=4).',
   `stop_lat` double NOT NULL COMMENT 'Latitude of the location.\n\nConditionally Required:\n• Required for locations which are stops (location_type=0), stations (location_type=1) or entrances/exits (location_type=2).\n• Optional for locations which are generic nodes (location_type=3) or boarding areas (location_type=4).',
   `stop_lon` double NOT NULL COMMENT 'Longitude of the location.\n\nConditionally Required:\n• Required for locations which are stops (location_type=0), stations (location_type=1) or entrances/exits (location_type=2).\n• Optional for locations which are generic nodes (location_type=3) or boarding areas (location_type=4).',
@@ -159,7 +250,8 @@ CREATE TABLE `stops` (
   `dist_from_cc` double NOT NULL COMMENT 'Distance from City Center. Our domain knowledge suggests travel times near the city center will be larger than travel times outside the city center.  So we added this column to supply an extra input to our model so we could assess it''s impact.  This column is not part of the orginal GTFS data and has been programatically populated.',
   PRIMARY KEY (`id`),
   SPATIAL KEY `stop_position` (`stop_position`),
-  KEY `stop_id` (`stop_id`)
+  KEY `stop_id` (`stop_id`),
+  KEY `stop_key` (`stop_key`)
 ) ENGINE=InnoDB AUTO_INCREMENT=10024 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='*** Initial Post-Import Data Type Review Complete, TK, 22/06/20';
 
 /*Data for the table `stops` */
@@ -180,20 +272,50 @@ CREATE TABLE `transfers` (
 
 /*Data for the table `transfers` */
 
+/*Table structure for table `trip_keys` */
+
+DROP TABLE IF EXISTS `trip_keys`;
+
+CREATE TABLE `trip_keys` (
+  `trip_key` int NOT NULL COMMENT 'Dense integer key, assigned by the loader (never reassigned).',
+  `trip_id` varchar(32) NOT NULL,
+  PRIMARY KEY (`trip_key`),
+  UNIQUE KEY `trip_id` (`trip_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+/*Data for the table `trip_keys` */
+
+/*Table structure for table `trip_patterns` */
+
+DROP TABLE IF EXISTS `trip_patterns`;
+
+CREATE TABLE `trip_patterns` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `pattern_key` int NOT NULL,
+  `stop_sequence` smallint NOT NULL,
+  `stop_key` int NOT NULL,
+  `shape_dist_traveled` double NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_trip_pattern` (`pattern_key`,`stop_sequence`,`stop_key`),
+  KEY `idx_trip_pattern_stop` (`stop_key`,`pattern_key`,`stop_sequence`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci COMMENT='Distinct ordered stop sequences shared by trips, built by the loader from stop_times';
+
+/*Data for the table `trip_patterns` */
+
 /*Table structure for table `trips` */
 
 DROP TABLE IF EXISTS `trips`;
 
 CREATE TABLE `trips` (
   `id` int NOT NULL AUTO_INCREMENT,
-  `route_id` varchar(32) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL,
+  `route_key` int NOT NULL,
   `service_id` varchar(32) NOT NULL,
-  `trip_id` varchar(32) NOT NULL,
-  `shape_id` varchar(32) NOT NULL,
+  `trip_key` int NOT NULL,
+  `shape_key` int NOT NULL,
   `trip_headsign` varchar(128) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci NOT NULL,
   `direction_id` tinyint NOT NULL,
   PRIMARY KEY (`id`),
-  UNIQUE KEY `idx_trip` (`route_id`,`trip_id`,`shape_id`)
+  UNIQUE KEY `idx_trip` (`route_key`,`trip_key`,`shape_key`)
 ) ENGINE=InnoDB AUTO_INCREMENT=87373 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 
 /*Data for the table `trips` */
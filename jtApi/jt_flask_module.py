@@ -4,6 +4,7 @@
 
 # Standard Library Imports
 from datetime import datetime
+import gc
 import json
 import logging
 import os
@@ -25,10 +26,10 @@ from sqlalchemy.exc import DBAPIError, NoResultFound, SQLAlchemyError
 # Local Application Imports
 from forms import CheckUsernameAvailableForm, LoginForm, RegisterForm, UpdateUserForm
 from jt_utils import get_available_end_to_end_models, get_stops_by_route, \
-                     get_valid_route_shortnames, predict_journey_time, \
+                     get_valid_route_shortnames, predict_journey_times, \
                      query_results_as_json, query_results_as_compressed_csv, \
                      time_rounded_to_hrs_mins_as_string, \
-                     JourneyPrediction
+                     load_shared_model, JourneyPrediction, RouteIndex, StopIndex, Timetable
 from models import Agency, Calendar, CalendarDates, Routes, \
     Shapes, Stop, StopTime, Trips, Transfers, JT_User
 
@@ -52,6 +53,15 @@ AVAILABLE_END_TO_END_MODELS = []
 # that our prediction service supports - and those it doesn't.
 VALID_ROUTE_SHORTNAMES = []
 
+# Routes (by name) and their trips are also indexed in memory, so a prediction can
+# find the candidate trips for a step without querying the database. Refreshed
+# along with the list of valid route shortnames.
+ROUTE_INDEX = RouteIndex()
+# ... likewise the stops, by name and by position.
+STOP_INDEX = StopIndex()
+# ... and the timetable (the calls at each stop), to find the most likely trip.
+TIMETABLE = Timetable()
+
 logging.basicConfig(
     format='%(levelname)s: %(message)s',
     encoding='utf-8',
@@ -190,28 +200,36 @@ def _load_stop_to_stop_model_for_month(month_name):
     #   -> A generic model that predicts times based on distance from the city center
     #      (used in cases where our training data - from 2018 - did not contain
     #       information for lines that exist currently).
-    # We keep the stop-to-stop model in memory - to improve performance. There is one
-    # model per month. We only overwrite the model in memory as required (i.e. on
-    # change of month)
+    # We keep the stop-to-stop models in memory - to improve performance. There is
+    # one model per month, all twelve are loaded at start-up.
+    # Raises FileNotFoundError if the month's pickle is missing.
     month_pickle_name = month_name + '.pickle'
     stop_to_stop_filepath= \
         os.path.join(jt_flask_mod_dir, *['pickles', 'stop_to_stop', month_pickle_name])
 
-    model = None
-    with open(stop_to_stop_filepath, 'rb') as file:
-        # TODO:: Agree what action we should take if the pickle is invalid/not found.
-        model = pickle.load(file)
-
-    return model
-
-jt_flask_app.config['MODEL_STOP_TO_STOP_MONTH'] = datetime.now().strftime("%B")
-jt_flask_app.config['MODEL_STOP_TO_STOP']       = \
-    _load_stop_to_stop_model_for_month(
-            jt_flask_app.config['MODEL_STOP_TO_STOP_MONTH']
-        )
+    return load_shared_model(stop_to_stop_filepath)
+
+# All twelve stop-to-stop models are loaded (memory-mapped where possible) as the
+# module is imported - so a prediction for any month never waits on the disk. When
+# the server loads the app before forking its workers (e.g. gunicorn --preload)
+# the workers share the models' memory, copy-on-write. Freezing the objects loaded
+# so far keeps the garbage collector from writing to (and so copying) those pages.
+# A month whose pickle is missing is remembered (as None) - it is not looked for
+# again on each request, the steps needing it are returned without a prediction.
+jt_flask_app.config['MODELS_STOP_TO_STOP'] = {}
+for month in range(1, 13):
+    month_name = datetime(2000, month, 1).strftime("%B")
+    try:
+        jt_flask_app.config['MODELS_STOP_TO_STOP'][month_name] = \
+            _load_stop_to_stop_model_for_month(month_name)
+    except FileNotFoundError:
+        log.warning('              Stop-to-stop model \"%s.pickle\" not found.', month_name)
+        jt_flask_app.config['MODELS_STOP_TO_STOP'][month_name] = None
+gc.freeze()
 log.info(
-            '              Stop-to-stop model \"%s.pickle\" has been loaded in memory.',
-            jt_flask_app.config['MODEL_STOP_TO_STOP_MONTH']
+            '              Stop-to-stop models for %s loaded in memory.',
+            ', '.join(loaded_month for loaded_month, model \
+                in jt_flask_app.config['MODELS_STOP_TO_STOP'].items() if model is not None)
         )
 
 ################################################################################
@@ -498,8 +516,8 @@ def get_shape(shape_id):
         # Simplest use case - user requires information on single agency
         # No option to download this as a file (currently) - just return requested
         # information as json.
-        shape_query = shape_query.filter(Shapes.shape_id == shape_id)
-        shape_query = shape_id.order_by(text('shape_id asc'))
+        shape_query = shape_query.filter(Shapes.gtfs_shape.has(shape_id=shape_id))
+        shape_query = shape_query.order_by(Shapes.shape_pt_sequence.asc())
 
         response = jsonify([row.serialize() for row in shape_query.all()])
     else:
@@ -560,8 +578,8 @@ def get_stop_times(trip_id):
         # Simplest use case - user requires information on single agency
         # No option to download this as a file (currently) - just return requested
         # information as json.
-        stoptime_query = stoptime_query.filter(StopTime.trip_id == trip_id)
-        stoptime_query = stoptime_query.order_by(text('trip_id asc'))
+        stoptime_query = stoptime_query.filter(StopTime.gtfs_trip.has(trip_id=trip_id))
+        stoptime_query = stoptime_query.order_by(text('stop_sequence asc'))
 
         response = jsonify([row.serialize() for row in stoptime_query.all()])
     else:
@@ -612,7 +630,7 @@ def get_trips(trip_id):
         # Simplest use case - user requires information on single trip
         # No option to download this as a file (currently) - just return requested
         # information as json.
-        trips_query = trips_query.filter(Trips.trip_id == trip_id)
+        trips_query = trips_query.filter(Trips.gtfs_trip.has(trip_id=trip_id))
 
         # ".one" causes a TypeError, ".all" returns just the specified trip
         response = jsonify([row.serialize() for row in trips_query.all()])
@@ -720,6 +738,9 @@ def update_valid_route_shortnames():
     # exists in the scope of this endpoint.
     VALID_ROUTE_SHORTNAMES.clear()
     VALID_ROUTE_SHORTNAMES.extend(get_valid_route_shortnames(db))
+    ROUTE_INDEX.refresh(db)
+    STOP_INDEX.refresh(db)
+    TIMETABLE.refresh(db)
 
     # Following generates large output.
     # log.debug("              Valid route shortnames are: %s", \
@@ -747,7 +768,10 @@ def get_journey_time():
         # The incoming json should contain one (or more) routes.  Each route will
         # be made up of steps, where each step is a seperate bus journey for that
         # route.
+        # We first find the stops for every step of every route, then predict
+        # them all together - one call to each model used by the request.
         log.debug('\n## Begin Prediction: looping over routes:\n')
+        planned_steps = []  # (step, JourneyPrediction, stop-to-stop model)
         for route_idx, route in enumerate(prediction_request_json['routes']):
              # def JourneyPrediction():
             no_of_steps_this_route = len(route['steps'])
@@ -756,7 +780,9 @@ def get_journey_time():
                 , route_idx, no_of_steps_this_route
                 )
 
-            _predict_all_steps(route)
+            _plan_all_steps(route, planned_steps)
+
+        _predict_planned_steps(planned_steps)
 
         # Hard code an updated title and description for the response so that
         # it's easier to understand at the client end.
@@ -769,21 +795,21 @@ def get_journey_time():
     return resp
 
 
-def _predict_all_steps(route):
-    """Predictions for each step in a route.
+def _plan_all_steps(route, planned_steps):
+    """Plan the predictions for each step in a route (added to 'planned_steps').
     """
     log.debug('\tlooping over steps')
     for step_idx, step in enumerate(route['steps']):
         log.debug('\tProcessing step %s.', step_idx)
 
-        _attempt_predict_this_step(step_idx, step)
+        _attempt_plan_this_step(step_idx, step, planned_steps)
 
 
-def _attempt_predict_this_step(step_idx, step):
-    """Attempt to perform a journey prediction for the current step
+def _attempt_plan_this_step(step_idx, step, planned_steps):
+    """Attempt to plan a journey prediction for the current step
 
     Extracts the details required for prediction from the inbound json
-    If route data is stored in the database we go ahead and make a prediction
+    If route data is stored in the database we go ahead and plan a prediction
     If we don't have information for this route, return a 'no prediction' message
     """
     planned_time_s  = step['duration']['value']
@@ -813,7 +839,10 @@ def _attempt_predict_this_step(step_idx, step):
             '\tThe good news - route %s is valid and is in our database!',
             route_shortname
             )
-        _predict_this_step(step_idx, step, planned_time_s, route_name, route_shortname)
+        planned_step = \
+            _plan_this_step(step_idx, step, planned_time_s, route_name, route_shortname)
+        if planned_step is not None:
+            planned_steps.append(planned_step)
     else:
         # We have encountered an invalid route shortname. We abort with an error message...
         step['prediction_status'] = \
@@ -824,11 +853,13 @@ def _attempt_predict_this_step(step_idx, step):
             )
 
 
-def _predict_this_step(step_idx, step, planned_time_s, route_name, route_shortname):
-    """Perform a journey prediction for the current step
+def _plan_this_step(step_idx, step, planned_time_s, route_name, route_shortname):
+    """Plan a journey prediction for the current step
 
-    Look up the stop sequence for this route from the GTFS data
-    Perform a prediction once we have the stop information to hand.
+    Look up the stop sequence for this route from the GTFS data, and the model
+    to use. Returns (step, JourneyPrediction, stop-to-stop model) - predicted
+    by _predict_planned_steps() - or None if the stop-to-stop model needed is
+    not available.
     """
     step['prediction_status'] = 'Prediction Attempted'
 
@@ -845,6 +876,22 @@ def _predict_this_step(step_idx, step, planned_time_s, route_name, route_shortna
     # we just fudge around it...
     planned_departure_datetime = _get_planned_departure_datetime(step)
 
+    # We want to get a prediction for 'planned_departure_datetime'.  And that
+    # prediction ?might? involve a stop-to-stop model if no route-shortname pickle
+    # exists. So if the stop-to-stop model is required, we make sure the correct
+    # model is loaded (all months are in memory - see start-up)...
+    model_stop_to_stop_this_pred = None
+    if not route_shortname_pickle_exists:
+        departure_month = planned_departure_datetime.strftime("%B")
+        log.debug('Using stop-to-stop model for \"%s\".', departure_month)
+        model_stop_to_stop_this_pred = jt_flask_app.config['MODELS_STOP_TO_STOP'][departure_month]
+        if model_stop_to_stop_this_pred is None:
+            # ... unless its pickle was missing at start-up - no prediction then.
+            step['prediction_status'] = \
+                'Prediction Service not available for departures in ' + departure_month + '.'
+            log.warning('No stop-to-stop model for \"%s\" (step %d).', departure_month, step_idx)
+            return None
+
     step_stops = _get_stops_for_this_step(step, route_name, route_shortname)
     if len(step_stops) == 0:
         log.warning(
@@ -857,29 +904,6 @@ def _predict_this_step(step_idx, step, planned_time_s, route_name, route_shortna
                         route_shortname, route_shortname_pickle_exists, \
                         planned_time_s, planned_departure_datetime, step_stops)
 
-    # We want to get a prediction for 'planned_departure_datetime'.  And that
-    # prediction ?might? involve a stop-to-stop model if no route-shortname pickle
-    # exists. So if the stop-to-stop model is required, we make sure the correct
-    # model is loaded...
-    model_stop_to_stop_this_pred = None
-    if not journey_pred.route_shortname_pickle_exists:
-        # Stop-to-stop model required.
-        departure_month = planned_departure_datetime.strftime("%B")
-
-        # Following check runs for every prediction - if we sheduled it, that
-        # would be more efficient...
-        _update_cached_fallback_model_if_reqd()
-
-        if not departure_month == jt_flask_app.config['MODEL_STOP_TO_STOP_MONTH']:
-            log.debug('Loading stop-to-stop model for \"%s\"', departure_month)
-            model_stop_to_stop_this_pred = \
-                _load_stop_to_stop_model_for_month(departure_month)
-        else:
-            log.debug('Using cached stop-to-stop model.')
-            # If the months match - use the model from the cache
-            model_stop_to_stop_this_pred = \
-                jt_flask_app.config['MODEL_STOP_TO_STOP']
-
     # # Pickle the JourneyPrediction object - handy for testing!!
     # with open(
     #     os.path.join(
@@ -890,10 +914,28 @@ def _predict_this_step(step_idx, step, planned_time_s, route_name, route_shortna
     #     ) as handle:
     #     pickle.dump(journey_pred, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-    # Call a function to get the predicted journey time for this step.
-    journey_pred = predict_journey_time(journey_pred, model_stop_to_stop_this_pred)
+    return step, journey_pred, model_stop_to_stop_this_pred
+
+
+def _predict_planned_steps(planned_steps):
+    """Perform the journey predictions for all the planned steps (of a request)
+
+    The steps are predicted together (one call to each model used) and the json
+    for each step extended with its prediction.
+    """
+    # Call a function to get the predicted journey times for these steps.
+    predict_journey_times( \
+        [(journey_pred, model_stop_to_stop) for _, journey_pred, model_stop_to_stop \
+            in planned_steps])
 
-    # Extend the json to contain the prediction information...
+    for step, journey_pred, _ in planned_steps:
+        _add_prediction_json_to_step(step, journey_pred)
+
+
+def _add_prediction_json_to_step(step, journey_pred):
+    """Extend the json for the step to contain the prediction information
+    """
+    step_stops = journey_pred.step_stops
     predicted_duration = journey_pred.predicted_duration_s
     step['predicted_duration'] = {}
     step['predicted_duration']['text'] = \
@@ -909,24 +951,6 @@ def _predict_this_step(step_idx, step, planned_time_s, route_name, route_shortna
                             'Prediction Attempted - Stop-by-Stop information not available.'
 
 
-def _update_cached_fallback_model_if_reqd():
-    """Update the cached fallback model if required
-
-    One stop-to-stop model is kept loaded in memory for speed - the current month
-    Check to see if the current month is still in memory - if it is not then load
-    the current month.
-    """
-    # Incorrect model for this journey prediction in the cache. Two actions:
-    # -> Is it time to renew the cached fallback model? (change of month)
-    # -> Load the correct model for this prediction
-    current_month = datetime.now().strftime("%B")
-    if not current_month == jt_flask_app.config['MODEL_STOP_TO_STOP_MONTH']:
-        log.debug('Updating cached stop-to-stop model to model for \"%s\"', current_month)
-        jt_flask_app.config['MODEL_STOP_TO_STOP_MONTH'] = current_month
-        jt_flask_app.config['MODEL_STOP_TO_STOP']       = \
-            _load_stop_to_stop_model_for_month(current_month)
-
-
 def _get_planned_departure_datetime(step):
     """Get the planned departure datetime for this step
 
@@ -980,7 +1004,9 @@ def _get_stops_for_this_step(step, route_name, route_shortname):
     step_stops = get_stops_by_route(db, route_name, route_shortname, \
                         stop_headsign, departure_time, \
                         departure_stop_name, departure_stop_lat, departure_stop_lon, \
-                        arrival_stop_name, arrival_stop_lat, arrival_stop_lon)
+                        arrival_stop_name, arrival_stop_lat, arrival_stop_lon, \
+                        route_index=ROUTE_INDEX, stop_index=STOP_INDEX, \
+                        timetable=TIMETABLE)
     log.debug(
                         "\t\twe found the following number of step_stops -> %d",
                         len(step_stops)
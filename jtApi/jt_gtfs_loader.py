@@ -5,21 +5,34 @@
 """
 
 # Standard Library Imports
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import csv
 from datetime import datetime
+import hashlib
+import io
+from itertools import groupby, islice
+import json
 import logging
+from operator import itemgetter
 import os
 from os.path import exists
+import pickle
+import resource
+import shutil
 import sys
+import tempfile
+import time
 import traceback
 import zipfile
 from zipfile import ZipFile
 
 # Related Third Party Imports
-from haversine import haversine
+import numpy as np
 import requests
 import sqlalchemy as db
-from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, OperationalError
 from sqlalchemy.orm import sessionmaker
 
 # Local Application Imports
@@ -29,8 +42,11 @@ from sqlalchemy.orm import sessionmaker
 # 'working directory' - but modules can only be imported from the python path.
 jt_gtfs_module_dir = os.path.dirname(__file__)
 sys.path.insert(0, jt_gtfs_module_dir)
-from jt_utils import load_credentials
-from models import Agency, Calendar, CalendarDates, Routes, Shapes, StopTime, Stop, Transfers, Trips
+from jt_utils import load_credentials, haversine_km, seconds_after_midnight, \
+    route_name_tokens, route_short_name_key
+from models import Agency, Calendar, CalendarDates, GtfsLoadHistory, Routes, Shapes, StopTime, \
+    Stop, Transfers, Trips, RouteKey, ShapeKey, StopKey, TripKey, TripPattern, PatternTrip, \
+    RouteName
 
 log = logging.getLogger(__name__)  # Standard naming...
 
@@ -40,181 +56,1396 @@ print('\tLoading credentials.')
 credentials = load_credentials()
 CONST_DUBLIN_CC = (credentials['DUBLIN_CC']['lat'], credentials['DUBLIN_CC']['lon'])
 
-CONST_OBJ_PER_SESS_MAX = 50000
-
-
-def download_gtfs_schedule_data(import_dir):
+# The number of rows written (and committed) per batch adapts to the throughput
+# of each load (see BatchSizer), starting from the 'initial' size, unless a fixed
+# size is given ('--batch-size').
+CONST_BATCH_SIZE_INITIAL = 50000
+CONST_BATCH_SIZE_MIN     = 5000
+CONST_BATCH_SIZE_MAX     = 400000
+CONST_BATCH_SIZE_GROWTH  = 1.5   # (grow by 50% while throughput improves...)
+CONST_BATCH_SIZE_GAIN    = 0.05  # (... by at least 5%)
+# Batches are halved if the loader's resident memory goes above this...
+CONST_BATCH_RSS_LIMIT_MB = 1024
+# MySQL error 'Lock wait timeout exceeded'
+CONST_MYSQL_LOCK_WAIT_TIMEOUT = 1205
+
+# How rows are written to the db. The insert mode can be chosen per file (see
+# '--insert-mode' in _parse_args()):
+#   -> 'orm'    builds one SQLAlchemy model object per csv row and saves them in
+#               bulk (the original approach - slow for the larger files)
+#   -> 'core'   skips the model objects, passing plain dictionaries straight to a
+#               Core 'insert()' executed as a single executemany per batch
+#   -> 'infile' hands the whole file to MySQL with 'LOAD DATA LOCAL INFILE' (the
+#               fastest, but the MySQL server must have 'local_infile' enabled)
+CONST_INSERT_MODE_ORM    = 'orm'
+CONST_INSERT_MODE_CORE   = 'core'
+CONST_INSERT_MODE_INFILE = 'infile'
+CONST_INSERT_MODES = (CONST_INSERT_MODE_ORM, CONST_INSERT_MODE_CORE, CONST_INSERT_MODE_INFILE)
+
+# The largest files - loaded by a pool of worker processes when '--workers' > 1.
+CONST_PARALLEL_GTFS_FILES = ('stop_times.txt', 'shapes.txt', 'trips.txt')
+# The files that are split into shards, each loaded by its own worker process,
+# when '--shards' > 1 ('stop_times.txt' alone is ~220MB).
+CONST_SHARDED_GTFS_FILES = ('stop_times.txt',)
+# The files whose table indexes are dropped before the load and built once the
+# load is complete, when '--defer-indexes' is set ('idx_stop_time', 'idx_shape'
+# and 'idx_trip' are wide - maintaining them row by row is slow).
+CONST_DEFERRED_INDEX_GTFS_FILES = ('stop_times.txt', 'shapes.txt', 'trips.txt')
+# The files that can be loaded incrementally ('--incremental'), and the columns
+# identifying each row. Only the rows that differ from the table are written.
+CONST_INCREMENTAL_GTFS_KEYS = {
+    'stop_times.txt': ('trip_id', 'stop_sequence'),
+    'trips.txt': ('trip_id',)
+}
+# The file is compared with the table in (up to) this many ranges of the first key
+# column's keys (it must be a GTFS id - see CONST_GTFS_KEY_COLUMNS), so only one
+# range is held in memory. The file's rows are split into the ranges (in temporary
+# files) in lists of this many rows.
+CONST_INCREMENTAL_CHUNKS = 64
+CONST_INCREMENTAL_ROWS_PER_SPILL = 1000
+# GTFS time columns (HH:MM:SS, passing 24:00:00 for trips running after midnight)
+# are stored as integer seconds after midnight.
+CONST_GTFS_TIME_COLUMNS = ('arrival_time', 'departure_time')
+# GTFS ids are stored as dense integer keys (the ids themselves are kept in lookup
+# tables - see models.py). GTFS id column -> (key column, lookup table model).
+CONST_GTFS_KEY_COLUMNS = {
+    'route_id': ('route_key', RouteKey),
+    'shape_id': ('shape_key', ShapeKey),
+    'stop_id': ('stop_key', StopKey),
+    'trip_id': ('trip_key', TripKey)
+}
+# The files (and columns) the GTFS ids are defined by. Keys are assigned to any
+# new ids in these files before the load starts (so every file load, in whatever
+# process, reads the same keys). 'stop_times.txt' only refers to these ids.
+CONST_GTFS_KEY_SOURCES = {
+    'routes.txt': ('route_id',),
+    'shapes.txt': ('shape_id',),
+    'stops.txt': ('stop_id',),
+    'trips.txt': ('route_id', 'trip_id', 'shape_id')
+}
+
+# Unless told to load 'in place', the loader fills a staging copy of each table
+# (e.g. 'stop_times__next') and swaps it for the live table once the load is
+# complete. The replaced tables are renamed with the 'old' suffix, then dropped.
+CONST_STAGING_SUFFIX = '__next'
+CONST_OLD_SUFFIX     = '__old'
+
+# The size and SHA-256 of each GTFS file at the last successful load are kept in
+# this file (in the import directory) - files which haven't changed are skipped.
+CONST_FINGERPRINTS_FILE = 'gtfs_fingerprints.json'
+CONST_HASH_CHUNK_BYTES  = 1024 * 1024
+
+# The GTFS Schedule Data .zip is kept in the import directory between runs and
+# the files are read straight out of it. The ETag/Last-Modified headers it came
+# with are kept so the next download only happens if the feed has changed.
+CONST_GTFS_ZIP_FILENAME     = 'google_transit_combined.zip'
+CONST_DOWNLOAD_STATE_FILE   = 'gtfs_download.json'
+CONST_DOWNLOAD_CHUNK_BYTES  = 1024 * 1024
+CONST_DOWNLOAD_TIMEOUT_S    = 60
+
+# The progress of each file's load is saved (after every committed batch) to a
+# checkpoint file in this sub-directory of the import directory, so a failed
+# load can be resumed ('--resume'). They are cleared once a load succeeds.
+CONST_CHECKPOINT_DIR = 'checkpoints'
+
+# A json report of the metrics for each run is saved to this sub-directory of
+# the import directory (and a summary row added to the 'gtfs_load_history' table).
+CONST_REPORT_DIR = 'reports'
+
+# Files in the import directory that are not GTFS files (and are expected)
+CONST_IMPORT_DIR_FILES = ( \
+    '.gitignore', CONST_FINGERPRINTS_FILE, CONST_GTFS_ZIP_FILENAME, CONST_DOWNLOAD_STATE_FILE)
+
+# Which model (table) each of the GTFS files is imported into...
+GTFS_FILE_MODELS = {
+    'agency.txt': Agency,
+    'calendar.txt': Calendar,
+    'calendar_dates.txt': CalendarDates,
+    'routes.txt': Routes,
+    'shapes.txt': Shapes,
+    'stops.txt': Stop,
+    'stop_times.txt': StopTime,
+    'transfers.txt': Transfers,
+    'trips.txt': Trips
+}
+
+# Tables derived from a GTFS file once it is loaded (and staged/swapped with it).
+# The trip patterns (the distinct stop sequences) are derived from stop_times,
+# the normalized route names (the API's route index) from routes.
+CONST_DERIVED_GTFS_MODELS = {
+    'routes.txt': (RouteName, ),
+    'stop_times.txt': (TripPattern, PatternTrip)
+}
+# The trip patterns are derived this many trips (keys) at a time
+CONST_TRIP_PATTERN_TRIPS_PER_QUERY = 5000
+
+# 'LOAD DATA' column lists (in the order the columns appear in each GTFS file),
+# along with any 'SET' clause needed to transform a column on the way in. Columns
+# read into '@variables' are transformed by the 'SET' clause (GTFS ids are looked
+# up in their key tables - the keys are assigned before the load starts).
+CONST_INFILE_COLUMNS = {
+    'agency.txt': ( \
+        '(agency_id, agency_name, agency_url, agency_timezone, agency_lang, agency_phone)', \
+        ''),
+    'calendar.txt': ( \
+        '(service_id, monday, tuesday, wednesday, thursday, friday, saturday, sunday, ' \
+        + 'start_date, end_date)', \
+        ''),
+    'calendar_dates.txt': ( \
+        '(service_id, date, exception_type)', \
+        ''),
+    'routes.txt': ( \
+        '(@route_id, agency_id, route_short_name, route_long_name, route_type)', \
+        'SET route_id = @route_id, ' \
+        + 'route_key = (SELECT route_key FROM route_keys WHERE route_id = @route_id)'),
+    'shapes.txt': ( \
+        '(@shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence, shape_dist_traveled)', \
+        'SET shape_key = (SELECT shape_key FROM shape_keys WHERE shape_id = @shape_id)'),
+    # Spatial points are defined "lon-lat". The distance from the city center is
+    # calculated by MySQL using the same (mean) earth radius as the haversine module.
+    'stops.txt': ( \
+        '(@stop_id, stop_name, @stop_lat, @stop_lon)', \
+        'SET stop_id = @stop_id, ' \
+        + 'stop_key = (SELECT stop_key FROM stop_keys WHERE stop_id = @stop_id), ' \
+        + 'stop_lat = @stop_lat, stop_lon = @stop_lon, ' \
+        + 'stop_position = ' \
+        + 'ST_GeomFromText(CONCAT(\'POINT(\', @stop_lon, \' \', @stop_lat, \')\')), ' \
+        + 'dist_from_cc = ST_Distance_Sphere(' \
+        + 'POINT(@stop_lon, @stop_lat), ' \
+        + 'POINT(' + str(CONST_DUBLIN_CC[1]) + ', ' + str(CONST_DUBLIN_CC[0]) + '), ' \
+        + '6371008.8) / 1000'),
+    'stop_times.txt': ( \
+        '(@trip_id, @arrival_time, @departure_time, @stop_id, stop_sequence, stop_headsign, ' \
+        + 'pickup_type, drop_off_type, shape_dist_traveled)', \
+        'SET trip_key = (SELECT trip_key FROM trip_keys WHERE trip_id = @trip_id), ' \
+        + 'arrival_time = TIME_TO_SEC(@arrival_time), ' \
+        + 'departure_time = TIME_TO_SEC(@departure_time), ' \
+        + 'stop_key = (SELECT stop_key FROM stop_keys WHERE stop_id = @stop_id)'),
+    'transfers.txt': ( \
+        '(from_stop_id, to_stop_id, transfer_type, @min_transfer_time)', \
+        'SET min_transfer_time = NULLIF(@min_transfer_time, \'\')'),
+    'trips.txt': ( \
+        '(@route_id, service_id, @trip_id, @shape_id, trip_headsign, direction_id)', \
+        'SET route_key = (SELECT route_key FROM route_keys WHERE route_id = @route_id), ' \
+        + 'trip_key = (SELECT trip_key FROM trip_keys WHERE trip_id = @trip_id), ' \
+        + 'shape_key = (SELECT shape_key FROM shape_keys WHERE shape_id = @shape_id)')
+}
+
+
+def download_gtfs_schedule_data(import_dir, metrics=None, cronitor_uri=None):
     """Download the latest version of the GTFS Schedule Data.
 
+    The .zip is streamed to disk in chunks. If the .zip from the previous download
+    is still on disk it is only replaced if the feed has changed since - and
+    only by a valid .zip (see verify_gtfs_zip()).
+    The download's metrics are added to the 'metrics' dict (if supplied).
     """
+    download_start_time = time.perf_counter()
+    download_bytes = 0
     print('\tRetrieving GTFS Schedule data from NTA.')
     # NOTE: We must download the combined schedule file as some bus routes are
     #       operated by Dublin Bus, some by Go-Ahead Ireland and others by yet
     #       more operators.  To cover all of Dublin - we need it all...
-    gtfs_schedule_data_file = os.path.join(import_dir, 'google_transit_combined.zip')
+    gtfs_schedule_data_file = os.path.join(import_dir, CONST_GTFS_ZIP_FILENAME)
+    download_state_file = os.path.join(import_dir, CONST_DOWNLOAD_STATE_FILE)
 
-    # If a .zip from a previous download exists - we don't really care. It's all
-    # about having the most up to date data. Log a warning, but proceed...
+    # Conditional request - the NTA answer '304 Not Modified' (with no content)
+    # if the feed hasn't changed since we downloaded the .zip we have.
+    request_headers = {}
     if os.path.exists(gtfs_schedule_data_file):
-        print('\tWARNING: Old Schedule Data file found - Deleting...')
-        os.remove(gtfs_schedule_data_file)
-
-    # Would it be better to use the python 'wget' module??
-    #     response = wget.download( \
-    #         credentials['nta-gtfs']['gtfs-schedule-data-url'], \
-    #         "import/google_transit_dublinbus.zip" \
-    #         )
-    # Open file for binary write...
-    # ... and write to it!
-    response = requests.get(credentials['nta-gtfs']['gtfs-schedule-data-url'])
-    if response.status_code == 200:
-        print('\tSaving GTFS Schedule data to disk.')
-        with open(gtfs_schedule_data_file, "wb") as gtfs_zip:
-            gtfs_zip.write(response.content)
-    else:
-        # Our call to the API failed for some reason...  print some information
-        # Who knows... someone may even look at the logs!!
-        print("ERROR: Call to GTFS Schedule API failed with status code: ", response.status_code)
-        print("       The response reason was \'" + str(response.reason) + "\'")
+        download_state = _load_json_file(download_state_file)
+        if download_state.get('etag'):
+            request_headers['If-None-Match'] = download_state['etag']
+        if download_state.get('last_modified'):
+            request_headers['If-Modified-Since'] = download_state['last_modified']
+
+    with requests.get( \
+            credentials['nta-gtfs']['gtfs-schedule-data-url'], \
+            headers=request_headers, \
+            stream=True, \
+            timeout=CONST_DOWNLOAD_TIMEOUT_S \
+        ) as response:
+        if response.status_code == 304:
+            print('\tGTFS Schedule data unchanged since the last download - ' \
+                + 'using the .zip on disk.')
+        elif response.status_code == 200:
+            print('\tSaving GTFS Schedule data to disk.')
+            # Written to a partial file first, so a failed download never leaves
+            # a truncated .zip behind...
+            partial_file = gtfs_schedule_data_file + '.part'
+            with open(partial_file, "wb") as gtfs_zip:
+                for chunk in response.iter_content(chunk_size=CONST_DOWNLOAD_CHUNK_BYTES):
+                    gtfs_zip.write(chunk)
+                    download_bytes += len(chunk)
+            # ... and only replaces the .zip (and is remembered, for the next
+            # conditional request) if it is a valid .zip.
+            if verify_gtfs_zip(partial_file, cronitor_uri):
+                os.replace(partial_file, gtfs_schedule_data_file)
+                _save_json_file(download_state_file, { \
+                    'etag': response.headers.get('ETag'), \
+                    'last_modified': response.headers.get('Last-Modified')})
+            else:
+                os.remove(partial_file)
+        else:
+            # Our call to the API failed for some reason...  print some information
+            # Who knows... someone may even look at the logs!!
+            print("ERROR: Call to GTFS Schedule API failed with status code: ", \
+                response.status_code)
+            print("       The response reason was \'" + str(response.reason) + "\'")
+
+    if metrics is not None:
+        download_s = time.perf_counter() - download_start_time
+        metrics.update({ \
+            'status_code': response.status_code, \
+            'bytes': download_bytes, \
+            'elapsed_s': round(download_s, 3), \
+            'bytes_per_sec': round(download_bytes / download_s) if download_s > 0 else 0})
 
     return gtfs_schedule_data_file
 
 
-def extract_gtfs_data_from_zip(gtfs_schedule_data_file, import_dir, cronitor_uri):
-    """Extract the contents of the GTFS Schedule Data zip to the import directory
+def verify_gtfs_zip(gtfs_schedule_data_file, cronitor_uri):
+    """Verify the downloaded GTFS Schedule Data zip is well formed
 
+    Registers the failure with cronitor (if a 'cronitor_uri' is supplied) if
+    not. Returns True if the zip is good.
     """
-    # Verify the downloaded zipfile is well formed...
     if zipfile.is_zipfile(gtfs_schedule_data_file):
-        # IMPORTANT NOTE: ZipFile OVERWRITES files without asking. In this case,
-        # that is the behaviour we require. But it's important to be aware of it.
-        with ZipFile(gtfs_schedule_data_file, 'r') as gtfs_zip:
-            # Extract all the contents of zip file in current directory
-            gtfs_zip.extractall(path=import_dir)
-        print('\tGTFS Schedule Data Extract Complete - Removing .Zip Archive.')
-        os.remove(gtfs_schedule_data_file)
-    else:
-        print('ERROR: Downloaded GTFS Schedule Data is not a valid .Zip file!')
-        print('       Aborting...')
+        return True
+
+    print('ERROR: Downloaded GTFS Schedule Data is not a valid .Zip file!')
+    print('       Aborting...')
+    if cronitor_uri is not None:
         # Send a Cronitor request to signal our process has failed.
         requests.get(cronitor_uri + "?state=fail")
-        # We don't have to clear down the file - it will get automatically cleared
-        # during the next pass...
+    return False
 
 
-def import_gtfs_txt_files_to_db(import_dir, session_maker):
-    """Iterate Over the GTFS Txt Files, Import them to the db
+def extract_gtfs_data_from_zip(gtfs_schedule_data_file, import_dir, cronitor_uri):
+    """Extract the contents of the GTFS Schedule Data zip to the import directory
+
+    Only used with '--extract' - by default the files are read from the zip.
+    Returns True if the zip was good (and extracted).
+    """
+    # Verify the downloaded zipfile is well formed...
+    if not verify_gtfs_zip(gtfs_schedule_data_file, cronitor_uri):
+        return False
+
+    # IMPORTANT NOTE: ZipFile OVERWRITES files without asking. In this case,
+    # that is the behaviour we require. But it's important to be aware of it.
+    with ZipFile(gtfs_schedule_data_file, 'r') as gtfs_zip:
+        # Extract all the contents of zip file in current directory
+        gtfs_zip.extractall(path=import_dir)
+    print('\tGTFS Schedule Data Extract Complete - Removing .Zip Archive.')
+    os.remove(gtfs_schedule_data_file)
+    # With the .zip gone, the ETag/Last-Modified saved for it no longer
+    # describe anything on disk - the next download must be unconditional.
+    download_state_file = os.path.join(import_dir, CONST_DOWNLOAD_STATE_FILE)
+    if os.path.exists(download_state_file):
+        os.remove(download_state_file)
+    return True
+
+
+def _gtfs_zip(import_dir):
+    """Return the GTFS Schedule Data zip, if the files are to be read from it (else None)
+
+    The GTFS Txt Files are read from the zip whenever there is one in the import
+    directory, otherwise from the (extracted) files in the import directory.
+    """
+    gtfs_zip_file = os.path.join(import_dir, CONST_GTFS_ZIP_FILENAME)
+    if zipfile.is_zipfile(gtfs_zip_file):
+        return gtfs_zip_file
+    return None
+
 
+def _gtfs_filenames(import_dir):
+    """Return the names of the files in the zip (or the import directory)
     """
+    gtfs_zip_file = _gtfs_zip(import_dir)
+    if gtfs_zip_file is not None:
+        with ZipFile(gtfs_zip_file, 'r') as gtfs_zip:
+            return [name for name in gtfs_zip.namelist() if not name.endswith('/')]
 
+    filenames = []
     import_dir_enc = os.fsencode(import_dir)
     for file in os.listdir(import_dir_enc):
         # 'file' is a handle on the actual file...
         filename = os.fsdecode(file)
-        path_this_item = os.path.join(import_dir, filename)
+        if not os.path.isdir(os.path.join(import_dir, filename)):
+            # (directories are skipped)
+            filenames.append(filename)
+    return filenames
 
-        if os.path.isdir(path_this_item):
-                # skip directories
-                pass
-        elif filename == ".gitignore":
+
+@contextmanager
+def _open_gtfs_txt(import_dir, filename):
+    """Open a GTFS Txt File for binary reading - a member stream if reading the zip
+    """
+    gtfs_zip_file = _gtfs_zip(import_dir)
+    if gtfs_zip_file is None:
+        with open(os.path.join(import_dir, filename), 'rb') as gtfs_txt:
+            yield gtfs_txt
+    else:
+        # The member is decompressed as it is read - nothing is written to disk.
+        with ZipFile(gtfs_zip_file, 'r') as gtfs_zip, gtfs_zip.open(filename) as gtfs_txt:
+            yield gtfs_txt
+
+
+@contextmanager
+def _open_gtfs_csv(import_dir, filename):
+    """Open a GTFS Txt File as text, ready for a csv reader
+    """
+    with _open_gtfs_txt(import_dir, filename) as gtfs_txt:
+        yield io.TextIOWrapper(gtfs_txt, encoding='utf-8', newline='')
+
+
+def _gtfs_txt_file_on_disk(import_dir, file_load):
+    """Return the path of a GTFS Txt File on disk, extracting it from the zip if need be
+
+    For the loads that need a real file - 'LOAD DATA' and sharded loads (which seek).
+    """
+    gtfs_zip_file = _gtfs_zip(import_dir)
+    if gtfs_zip_file is not None:
+        print('        Extracting ' + file_load.filename + ' from the .zip.')
+        extract_start_time = time.perf_counter()
+        with ZipFile(gtfs_zip_file, 'r') as gtfs_zip:
+            gtfs_zip.extract(file_load.filename, path=import_dir)
+        file_load.stats['extract_s'] += time.perf_counter() - extract_start_time
+    return os.path.join(import_dir, file_load.filename)
+
+
+def _gtfs_txt_file_fingerprints(import_dir):
+    """Return the size and SHA-256 of each (known) GTFS Txt File
+
+    Returns a dict keyed by filename, e.g. {'trips.txt': {'size': .., 'sha256': ..}}
+    """
+    fingerprints = {}
+    gtfs_filenames = _gtfs_filenames(import_dir)
+    for filename in sorted(GTFS_FILE_MODELS):
+        if filename not in gtfs_filenames:
+            continue
+
+        sha256 = hashlib.sha256()
+        size = 0
+        with _open_gtfs_txt(import_dir, filename) as gtfs_txt:
+            for chunk in iter(lambda: gtfs_txt.read(CONST_HASH_CHUNK_BYTES), b''):
+                sha256.update(chunk)
+                size += len(chunk)
+
+        fingerprints[filename] = {'size': size, 'sha256': sha256.hexdigest()}
+    return fingerprints
+
+
+def _load_fingerprints(import_dir):
+    """Return the fingerprints saved by the last successful load ({} if none)
+    """
+    return _load_json_file(os.path.join(import_dir, CONST_FINGERPRINTS_FILE))
+
+
+def _save_fingerprints(import_dir, fingerprints):
+    """Save the fingerprints of the files just loaded, for the next run to compare
+    """
+    _save_json_file(os.path.join(import_dir, CONST_FINGERPRINTS_FILE), fingerprints)
+
+
+def _load_json_file(json_file):
+    """Return the content of one of the loader's json files ({} if there is none)
+    """
+    if not exists(json_file):
+        return {}
+
+    try:
+        with open(json_file, 'r') as json_content:
+            return json.load(json_content)
+    except (OSError, ValueError):
+        print('WARNING: Unable to read ' + os.path.basename(json_file) + ' - ignoring it')
+        return {}
+
+
+def _save_json_file(json_file, content):
+    """Save one of the loader's json files
+    """
+    with open(json_file, 'w') as json_content:
+        json.dump(content, json_content, indent=4, sort_keys=True)
+
+
+def _unchanged_gtfs_txt_files(fingerprints, previous_fingerprints):
+    """Return the (sorted) files whose fingerprint matches the previous load
+    """
+    return sorted( \
+        filename \
+        for filename, fingerprint in fingerprints.items() \
+        if previous_fingerprints.get(filename) == fingerprint)
+
+
+def import_gtfs_txt_files_to_db( \
+        import_dir, session_maker, options=None, unchanged_files=(), metrics=None):
+    """Iterate Over the GTFS Txt Files, Import them to the db
+
+    'options' are the loader options parsed by _parse_args() (defaults if None).
+    Files named in 'unchanged_files' are skipped (their tables are left as is).
+    The metrics for each file (and the swap) are added to the 'metrics' dict.
+    Unless the 'in place' option is set, each file is loaded into a staging table
+    and the live tables are swapped for the staging tables once every file loads.
+    With more than one worker, the large files are loaded in parallel by a pool
+    of worker processes while the small files are loaded here.
+    """
+    if options is None:
+        options = _parse_args([])
+
+    if not options.resume:
+        # Progress saved by an earlier failed load is of no interest...
+        _clear_checkpoints(import_dir)
+
+    gtfs_txt_files = []
+
+    for filename in _gtfs_filenames(import_dir):
+        if filename in CONST_IMPORT_DIR_FILES:
             # Expected extraneous file... ignore...
             pass
+        elif filename in unchanged_files:
+            print('Skipping ' + filename + ' (unchanged since the last load)')
+        elif filename.endswith(".txt"):
+            gtfs_txt_files.append(filename)
         else:
-            print('----------------------------------------')
-            print('Processing \"' + str(filename) + '\".' \
-                + ' Time is: ' + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-
-            if filename.endswith(".txt"):
-                # Now... load all the files, by name...
-                # There may be a better abstraction for this but as we're only dealing
-                # with ten files we're taking the following expedient approach.
-
-                # Some of the files are large... 'stop_times.txt' is 220MB. We use a
-                # 'csv reader' as it is quite memory efficient. It is an iterator -
-                # so it processes the file line by line and does not load the whole
-                # file into memory (which would be bad).
-                with open(
-                        os.path.join(import_dir, filename), \
-                        newline='', \
-                        encoding='utf-8' \
-                    ) as gtfs_csv:
-                    data = csv.reader(gtfs_csv, delimiter=",")
-                    # Skip over the first line (header row)
-                    next(data)
-
-                    # Instantiate a session *per file* so we can talk to the database!
-                    session = session_maker()
-                    objects_this_session = []  # We build a list of objects for bulk insert...
-
-                    # Process the files line-by-line...
-                    # -> Some files are small (e.g. agency - 1 record). We process
-                    #    the entire file and move on.
-                    # -> Some files are large (e.g. stop-times, 2M+ records). We
-                    #    process these in batches to make better use of each session
-
-                    # RISK!!!!  We truncate the table before re-populating...
-                    #           What if population fails???
-
-                    if filename == "agency.txt":
-                        import_agency(data, session, objects_this_session)
-
-                    elif filename == "calendar.txt":
-                        import_calendar(data, session, objects_this_session)
-
-                    elif filename == "calendar_dates.txt":
-                        import_calendar_dates(data, session, objects_this_session)
-
-                    elif filename == "routes.txt":
-                        import_routes(data, session, objects_this_session)
-
-                    elif filename == "shapes.txt":
-                        session, objects_this_session = \
-                            import_shapes(data, session, session_maker, objects_this_session)
-
-                    elif filename == "stops.txt":
-                        import_stops(data, session, objects_this_session)
-
-                    elif filename == "stop_times.txt":
-                        session, objects_this_session = \
-                            import_stop_times(data, session, session_maker, objects_this_session)
-
-                    elif filename == "transfers.txt":
-                        import_transfers(data, session, objects_this_session)
-
-                    elif filename == "trips.txt":
-                        session, objects_this_session = \
-                            import_trips(data, session, session_maker, objects_this_session)
-
-                    else:
-                        print('WARNING: Unexpected .txt file encountered -> ' + str(filename))
-                        print('         Ignoring...')
-
-                    # To see a list of updated objects we can use:
-                    #   -> print('session.dirty -> ', session.dirty)
-                    # To see a list of new objects we can use:
-                    #   -> print('session.new -> ', session.new)
-
-                    # Save outstanding insertions to the db...
-                    if len(objects_this_session) > 0:
-                        print('#', end='')
-                        session.bulk_save_objects(objects_this_session)
-                        session.commit()
-            else:
-                print('WARNING: Unexpected file encountered -> ' + str(filename))
-                print('         Ignoring...')
+            print('WARNING: Unexpected file encountered -> ' + str(filename))
+            print('         Ignoring...')
+
+    # Keys for new GTFS ids are assigned up front, so every file load (in
+    # whatever process) reads the same keys.
+    print('Assigning keys to new GTFS ids.')
+    keys_start_time = time.perf_counter()
+    num_keys = _register_gtfs_keys(import_dir, session_maker, gtfs_txt_files)
+    if metrics is not None:
+        metrics['gtfs_keys'] = { \
+            'assigned': num_keys, 'elapsed_s': round(time.perf_counter() - keys_start_time, 3)}
+
+    parallel_files = []
+    if options.workers > 1:
+        parallel_files = [f for f in gtfs_txt_files if f in CONST_PARALLEL_GTFS_FILES]
+    serial_files = [f for f in gtfs_txt_files if f not in parallel_files]
+
+    # For each file loaded: (rows loaded, wall time in seconds, metrics)
+    file_load_times = {}
+
+    if len(parallel_files) > 0:
+        print('Loading ' + ', '.join(parallel_files) + ' in parallel (' \
+            + str(options.workers) + ' worker processes).')
+        with ProcessPoolExecutor(max_workers=options.workers) as executor:
+            futures = [ \
+                executor.submit( \
+                    _timed_import_gtfs_txt_file_in_worker, import_dir, filename, options) \
+                for filename in parallel_files]
+
+            # The small files are loaded here while the workers get on with the
+            # large files...
+            for filename in serial_files:
+                file_load_times[filename] = \
+                    _timed_import_gtfs_txt_file(import_dir, filename, session_maker, options)
+
+            # (result() re-raises any exception raised in the worker)
+            for filename, future in zip(parallel_files, futures):
+                file_load_times[filename] = future.result()
+    else:
+        for filename in serial_files:
+            file_load_times[filename] = \
+                _timed_import_gtfs_txt_file(import_dir, filename, session_maker, options)
+
+    _print_file_load_times(file_load_times)
+    if metrics is not None:
+        metrics['files'] = { \
+            filename: file_metrics \
+            for filename, (_, _, file_metrics) in file_load_times.items() \
+            if file_metrics is not None}
+
+    models_loaded = []
+    for filename, (num_rows, _, _) in file_load_times.items():
+        if num_rows is not None and not _is_incremental_load(options, filename):
+            models_loaded.append(GTFS_FILE_MODELS[filename])
+            models_loaded.extend(CONST_DERIVED_GTFS_MODELS.get(filename, ()))
+    if not options.in_place and len(models_loaded) > 0:
+        # Every file loaded without error - put the new data live.
+        swap_start_time = time.perf_counter()
+        _swap_staging_tables(session_maker, models_loaded)
+        if metrics is not None:
+            metrics['swap_s'] = round(time.perf_counter() - swap_start_time, 3)
+
+    _clear_checkpoints(import_dir)
+
+
+def _timed_import_gtfs_txt_file(import_dir, filename, session_maker, options):
+    """Import a single GTFS Txt File to the db, timing the load
+
+    Returns a tuple of (rows loaded, wall time in seconds, metrics) - see
+    _file_load_metrics() for the metrics.
+    """
+    print('----------------------------------------')
+    print('Processing \"' + str(filename) + '\".' \
+        + ' Time is: ' + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
-            print('')
+    file_start_time = time.perf_counter()
+    num_rows, file_load = _import_gtfs_txt_file(import_dir, filename, session_maker, options)
+    elapsed_s = time.perf_counter() - file_start_time
 
+    print('')
+    if file_load is None:
+        return num_rows, elapsed_s, None
+    return num_rows, elapsed_s, _file_load_metrics(file_load, num_rows, elapsed_s)
 
-def import_agency(data, session, objects_this_session):
-    """Import content from data into the Agency table
 
+def _timed_import_gtfs_txt_file_in_worker(import_dir, filename, options):
+    """Import a single GTFS Txt File to the db from a worker process
+
+    Db connections can't be shared between processes, so each worker creates
+    its own engine (and sessions).
+    Returns a tuple of (rows loaded, wall time in seconds, metrics).
+    """
+    engine = _create_engine(options)
+    try:
+        return _timed_import_gtfs_txt_file(
+            import_dir, filename, sessionmaker(bind=engine), options
+            )
+    finally:
+        engine.dispose()
+
+
+def _print_file_load_times(file_load_times):
+    """Print a summary of the wall time taken to load each file
+    """
+    print('----------------------------------------')
+    print('Load Summary:')
+    for filename, (num_rows, elapsed_s, _) in file_load_times.items():
+        if num_rows is None:
+            print('        ' + filename.ljust(20) + '   (ignored)')
+        else:
+            print('        ' + filename.ljust(20) + f'{elapsed_s:10.2f}s' \
+                + f'{num_rows:12,d} rows')
+    print('')
+
+
+def _file_load_metrics(file_load, num_rows, elapsed_s):
+    """Return the metrics for the load of a file (as a json serialisable dict)
+
+    'parse' is the time not spent writing to the db (reading, parsing and
+    building records). With shards, the insert and commit times are summed over
+    the workers (so can exceed the wall time).
+    """
+    stats = file_load.stats
+    commit_latencies_ms = np.array(stats['commit_latencies_s']) * 1000
+    index_build_s = sum(stats['index_build_s'].values())
+    write_s = stats['insert_s'] + commit_latencies_ms.sum() / 1000
+    parse_s = max(0.0, \
+        elapsed_s - write_s - stats['extract_s'] - index_build_s - stats['derived_tables_s'])
+
+    def per_sec(seconds):
+        return round(num_rows / seconds) if num_rows and seconds > 0 else None
+
+    metrics = { \
+        'rows': num_rows, \
+        'insert_mode': file_load.insert_mode, \
+        'elapsed_s': round(elapsed_s, 3), \
+        'extract_s': round(stats['extract_s'], 3), \
+        'parse_s': round(parse_s, 3), \
+        'parse_rows_per_sec': per_sec(parse_s), \
+        'insert_s': round(stats['insert_s'], 3), \
+        'insert_rows_per_sec': per_sec(stats['insert_s']), \
+        'commits': len(commit_latencies_ms), \
+        'index_build_s': { \
+            index_name: round(build_s, 3) \
+            for index_name, build_s in stats['index_build_s'].items()}, \
+        'derived_tables_s': round(stats['derived_tables_s'], 3), \
+        'batch_sizes': file_load.batch_sizer.sizes_used}
+    if len(commit_latencies_ms) > 0:
+        metrics['commit_latency_ms'] = { \
+            'p50': round(float(np.percentile(commit_latencies_ms, 50)), 1), \
+            'p90': round(float(np.percentile(commit_latencies_ms, 90)), 1), \
+            'p99': round(float(np.percentile(commit_latencies_ms, 99)), 1), \
+            'max': round(float(commit_latencies_ms.max()), 1)}
+    return metrics
+
+
+def import_gtfs_txt_file(import_dir, filename, session_maker, options):
+    """Import a single GTFS Txt File to the db
+
+    Uses the insert mode chosen for this file in 'options'.
+    Returns the number of rows loaded (None if the file is not a GTFS file we load).
+    """
+    num_rows, _ = _import_gtfs_txt_file(import_dir, filename, session_maker, options)
+    return num_rows
+
+
+def _import_gtfs_txt_file(import_dir, filename, session_maker, options):
+    """Import a single GTFS Txt File to the db (see import_gtfs_txt_file())
+
+    Returns a tuple of (rows loaded, the GtfsFileLoad) - (None, None) if the
+    file is not a GTFS file we load.
     """
-    truncate_table(session, Agency)
+    if filename not in GTFS_FILE_MODELS:
+        print('WARNING: Unexpected .txt file encountered -> ' + str(filename))
+        print('         Ignoring...')
+        return None, None
+
+    if _is_incremental_load(options, filename):
+        # The diff is applied to the live table itself (no staging table)
+        file_load = GtfsFileLoad(filename, CONST_INSERT_MODE_CORE, False)
+        print('        Incremental load (only rows that differ from the table are written).')
+        file_start_time = time.perf_counter()
+        num_rows = _import_gtfs_txt_file_incrementally(import_dir, file_load, session_maker)
+        _print_rows_per_sec(num_rows, time.perf_counter() - file_start_time, file_load.insert_mode)
+        _build_derived_tables(session_maker, file_load)
+        return num_rows, file_load
+
+    file_load = GtfsFileLoad(
+        filename, _insert_mode_for_file(options, filename), not options.in_place, \
+        options.defer_indexes and filename in CONST_DEFERRED_INDEX_GTFS_FILES
+        )
+    print('        Insert mode is \"' + file_load.insert_mode + '\".')
+    file_load.batch_sizer = BatchSizer(options.batch_size)
+
+    file_load.checkpoint = GtfsLoadCheckpoint(import_dir, file_load)
+    if options.resume and file_load.checkpoint.restore():
+        if file_load.checkpoint.complete:
+            print('        Loaded by an earlier run (' + str(file_load.checkpoint.rows_committed) \
+                + ' rows) - nothing to resume.')
+            return file_load.checkpoint.rows_committed, file_load
+        print('        Resuming after batch ' + str(file_load.checkpoint.batches_committed) \
+            + ' (' + str(file_load.checkpoint.rows_committed) + ' rows already committed).')
+        # The indexes the failed load dropped (not dropped again - the table
+        # isn't prepared afresh).
+        file_load.deferred_indexes = file_load.checkpoint.deferred_indexes
+    file_start_time = time.perf_counter()
+
+    num_rows = None
+    if file_load.insert_mode == CONST_INSERT_MODE_INFILE:
+        num_rows = _import_gtfs_txt_file_using_infile(import_dir, file_load, session_maker)
+        if num_rows is None:
+            # MySQL refused the 'LOAD DATA' - fall back to a Core executemany load.
+            file_load.insert_mode = CONST_INSERT_MODE_CORE
+            print('        Insert mode is now \"' + file_load.insert_mode + '\".')
+
+    if num_rows is None:
+        if filename in CONST_SHARDED_GTFS_FILES and options.shards > 1:
+            num_rows = _import_gtfs_txt_file_in_shards( \
+                import_dir, file_load, session_maker, options)
+        else:
+            num_rows = _import_gtfs_txt_file_using_csv(import_dir, file_load, session_maker)
+
+    _print_rows_per_sec(num_rows, time.perf_counter() - file_start_time, file_load.insert_mode)
+    file_load.batch_sizer.print_sizes_used()
+
+    if file_load.defer_indexes:
+        _build_deferred_indexes(session_maker, file_load)
 
+    _build_derived_tables(session_maker, file_load)
+
+    file_load.checkpoint.file_complete(num_rows)
+
+    return num_rows, file_load
+
+
+class GtfsFileLoad:
+    """The target table and settings for the load of one GTFS file
+
+    When staging, rows are written to a copy of the model's table (see
+    _staging_table()) rather than to the live table. When deferring indexes,
+    the table's indexes are dropped before the load and built after it.
+    """
+
+    def __init__(self, filename, insert_mode, staging, defer_indexes=False):
+        # Instance Variables
+        self.filename = filename
+        self.model = GTFS_FILE_MODELS[filename]
+        self.insert_mode = insert_mode
+        self.staging = staging
+        self.defer_indexes = defer_indexes
+        self.deferred_indexes = {}  # (the indexes dropped for the load)
+        self.checkpoint = None  # (a GtfsLoadCheckpoint, if progress is saved)
+        self.batch_sizer = BatchSizer()
+        # GTFS id column -> {GTFS id: key}, for the ids in this file (see _load_gtfs_keys())
+        self.gtfs_keys = {}
+        # Time spent writing to the db etc. - see _file_load_metrics()
+        self.stats = { \
+            'insert_s': 0.0, 'commit_latencies_s': [], 'extract_s': 0.0, 'index_build_s': {}, \
+            'derived_tables_s': 0.0}
+        self.table = self.model.__table__
+        if staging:
+            self.table = _staging_table(self.model)
+            if insert_mode == CONST_INSERT_MODE_ORM:
+                # Model objects always save to the live table, so staging loads
+                # write the same records with a Core insert instead.
+                print('        (\"' + insert_mode + '\" mode writes to the live table,' \
+                    + ' staging with \"' + CONST_INSERT_MODE_CORE + '\" instead)')
+                self.insert_mode = CONST_INSERT_MODE_CORE
+
+
+class GtfsLoadCheckpoint:
+    """The progress of the load of one GTFS file, saved as each batch is committed
+
+    Saved to a json file in the checkpoint directory. A checkpoint is only
+    restored for the same GTFS file (same size and CRC/mtime) loading into the
+    same table - anything else and the file is loaded from the start.
+    The definitions of the indexes dropped for the load (see
+    _drop_deferred_indexes()) are saved too, so a resumed load rebuilds them.
+    """
+
+    def __init__(self, import_dir, file_load):
+        # Instance Variables
+        self.checkpoint_file = os.path.join( \
+            import_dir, CONST_CHECKPOINT_DIR, file_load.filename + '.json')
+        self.gtfs_txt_file_id = _gtfs_txt_file_id(import_dir, file_load.filename)
+        self.table_name = file_load.table.name
+        self.rows_committed = 0
+        self.batches_committed = 0
+        self.complete = False
+        # index name -> (unique, [column names])
+        self.deferred_indexes = {}
+
+    def restore(self):
+        """Restore the progress saved by an earlier load, returns True if there was any
+        """
+        saved = _load_json_file(self.checkpoint_file)
+        if saved.get('gtfs_txt_file_id') != self.gtfs_txt_file_id \
+                or saved.get('table') != self.table_name:
+            return False
+
+        self.rows_committed = saved['rows_committed']
+        self.batches_committed = saved['batches_committed']
+        self.complete = saved['complete']
+        self.deferred_indexes = { \
+            index_name: (unique, column_names) \
+            for index_name, (unique, column_names) \
+            in saved.get('deferred_indexes', {}).items()}
+        return self.rows_committed > 0 or self.complete
+
+    def restart(self):
+        """The load is starting from the beginning (the target table is empty)
+
+        (the deferred indexes are kept - they are dropped before the restart)
+        """
+        self.rows_committed = 0
+        self.batches_committed = 0
+        self.complete = False
+        self.save()
+
+    def batch_committed(self, num_rows):
+        """A batch of 'num_rows' rows has been committed
+        """
+        self.rows_committed += num_rows
+        self.batches_committed += 1
+        self.save()
+
+    def file_complete(self, num_rows):
+        """Every row of the file is loaded
+        """
+        self.rows_committed = num_rows
+        self.complete = True
+        self.save()
+
+    def save(self):
+        """Save the checkpoint (replacing the file, so it's never half written)
+        """
+        os.makedirs(os.path.dirname(self.checkpoint_file), exist_ok=True)
+        _save_json_file(self.checkpoint_file + '.tmp', { \
+            'gtfs_txt_file_id': self.gtfs_txt_file_id, \
+            'table': self.table_name, \
+            'rows_committed': self.rows_committed, \
+            'batches_committed': self.batches_committed, \
+            'complete': self.complete, \
+            'deferred_indexes': self.deferred_indexes})
+        os.replace(self.checkpoint_file + '.tmp', self.checkpoint_file)
+
+
+def _gtfs_txt_file_id(import_dir, filename):
+    """Return a (cheap) identity for a GTFS Txt File - changes if the file does
+
+    The size and CRC of a file in the zip, or the size and mtime of one on disk.
+    """
+    gtfs_zip_file = _gtfs_zip(import_dir)
+    if gtfs_zip_file is not None:
+        with ZipFile(gtfs_zip_file, 'r') as gtfs_zip:
+            zip_info = gtfs_zip.getinfo(filename)
+        return {'size': zip_info.file_size, 'crc': zip_info.CRC}
+
+    file_stat = os.stat(os.path.join(import_dir, filename))
+    return {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+
+
+def _clear_checkpoints(import_dir):
+    """Remove the checkpoints of every file
+    """
+    shutil.rmtree(os.path.join(import_dir, CONST_CHECKPOINT_DIR), ignore_errors=True)
+
+
+def _import_gtfs_txt_file_using_csv(import_dir, file_load, session_maker):
+    """Parse a GTFS Txt File with a csv reader, writing batches of rows to the db
+
+    Returns the number of rows loaded.
+    """
+    # Some of the files are large... 'stop_times.txt' is 220MB. We use a
+    # 'csv reader' as it is quite memory efficient. It is an iterator -
+    # so it processes the file line by line and does not load the whole
+    # file into memory (which would be bad). Reading from the .zip, the file is
+    # decompressed as we go - it never touches the disk.
+    with _open_gtfs_csv(import_dir, file_load.filename) as gtfs_csv:
+        data = csv.reader(gtfs_csv, delimiter=",")
+        # Skip over the first line (header row)
+        next(data)
+
+        # Instantiate a session *per file* so we can talk to the database!
+        session = session_maker()
+
+        rows_committed = 0
+        if file_load.checkpoint is not None:
+            rows_committed = file_load.checkpoint.rows_committed
+
+        if rows_committed > 0:
+            # Resuming - the rows committed by the failed load are in the table
+            # already, so we skip over them (without parsing them into records).
+            for _ in islice(data, rows_committed):
+                pass
+        else:
+            # When loading in place we truncate the table before re-populating...
+            # RISK!!!!  What if population fails??? (staging loads avoid this risk)
+            _prepare_target_table(session, file_load)
+
+        _import_gtfs_csv_rows(data, session, session_maker, file_load)
+
+        # The csv reader counts the lines it has read (we don't count the header)
+        return data.line_num - 1
+
+
+def _import_gtfs_csv_rows(data, session, session_maker, file_load):
+    """Write the rows from the csv reader 'data' to the db, in batches
+
+    The target table must already be prepared (see _prepare_target_table()).
+    """
+    filename = file_load.filename
+    objects_this_session = []  # We build a list of objects for bulk insert...
+    file_load.gtfs_keys = _load_gtfs_keys(session, filename)
+
+    # Process the files line-by-line...
+    # -> Some files are small (e.g. agency - 1 record). We process
+    #    the entire file and move on.
+    # -> Some files are large (e.g. stop-times, 2M+ records). We
+    #    process these in batches to make better use of each session
+
+    # Now... load all the files, by name...
+    # There may be a better abstraction for this but as we're only dealing
+    # with ten files we're taking the following expedient approach.
+    if filename == "agency.txt":
+        import_agency(data, session, objects_this_session, file_load)
+
+    elif filename == "calendar.txt":
+        import_calendar(data, session, objects_this_session, file_load)
+
+    elif filename == "calendar_dates.txt":
+        import_calendar_dates(data, session, objects_this_session, file_load)
+
+    elif filename == "routes.txt":
+        import_routes(data, session, objects_this_session, file_load)
+
+    elif filename == "shapes.txt":
+        session, objects_this_session = \
+            import_shapes(data, session, session_maker, objects_this_session, file_load)
+
+    elif filename == "stops.txt":
+        import_stops(data, session, objects_this_session, file_load)
+
+    elif filename == "stop_times.txt":
+        session, objects_this_session = \
+            import_stop_times(data, session, session_maker, objects_this_session, file_load)
+
+    elif filename == "transfers.txt":
+        import_transfers(data, session, objects_this_session, file_load)
+
+    elif filename == "trips.txt":
+        session, objects_this_session = \
+            import_trips(data, session, session_maker, objects_this_session, file_load)
+
+    # To see a list of updated objects we can use:
+    #   -> print('session.dirty -> ', session.dirty)
+    # To see a list of new objects we can use:
+    #   -> print('session.new -> ', session.new)
+
+    # Save outstanding insertions to the db...
+    if len(objects_this_session) > 0:
+        print('#', end='')
+        _save_batch(session, file_load, objects_this_session)
+    session.commit()
+    session.close()
+
+
+def _import_gtfs_txt_file_in_shards(import_dir, file_load, session_maker, options):
+    """Load a GTFS Txt File using a pool of workers, each loading one shard of the file
+
+    The file is split into byte ranges aligned on line boundaries (see
+    _shard_byte_ranges()). Every worker parses its own shard and writes it in
+    batches (sized by its own BatchSizer), just like a single process load.
+    Returns the number of rows loaded.
+    """
+    # (The workers seek to their shard, so they need the file on disk)
+    gtfs_txt_file = _gtfs_txt_file_on_disk(import_dir, file_load)
+
+    # The target table is prepared once, before any of the workers start.
+    session = session_maker()
+    _prepare_target_table(session, file_load)
+    session.commit()
+    session.close()
+
+    shards = _shard_byte_ranges(gtfs_txt_file, options.shards)
+    print('        Loading in ' + str(len(shards)) + ' shards (' \
+        + str(options.shards) + ' worker processes).')
+    with ProcessPoolExecutor(max_workers=options.shards) as executor:
+        futures = [ \
+            executor.submit( \
+                _import_gtfs_txt_shard_in_worker, gtfs_txt_file, \
+                file_load.filename, file_load.insert_mode, file_load.staging, \
+                shard_start, shard_end, options) \
+            for shard_start, shard_end in shards]
+
+        # (result() re-raises any exception raised in the worker)
+        num_rows = 0
+        for future in futures:
+            shard_rows, shard_stats = future.result()
+            num_rows += shard_rows
+            file_load.stats['insert_s'] += shard_stats['insert_s']
+            file_load.stats['commit_latencies_s'].extend(shard_stats['commit_latencies_s'])
+        return num_rows
+
+
+def _shard_byte_ranges(gtfs_txt_file, num_shards):
+    """Split the data rows of a GTFS Txt File into (roughly) equal byte ranges
+
+    Each range starts at the beginning of a line (the header row is excluded)
+    and ends where the next range starts. Returns a list of (start, end) byte
+    offsets - fewer than 'num_shards' if the file is very small.
+    """
+    with open(gtfs_txt_file, 'rb') as gtfs_txt:
+        gtfs_txt.readline()  # Skip the header row
+        data_start = gtfs_txt.tell()
+        file_size = os.fstat(gtfs_txt.fileno()).st_size
+
+        boundaries = [data_start]
+        for shard in range(1, num_shards):
+            # Seek to the approximate boundary, then move on to the start of the
+            # next line...
+            gtfs_txt.seek(
+                max(data_start + (file_size - data_start) * shard // num_shards, boundaries[-1])
+                )
+            gtfs_txt.readline()
+            boundaries.append(min(gtfs_txt.tell(), file_size))
+        boundaries.append(file_size)
+
+    return [ \
+        (shard_start, shard_end) \
+        for shard_start, shard_end in zip(boundaries, boundaries[1:]) \
+        if shard_end > shard_start]
+
+
+def _shard_lines(gtfs_txt, shard_start, shard_end):
+    """Yield the (decoded) lines of a GTFS Txt File between two byte offsets
+    """
+    gtfs_txt.seek(shard_start)
+    position = shard_start
+    while position < shard_end:
+        line = gtfs_txt.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line.decode('utf-8')
+
+
+def _import_gtfs_txt_shard_in_worker( \
+        gtfs_txt_file, filename, insert_mode, staging, shard_start, shard_end, options):
+    """Load one shard of a GTFS Txt File from a worker process
+
+    Each worker creates its own engine (and sessions).
+    Returns a tuple of (rows loaded, the shard's GtfsFileLoad stats).
+    """
+    file_load = GtfsFileLoad(filename, insert_mode, staging)
+    file_load.batch_sizer = BatchSizer(options.batch_size)
+    engine = _create_engine(options)
+    session_maker = sessionmaker(bind=engine)
+    try:
+        with open(gtfs_txt_file, 'rb') as gtfs_txt:
+            data = csv.reader(_shard_lines(gtfs_txt, shard_start, shard_end), delimiter=",")
+            _import_gtfs_csv_rows(data, session_maker(), session_maker, file_load)
+            return data.line_num, file_load.stats
+    finally:
+        engine.dispose()
+
+
+def _import_gtfs_txt_file_using_infile(import_dir, file_load, session_maker):
+    """Load a GTFS Txt File to the db using MySQL 'LOAD DATA LOCAL INFILE'
+
+    No csv parsing happens in python at all - MySQL reads the file directly.
+    Returns the number of rows loaded, or None if MySQL refused the load (e.g.
+    the server has 'local_infile' disabled).
+    """
+    # (MySQL can only read a file on disk)
+    gtfs_txt_file = _gtfs_txt_file_on_disk(import_dir, file_load)
+    columns, set_clause = CONST_INFILE_COLUMNS[file_load.filename]
+
+    # The GTFS files can come with either unix or windows line endings, we check
+    # the header row to find out which...
+    with open(gtfs_txt_file, 'rb') as gtfs_txt:
+        header_row = gtfs_txt.readline()
+    line_terminator = '\\r\\n' if header_row.endswith(b'\r\n') else '\\n'
+
+    load_data_sql = \
+        'LOAD DATA LOCAL INFILE \'' + gtfs_txt_file.replace('\\', '\\\\') + '\'' \
+        + ' INTO TABLE ' + file_load.table.name \
+        + ' CHARACTER SET utf8mb4' \
+        + ' FIELDS TERMINATED BY \',\' OPTIONALLY ENCLOSED BY \'\"\'' \
+        + ' LINES TERMINATED BY \'' + line_terminator + '\'' \
+        + ' IGNORE 1 LINES ' \
+        + columns + ' ' + set_clause
+
+    session = session_maker()
+    try:
+        _prepare_target_table(session, file_load)
+        print('          -> ', end='')
+        insert_start_time = time.perf_counter()
+        result = session.execute(db.text(load_data_sql))
+        commit_start_time = time.perf_counter()
+        session.commit()
+        file_load.stats['insert_s'] += commit_start_time - insert_start_time
+        file_load.stats['commit_latencies_s'].append(time.perf_counter() - commit_start_time)
+        print('#', end='')
+        num_rows = result.rowcount
+    except (SQLAlchemyError, DBAPIError) as load_data_error:
+        # (The fallback load prepares and repopulates the table anyway.)
+        session.rollback()
+        print('\n        WARNING: LOAD DATA LOCAL INFILE failed -> ' + str(load_data_error))
+        num_rows = None
+    finally:
+        session.close()
+
+    return num_rows
+
+
+def _import_gtfs_txt_file_incrementally(import_dir, file_load, session_maker):
+    """Apply only the differences between a GTFS Txt File and its (live) table
+
+    Rows are matched on the file's key columns (CONST_INCREMENTAL_GTFS_KEYS). New
+    rows are inserted, changed rows updated and rows no longer in the file deleted,
+    all in a single transaction. Returns the number of rows in the file.
+    The file and the table are compared one range of (first key column) keys at
+    a time - the file's rows are first split into the ranges, in temporary files
+    - so only one range of rows is ever held in memory.
+    """
+    table = file_load.table
+    key_columns = CONST_INCREMENTAL_GTFS_KEYS[file_load.filename]
+    columns = _infile_column_names(file_load.filename)
+    key_indexes = [columns.index(column) for column in key_columns]
+    # GTFS times are stored as seconds after midnight
+    time_indexes = [columns.index(column) for column in CONST_GTFS_TIME_COLUMNS \
+                                          if column in columns]
+    id_columns = _gtfs_id_columns(file_load.filename)
+    columns = [ \
+        CONST_GTFS_KEY_COLUMNS[column][0] if column in CONST_GTFS_KEY_COLUMNS else column \
+        for column in columns]
+    column_types = [table.c[column].type for column in columns]
+    chunk_column = table.c[columns[key_indexes[0]]]
+
+    session = session_maker()
+    try:
+        file_load.gtfs_keys = _load_gtfs_keys(session, file_load.filename)
+        # GTFS ids are stored (and so compared) as their keys
+        id_keys = [ \
+            (_infile_column_names(file_load.filename).index(id_column), id_column, \
+             file_load.gtfs_keys[id_column]) \
+            for id_column in id_columns]
+        # The keys are dense (1, 2, ...) - split them into equal ranges.
+        max_key = max(file_load.gtfs_keys[key_columns[0]].values(), default=0)
+        keys_per_chunk = max_key // CONST_INCREMENTAL_CHUNKS + 1
+        num_chunks = max_key // keys_per_chunk + 1
+
+        inserts_total = updates_total = deletes_total = 0
+        insert_start_time = time.perf_counter()
+        with tempfile.TemporaryDirectory(dir=import_dir) as chunk_dir:
+            num_rows, chunk_files = _split_gtfs_rows_into_chunks( \
+                import_dir, file_load.filename, chunk_dir, num_chunks, keys_per_chunk, \
+                key_indexes[0], time_indexes, id_keys)
+            print('        ' + str(num_rows) + ' rows in ' + file_load.filename \
+                + ', compared with ' + table.name + ' in ' + str(len(chunk_files)) + ' key ranges')
+            print('          -> ', end='')
+
+            for chunk, chunk_file in enumerate(chunk_files):
+                # The table's rows in this range (the first range also takes any
+                # without a key, the last any beyond the keys we know of)
+                bounds = []
+                if chunk > 0:
+                    bounds.append(chunk_column >= chunk * keys_per_chunk)
+                if chunk < num_chunks - 1:
+                    bounds.append(chunk_column < (chunk + 1) * keys_per_chunk)
+                in_chunk = db.and_(*bounds) if len(bounds) > 0 else db.true()
+                if chunk == 0:
+                    in_chunk = db.or_(chunk_column.is_(None), in_chunk)
+
+                inserts, updates, deletes = _diff_gtfs_rows_chunk( \
+                    session, table, columns, column_types, key_indexes, in_chunk, \
+                    _read_gtfs_rows_chunk(chunk_file))
+                _apply_gtfs_rows_diff( \
+                    session, table, file_load.batch_sizer.size, inserts, updates, deletes)
+                inserts_total += len(inserts)
+                updates_total += len(updates)
+                deletes_total += len(deletes)
+
+        print('')
+        print('        ' + str(inserts_total) + ' inserts, ' + str(updates_total) + ' updates, ' \
+            + str(deletes_total) + ' deletes (' \
+            + str(num_rows - inserts_total - updates_total) + ' rows unchanged)')
+
+        # One commit - the API never sees a half applied diff.
+        commit_start_time = time.perf_counter()
+        session.commit()
+        file_load.stats['insert_s'] += commit_start_time - insert_start_time
+        file_load.stats['commit_latencies_s'].append(time.perf_counter() - commit_start_time)
+    finally:
+        session.close()
+
+    return num_rows
+
+
+def _split_gtfs_rows_into_chunks(import_dir, filename, chunk_dir, num_chunks, keys_per_chunk, \
+                                 chunk_index, time_indexes, id_keys):
+    """Split the rows of a GTFS Txt File into files, one per range of keys
+
+    The rows are normalised as they would be stored (times as seconds after
+    midnight, GTFS ids as keys). A row's range is its value at 'chunk_index' (a
+    key) // 'keys_per_chunk'. Returns the number of rows and the chunk files
+    (in key order). Raises a ValueError if a row refers to a GTFS id without a key.
+    """
+    chunk_files = [ \
+        os.path.join(chunk_dir, str(chunk)) for chunk in range(num_chunks)]
+    chunk_rows = [[] for _ in chunk_files]
+    num_rows = 0
+
+    def spill(chunk):
+        with open(chunk_files[chunk], 'ab') as chunk_file:
+            pickle.dump(chunk_rows[chunk], chunk_file, protocol=pickle.HIGHEST_PROTOCOL)
+        chunk_rows[chunk] = []
+
+    with _open_gtfs_csv(import_dir, filename) as gtfs_csv:
+        data = csv.reader(gtfs_csv, delimiter=",")
+        # Skip over the first line (header row)
+        next(data)
+
+        for line_number, row in enumerate(data, start=2):
+            num_rows += 1
+            for time_index in time_indexes:
+                row[time_index] = seconds_after_midnight(row[time_index])
+            for id_index, id_column, gtfs_keys in id_keys:
+                gtfs_key = gtfs_keys.get(row[id_index])
+                if gtfs_key is None:
+                    raise ValueError( \
+                        filename + ' line ' + str(line_number) + ': ' + id_column \
+                        + ' \'' + row[id_index] + '\' is not defined' \
+                        + ' (not in ' + ', '.join(sorted( \
+                            source for source, source_ids in CONST_GTFS_KEY_SOURCES.items() \
+                            if id_column in source_ids)) + ')')
+                row[id_index] = gtfs_key
+            chunk = row[chunk_index] // keys_per_chunk
+            chunk_rows[chunk].append(row)
+            if len(chunk_rows[chunk]) == CONST_INCREMENTAL_ROWS_PER_SPILL:
+                spill(chunk)
+
+    for chunk, rows in enumerate(chunk_rows):
+        if len(rows) > 0:
+            spill(chunk)
+    return num_rows, chunk_files
+
+
+def _read_gtfs_rows_chunk(chunk_file):
+    """Return the rows written to a chunk file by _split_gtfs_rows_into_chunks()
+    """
+    rows = []
+    if os.path.exists(chunk_file):
+        with open(chunk_file, 'rb') as chunk_rows:
+            while True:
+                try:
+                    rows.extend(pickle.load(chunk_rows))
+                except EOFError:
+                    break
+    return rows
+
+
+def _diff_gtfs_rows_chunk(session, table, columns, column_types, key_indexes, in_chunk, rows):
+    """Compare a range of the file's rows with the same range of the table
+
+    'in_chunk' is the condition selecting the range from the table. Returns
+    the (inserts, updates, deletes) - records to insert, records to update
+    (with their row's '_id') and the ids of the rows to delete.
+    """
+    # The current table content: key -> (id, normalised row values)
+    current_rows = {}
+    surplus_ids = []  # (rows duplicating a key - they are replaced)
+    for row in session.execute( \
+            db.select(table.c.id, *[table.c[column] for column in columns]) \
+            .where(in_chunk)):
+        values = tuple( \
+            _diff_value(column_type, value) \
+            for column_type, value in zip(column_types, row[1:]))
+        key = tuple(values[key_index] for key_index in key_indexes)
+        if key in current_rows:
+            surplus_ids.append(current_rows[key][0])
+        current_rows[key] = (row[0], values)
+
+    inserts = []
+    updates = []
+    for row in rows:
+        values = tuple( \
+            _diff_value(column_type, value) \
+            for column_type, value in zip(column_types, row))
+        key = tuple(values[key_index] for key_index in key_indexes)
+        record = dict(zip(columns, row))
+
+        current_row = current_rows.pop(key, None)
+        if current_row is None:
+            inserts.append(record)
+        elif current_row[1] != values:
+            record['_id'] = current_row[0]
+            updates.append(record)
+
+    # Whatever is left over is no longer in the file...
+    deletes = surplus_ids + [current_row[0] for current_row in current_rows.values()]
+    return inserts, updates, deletes
+
+
+def _apply_gtfs_rows_diff(session, table, batch_size, inserts, updates, deletes):
+    """Write a diff (see _diff_gtfs_rows_chunk()) to the table - uncommitted
+    """
+    for batch_start in range(0, len(deletes), batch_size):
+        session.execute( \
+            table.delete().where( \
+                table.c.id.in_(deletes[batch_start:batch_start + batch_size])))
+        print('#', end='')
+
+    # (the SET clause is built from the columns in the update records)
+    update_statement = table.update().where(table.c.id == db.bindparam('_id'))
+    for batch_start in range(0, len(updates), batch_size):
+        session.execute( \
+            update_statement, updates[batch_start:batch_start + batch_size])
+        print('#', end='')
+
+    for batch_start in range(0, len(inserts), batch_size):
+        session.execute( \
+            table.insert(), inserts[batch_start:batch_start + batch_size])
+        print('#', end='')
+
+
+def _infile_column_names(filename):
+    """Return the names of the columns in a GTFS file (from CONST_INFILE_COLUMNS)
+    """
+    columns, _ = CONST_INFILE_COLUMNS[filename]
+    # (user variables, e.g. '@arrival_time', are the file's value for that column)
+    return [column.strip().lstrip('@') for column in columns.strip('()').split(',')]
+
+
+def _gtfs_id_columns(filename):
+    """Return the GTFS id columns in a GTFS file (the ids stored as keys)
+    """
+    return [column for column in _infile_column_names(filename) if column in CONST_GTFS_KEY_COLUMNS]
+
+
+def _read_gtfs_keys(session, id_column):
+    """Return the keys assigned to the GTFS ids of one type, as a dict (GTFS id -> key)
+    """
+    key_column, lookup_model = CONST_GTFS_KEY_COLUMNS[id_column]
+    lookup_table = lookup_model.__table__
+    return dict(session.execute( \
+        db.select(lookup_table.c[id_column], lookup_table.c[key_column])).all())
+
+
+def _load_gtfs_keys(session, filename):
+    """Return the keys for the GTFS ids in a file: GTFS id column -> {GTFS id: key}
+    """
+    return { \
+        id_column: _read_gtfs_keys(session, id_column) \
+        for id_column in _gtfs_id_columns(filename)}
+
+
+def _register_gtfs_keys(import_dir, session_maker, filenames):
+    """Assign keys to any new GTFS ids in the files about to be loaded
+
+    Only the files defining the ids are read (see CONST_GTFS_KEY_SOURCES). An id
+    keeps its key for good - new ids are numbered on from the highest key
+    assigned so far. Returns the number of keys assigned.
+    """
+    gtfs_ids = {id_column: set() for id_column in CONST_GTFS_KEY_COLUMNS}
+    for filename in filenames:
+        if filename not in CONST_GTFS_KEY_SOURCES:
+            continue
+        columns = _infile_column_names(filename)
+        id_indexes = [ \
+            (id_column, columns.index(id_column)) for id_column in CONST_GTFS_KEY_SOURCES[filename]]
+        with _open_gtfs_csv(import_dir, filename) as gtfs_csv:
+            data = csv.reader(gtfs_csv, delimiter=",")
+            # Skip over the first line (header row)
+            next(data)
+            for row in data:
+                for id_column, id_index in id_indexes:
+                    gtfs_ids[id_column].add(row[id_index])
+
+    num_keys = 0
+    session = session_maker()
+    try:
+        for _, lookup_model in CONST_GTFS_KEY_COLUMNS.values():
+            lookup_model.__table__.create(session.connection(), checkfirst=True)
+
+        for id_column, ids in gtfs_ids.items():
+            gtfs_keys = _read_gtfs_keys(session, id_column)
+            new_ids = sorted(ids.difference(gtfs_keys))
+            if len(new_ids) == 0:
+                continue
+            key_column, lookup_model = CONST_GTFS_KEY_COLUMNS[id_column]
+            next_key = max(gtfs_keys.values(), default=0) + 1
+            records = [ \
+                {key_column: key, id_column: gtfs_id} \
+                for key, gtfs_id in enumerate(new_ids, start=next_key)]
+            for batch_start in range(0, len(records), CONST_BATCH_SIZE_INITIAL):
+                session.execute(lookup_model.__table__.insert(), \
+                    records[batch_start:batch_start + CONST_BATCH_SIZE_INITIAL])
+            print('        ' + str(len(new_ids)) + ' new ' + id_column + 's (keys ' \
+                + str(next_key) + ' to ' + str(next_key + len(new_ids) - 1) + ')')
+            num_keys += len(new_ids)
+        session.commit()
+    finally:
+        session.close()
+
+    return num_keys
+
+
+def _diff_value(column_type, value):
+    """Normalise a value, read from either the db or a GTFS file, for comparison
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(column_type, db.Integer):
+        return int(value)
+    if isinstance(column_type, db.Float):
+        # FLOAT columns only keep ~6 significant digits
+        return '%.6g' % float(value)
+    return str(value)
+
+
+def _print_rows_per_sec(num_rows, elapsed_s, insert_mode):
+    """Print the load throughput for a file, so the insert modes can be compared
+    """
+    rows_per_sec = num_rows / elapsed_s if elapsed_s > 0 else 0
+    print('\n        Loaded ' + str(num_rows) + ' rows in ' + f'{elapsed_s:.2f}' + 's' \
+        + ' (' + f'{rows_per_sec:,.0f}' + ' rows/sec, insert mode \"' + insert_mode + '\").')
+
+
+def import_agency(data, session, objects_this_session, file_load):
+    """Import content from data into the Agency table
+
+    """
     print('          -> ', end='')
     for row in data:
-        agency = Agency(agency_id=row[0],
+        agency = _new_record(file_load,
+                        agency_id=row[0],
                         agency_name=row[1],
                         agency_url=row[2],
                         agency_timezone=row[3],
@@ -225,15 +1456,13 @@ def import_agency(data, session, objects_this_session):
         objects_this_session.append(agency)
 
 
-def import_calendar(data, session, objects_this_session):
+def import_calendar(data, session, objects_this_session, file_load):
     """Import content from data into the Calendar table
 
     """
-    truncate_table(session, Calendar)
-
     print('          -> ', end='')
     for row in data:
-        calendar = Calendar(
+        calendar = _new_record(file_load,
                                 service_id=row[0],
                                 monday=row[1],
                                 tuesday=row[2],
@@ -248,15 +1477,13 @@ def import_calendar(data, session, objects_this_session):
         objects_this_session.append(calendar)
 
 
-def import_calendar_dates(data, session, objects_this_session):
+def import_calendar_dates(data, session, objects_this_session, file_load):
     """Import content from data into the CalendarDates table
 
     """
-    truncate_table(session, CalendarDates)
-
     print('          -> ', end='')
     for row in data:
-        calendar_date = CalendarDates(
+        calendar_date = _new_record(file_load,
                                 service_id=row[0],
                                 date=row[1],
                                 exception_type=row[2]
@@ -264,16 +1491,16 @@ def import_calendar_dates(data, session, objects_this_session):
         objects_this_session.append(calendar_date)
 
 
-def import_routes(data, session, objects_this_session):
+def import_routes(data, session, objects_this_session, file_load):
     """Import content from data into the Routes table
 
     """
-    truncate_table(session, Routes)
-
     print('          -> ', end='')
+    route_keys = file_load.gtfs_keys['route_id']
     for row in data:
-        route = Routes(
+        route = _new_record(file_load,
                                 route_id=row[0],
+                                route_key=route_keys[row[0]],
                                 agency_id=row[1],
                                 route_short_name=row[2],
                                 route_long_name=row[3],
@@ -282,17 +1509,16 @@ def import_routes(data, session, objects_this_session):
         objects_this_session.append(route)
 
 
-def import_shapes(data, session, session_maker, objects_this_session):
+def import_shapes(data, session, session_maker, objects_this_session, \
+        file_load):
     """Import content from data into the Shapes table
 
     """
-    truncate_table(session, Shapes)
-
-    print('        Processing records in batches of', CONST_OBJ_PER_SESS_MAX)
-    print('          -> ', end='')
+    file_load.batch_sizer.print_batch_size()
+    shape_keys = file_load.gtfs_keys['shape_id']
     for row in data:
-        shape = Shapes(
-                                shape_id=row[0],
+        shape = _new_record(file_load,
+                                shape_key=shape_keys[row[0]],
                                 shape_pt_lat=row[1],
                                 shape_pt_lon=row[2],
                                 shape_pt_sequence=row[3],
@@ -300,23 +1526,34 @@ def import_shapes(data, session, session_maker, objects_this_session):
                             )
         objects_this_session.append(shape)
 
-        if len(objects_this_session) >= CONST_OBJ_PER_SESS_MAX:
+        if len(objects_this_session) >= file_load.batch_sizer.size:
             session = commit_batch_and_start_new_session( \
-                                    objects_this_session, session, session_maker \
+                                    objects_this_session, session, session_maker, file_load \
                                     )
             objects_this_session = []  # Resume with an empty list...
     return session,objects_this_session
 
 
-def import_stops(data, session, objects_this_session):
+def import_stops(data, session, objects_this_session, file_load):
     """Import content from data into the Stop table
 
+    The distance from the city center is calculated for every stop in one
+    (vectorised) pass.
     """
-    truncate_table(session, Stop)
-
     print('          -> ', end='')
-    for row in data:
-        stop = Stop(stop_id=row[0],
+    rows = list(data)  # (stops.txt is small - ~5,000 stops)
+    # Calculate distance to city center using haversine (in km) ...
+    dists_from_cc = haversine_km( \
+        CONST_DUBLIN_CC[0], CONST_DUBLIN_CC[1], \
+        np.array([row[2] for row in rows], dtype=float), \
+        np.array([row[3] for row in rows], dtype=float) \
+        ).tolist()  # (the db driver wants python floats, not numpy floats)
+
+    stop_keys = file_load.gtfs_keys['stop_id']
+    for row, dist_from_cc in zip(rows, dists_from_cc):
+        stop = _new_record(file_load,
+                    stop_id=row[0],
+                    stop_key=stop_keys[row[0]],
                     stop_name=row[1],
                     stop_lat=row[2],
                     stop_lon=row[3],
@@ -328,29 +1565,26 @@ def import_stops(data, session, objects_this_session):
                     # the built in functions to display it. E.g:
                     #   SELECT stop_lat,stop_lon, ST_ASTEXT(stop_position)
                     #   FROM stops
-                    # Calculate distance to city center using haversine (in km) ...
-                    dist_from_cc = haversine(
-                        CONST_DUBLIN_CC,
-                        (float(row[2]), float(row[3]))
-                        )
+                    dist_from_cc = dist_from_cc
                     )
         objects_this_session.append(stop)
 
 
-def import_stop_times(data, session, session_maker, objects_this_session):
+def import_stop_times(data, session, session_maker, objects_this_session, \
+        file_load):
     """Import content from data into the StopTimes table
 
-    Processed in batches of "CONST_OBJ_PER_SESS_MAX" records.
+    Processed in batches (sized by the file load's BatchSizer).
     """
-    truncate_table(session, StopTime)
-
-    print('        Processing records in batches of', CONST_OBJ_PER_SESS_MAX)
-    print('          -> ', end='')
+    file_load.batch_sizer.print_batch_size()
+    trip_keys = file_load.gtfs_keys['trip_id']
+    stop_keys = file_load.gtfs_keys['stop_id']
     for row in data:
-        stop_time = StopTime(trip_id=row[0],
-                            arrival_time=row[1],
-                            departure_time=row[2],
-                            stop_id=row[3],
+        stop_time = _new_record(file_load,
+                            trip_key=trip_keys[row[0]],
+                            arrival_time=seconds_after_midnight(row[1]),
+                            departure_time=seconds_after_midnight(row[2]),
+                            stop_key=stop_keys[row[3]],
                             stop_sequence=row[4],
                             stop_headsign=row[5],
                             pickup_type=row[6],
@@ -359,24 +1593,23 @@ def import_stop_times(data, session, session_maker, objects_this_session):
                             )
         objects_this_session.append(stop_time)
 
-        if len(objects_this_session) >= CONST_OBJ_PER_SESS_MAX:
+        if len(objects_this_session) >= file_load.batch_sizer.size:
             session = commit_batch_and_start_new_session( \
-                                    objects_this_session, session, session_maker \
+                                    objects_this_session, session, session_maker, file_load \
                                     )
             objects_this_session = []  # Resume with an empty list...
 
     return session,objects_this_session
 
 
-def import_transfers(data, session, objects_this_session):
+def import_transfers(data, session, objects_this_session, file_load):
     """Import content from data into the Transfers table
 
     """
-    truncate_table(session, Transfers)
-
     print('          -> ', end='')
     for row in data:
-        transfer = Transfers(from_stop_id=row[0],
+        transfer = _new_record(file_load,
+                            from_stop_id=row[0],
                             to_stop_id=row[1],
                             transfer_type=row[2],
                             min_transfer_time=row[3] if row[3] != '' else None
@@ -384,28 +1617,30 @@ def import_transfers(data, session, objects_this_session):
         objects_this_session.append(transfer)
 
 
-def import_trips(data, session, session_maker, objects_this_session):
+def import_trips(data, session, session_maker, objects_this_session, \
+        file_load):
     """Import content from data into the Trips table
 
-    Processed in batches of "CONST_OBJ_PER_SESS_MAX" records.
+    Processed in batches (sized by the file load's BatchSizer).
     """
-    truncate_table(session, Trips)
-
-    print('        Processing records in batches of', CONST_OBJ_PER_SESS_MAX)
-    print('          -> ', end='')
+    file_load.batch_sizer.print_batch_size()
+    route_keys = file_load.gtfs_keys['route_id']
+    trip_keys = file_load.gtfs_keys['trip_id']
+    shape_keys = file_load.gtfs_keys['shape_id']
     for row in data:
-        trip = Trips(route_id=row[0],
+        trip = _new_record(file_load,
+                    route_key=route_keys[row[0]],
                     service_id=row[1],
-                    trip_id=row[2],
-                    shape_id=row[3],
+                    trip_key=trip_keys[row[2]],
+                    shape_key=shape_keys[row[3]],
                     trip_headsign=row[4],
                     direction_id=row[5]
                     )
         objects_this_session.append(trip)
 
-        if len(objects_this_session) >= CONST_OBJ_PER_SESS_MAX:
+        if len(objects_this_session) >= file_load.batch_sizer.size:
             session = commit_batch_and_start_new_session( \
-                                    objects_this_session, session, session_maker \
+                                    objects_this_session, session, session_maker, file_load \
                                     )
             objects_this_session = []  # Resume with an empty list...
 
@@ -415,7 +1650,53 @@ def import_trips(data, session, session_maker, objects_this_session):
 #-------------------------------------------------------------------------------
 
 
-def commit_batch_and_start_new_session(list_of_objects, session, session_maker):
+def _new_record(file_load, **values):
+    """Return a new record for the file being loaded, in the form required by the insert mode
+
+    'orm' mode needs a model object, 'core' mode just needs the column values.
+    """
+    if file_load.insert_mode == CONST_INSERT_MODE_ORM:
+        return file_load.model(**values)
+    return values
+
+
+def _save_batch(session, file_load, list_of_records):
+    """Save a batch of records (built by _new_record()) and commit
+
+    If the db times out waiting for a lock, the batch is split in two and each
+    half saved in turn (and smaller batches are used from then on).
+    """
+    save_start_time = time.perf_counter()
+    try:
+        if file_load.insert_mode == CONST_INSERT_MODE_ORM:
+            session.bulk_save_objects(list_of_records)
+        else:
+            # A single Core insert, executed once with the list of dictionaries, is
+            # run by the db driver as an 'executemany' - no ORM bookkeeping at all.
+            session.execute(file_load.table.insert(), list_of_records)
+        commit_start_time = time.perf_counter()
+        session.commit()
+    except OperationalError as operational_error:
+        if getattr(operational_error.orig, 'errno', None) != CONST_MYSQL_LOCK_WAIT_TIMEOUT \
+                or len(list_of_records) < 2:
+            raise
+        session.rollback()
+        file_load.batch_sizer.lock_wait_timeout()
+        half = len(list_of_records) // 2
+        _save_batch(session, file_load, list_of_records[:half])
+        _save_batch(session, file_load, list_of_records[half:])
+        return
+
+    save_end_time = time.perf_counter()
+    file_load.stats['insert_s'] += commit_start_time - save_start_time
+    file_load.stats['commit_latencies_s'].append(save_end_time - commit_start_time)
+    file_load.batch_sizer.batch_committed(len(list_of_records), save_end_time - save_start_time)
+
+    if file_load.checkpoint is not None:
+        file_load.checkpoint.batch_committed(len(list_of_records))
+
+
+def commit_batch_and_start_new_session(list_of_objects, session, session_maker, file_load):
     """Commit the session once the object session limit is reached.
 
     Also prints a '# to the console as a type of 'chunk progress indicator' for the logs...
@@ -423,13 +1704,334 @@ def commit_batch_and_start_new_session(list_of_objects, session, session_maker):
     # Once our session is holding a fair chunk of data we commit and begin a new session...
     # We print a '#' to the console as a type of 'chunk progress indicator' for the logs...
     print('#', end='')
-    session.bulk_save_objects(list_of_objects)
-    session.commit()
+    _save_batch(session, file_load, list_of_objects)
     session = session_maker()
 
     return session
 
 
+class BatchSizer:
+    """Chooses the number of rows written (and committed) per batch of a file load
+
+    With a fixed size every batch is that size. Otherwise the size adapts to the
+    commit throughput (rows/sec): it grows while throughput keeps improving, then
+    settles at the best size seen. It is halved (and stays settled) if the loader
+    runs short of memory, or if the db times out waiting for a lock.
+    """
+
+    def __init__(self, fixed_size=None):
+        # Instance Variables
+        self.fixed = fixed_size is not None
+        self.size = fixed_size if self.fixed else CONST_BATCH_SIZE_INITIAL
+        self.sizes_used = [self.size]
+        self.settled = self.fixed
+        self.best_size = self.size
+        self.best_rows_per_sec = 0
+
+    def print_batch_size(self):
+        """Log the (initial) batch size
+        """
+        print('        Processing records in batches of', self.size, \
+            '(fixed)' if self.fixed else '(adaptive)')
+        print('          -> ', end='')
+
+    def print_sizes_used(self):
+        """Log the batch sizes chosen during the load (if the size changed)
+        """
+        if len(self.sizes_used) > 1:
+            print('        Batch sizes used: ' + ' -> '.join(str(size) for size in self.sizes_used))
+
+    def batch_committed(self, num_rows, elapsed_s):
+        """Adapt the batch size, given a batch of 'num_rows' rows took 'elapsed_s' to commit
+        """
+        rss_mb = _current_rss_mb()
+        if not self.fixed and rss_mb is not None and rss_mb > CONST_BATCH_RSS_LIMIT_MB:
+            self.settled = True
+            self._resize(self.size // 2, 'memory ' + f'{rss_mb:.0f}' + 'MB')
+            return
+
+        if self.settled or num_rows < self.size or elapsed_s <= 0:
+            # (the last, part filled, batch of a file tells us nothing)
+            return
+
+        rows_per_sec = num_rows / elapsed_s
+        if rows_per_sec > self.best_rows_per_sec * (1 + CONST_BATCH_SIZE_GAIN) \
+                and self.size < CONST_BATCH_SIZE_MAX:
+            self.best_rows_per_sec = rows_per_sec
+            self.best_size = self.size
+            self._resize(int(self.size * CONST_BATCH_SIZE_GROWTH), \
+                f'{rows_per_sec:,.0f}' + ' rows/sec')
+        else:
+            # No better than the best size so far - go back to it and stay there
+            self.settled = True
+            self._resize(self.best_size, 'settled')
+
+    def lock_wait_timeout(self):
+        """The db timed out waiting for a lock - use smaller batches from now on
+        """
+        if not self.fixed:
+            self.settled = True
+            self._resize(self.size // 2, 'lock wait timeout')
+
+    def _resize(self, size, reason):
+        size = max(CONST_BATCH_SIZE_MIN, min(CONST_BATCH_SIZE_MAX, size))
+        if size != self.size:
+            self.size = size
+            self.sizes_used.append(size)
+            # (inline with the '#' batch progress indicator)
+            print('[' + str(size) + ', ' + reason + ']', end='')
+
+
+def _current_rss_mb():
+    """Return the resident memory of this process in MB (None if not known)
+
+    Read from /proc (i.e. Linux only - our EC2 instances).
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def _prepare_target_table(session, file_load):
+    """Get the table the file is loaded into ready for a fresh load
+
+    Staging tables are created empty, live tables (loads 'in place') are truncated.
+    """
+    if file_load.staging:
+        _create_staging_table(session, file_load.model)
+    else:
+        _truncate_table(session, file_load.model)
+
+    if file_load.defer_indexes:
+        _drop_deferred_indexes(session, file_load)
+
+    if file_load.checkpoint is not None:
+        file_load.checkpoint.restart()
+
+
+def _db_indexes(session, table):
+    """Return the (secondary) indexes the table has in the db
+
+    As a dict of index name -> (unique, [column names]).
+    """
+    return { \
+        index['name']: (bool(index['unique']), index['column_names']) \
+        for index in db.inspect(session.connection()).get_indexes(table.name)}
+
+
+def _drop_deferred_indexes(session, file_load):
+    """Drop the table's secondary indexes so the load doesn't maintain them
+
+    The definitions are kept (in the file load) so exactly the same indexes are
+    rebuilt - the indexes in the db can differ from models.py (e.g. 'idx_trip'
+    is UNIQUE in the db).
+    """
+    db_indexes = _db_indexes(session, file_load.table)
+    # (resuming, the indexes a failed load already dropped are in the checkpoint)
+    file_load.deferred_indexes = dict(file_load.deferred_indexes, **db_indexes)
+    if file_load.checkpoint is not None:
+        # Saved before they are dropped - a resumed load must rebuild them.
+        file_load.checkpoint.deferred_indexes = file_load.deferred_indexes
+        file_load.checkpoint.save()
+    for index_name in sorted(db_indexes):
+        session.execute(db.text('DROP INDEX ' + index_name + ' ON ' + file_load.table.name))
+        print('        Dropped index ' + index_name + ' (rebuilt after the load).')
+
+
+def _build_deferred_indexes(session_maker, file_load):
+    """Build the table's indexes once the load is complete
+
+    Builds the indexes dropped by _drop_deferred_indexes() - resuming a load, the
+    ones saved in its checkpoint (or, for a checkpoint saved without them, the
+    indexes declared in models.py). Each index is built
+    with a single sort of the loaded rows, far cheaper than maintaining it as
+    every row is inserted. Prints the time taken for each.
+    """
+    indexes = file_load.deferred_indexes
+    if len(indexes) == 0:
+        indexes = { \
+            index.name: (index.unique, [column.name for column in index.columns]) \
+            for index in file_load.table.indexes}
+
+    session = session_maker()
+    try:
+        existing_indexes = _db_indexes(session, file_load.table)
+        for index_name, (unique, column_names) in sorted(indexes.items()):
+            if index_name in existing_indexes:
+                continue
+            index_start_time = time.perf_counter()
+            session.execute(db.text( \
+                'CREATE ' + ('UNIQUE ' if unique else '') + 'INDEX ' + index_name \
+                + ' ON ' + file_load.table.name + ' (' + ', '.join(column_names) + ')'))
+            index_build_s = time.perf_counter() - index_start_time
+            file_load.stats['index_build_s'][index_name] = index_build_s
+            print('        Built index ' + index_name + ' on ' + file_load.table.name \
+                + ' in ' + f'{index_build_s:.2f}' + 's.')
+        session.commit()
+    finally:
+        session.close()
+
+
+def _build_derived_tables(session_maker, file_load):
+    """Build the tables derived from a freshly loaded GTFS file (CONST_DERIVED_GTFS_MODELS)
+
+    They are built alongside the file's table - into staging tables when the
+    file was staged, otherwise replacing the live content in one transaction.
+    """
+    if file_load.filename not in CONST_DERIVED_GTFS_MODELS:
+        return
+
+    derived_start_time = time.perf_counter()
+    models = CONST_DERIVED_GTFS_MODELS[file_load.filename]
+    session = session_maker()
+    try:
+        tables = []
+        for model in models:
+            # (the staging copy is created 'LIKE' the live table)
+            model.__table__.create(session.connection(), checkfirst=True)
+            if file_load.staging:
+                _create_staging_table(session, model)
+                tables.append(_staging_table(model))
+            else:
+                session.execute(model.__table__.delete())
+                tables.append(model.__table__)
+
+        if file_load.filename == 'routes.txt':
+            _build_route_names(session, file_load.table, *tables)
+        elif file_load.filename == 'stop_times.txt':
+            _build_trip_patterns(session, file_load.table, *tables)
+        session.commit()
+    finally:
+        session.close()
+    file_load.stats['derived_tables_s'] += time.perf_counter() - derived_start_time
+
+
+def _build_route_names(session, routes_table, route_names_table):
+    """Derive the normalized route names (see jt_utils.RouteIndex) from routes
+    """
+    print('        Building route names from ' + routes_table.name + '.')
+    columns = routes_table.c
+    rows = session.execute(db.select( \
+        columns.route_key, columns.route_short_name, columns.route_long_name))
+    route_name_records = [ \
+        {'route_key': route_key, 'short_name': route_short_name_key(route_short_name), \
+         'long_name_tokens': ' '.join(sorted(route_name_tokens(route_long_name)))} \
+        for route_key, route_short_name, route_long_name in rows]
+    for batch_start in range(0, len(route_name_records), CONST_BATCH_SIZE_INITIAL):
+        session.execute(route_names_table.insert(), \
+            route_name_records[batch_start:batch_start + CONST_BATCH_SIZE_INITIAL])
+
+    print('          -> ' + str(len(route_name_records)) + ' route names.')
+
+
+def _build_trip_patterns(session, stop_times_table, trip_patterns_table, pattern_trips_table):
+    """Derive the trip patterns, and the pattern each trip follows, from stop_times
+
+    The stop_times are read a range of (dense) trip keys at a time, in the order
+    of the 'idx_stop_time' index.
+    """
+    print('        Building trip patterns from ' + stop_times_table.name + '.')
+    columns = stop_times_table.c
+    max_trip_key = session.execute( \
+        db.select(db.func.max(columns.trip_key))).scalar() or 0
+
+    patterns = {}  # (the stops of a pattern) -> pattern key
+    pattern_trips = []
+    for first_trip_key in range(1, max_trip_key + 1, CONST_TRIP_PATTERN_TRIPS_PER_QUERY):
+        rows = session.execute( \
+            db.select(columns.trip_key, columns.stop_sequence, columns.stop_key, \
+                      columns.shape_dist_traveled) \
+            .where(columns.trip_key.between( \
+                first_trip_key, first_trip_key + CONST_TRIP_PATTERN_TRIPS_PER_QUERY - 1)) \
+            .order_by(columns.trip_key, columns.stop_sequence))
+        pattern_trips.extend(_trip_patterns(rows, patterns))
+
+    trip_pattern_records = [ \
+        {'pattern_key': pattern_key, 'stop_sequence': stop_sequence, 'stop_key': stop_key, \
+         'shape_dist_traveled': shape_dist_traveled} \
+        for pattern, pattern_key in patterns.items() \
+        for stop_sequence, stop_key, shape_dist_traveled in pattern]
+    pattern_trip_records = [ \
+        {'trip_key': trip_key, 'pattern_key': pattern_key} \
+        for trip_key, pattern_key in pattern_trips]
+    for table, records in ((trip_patterns_table, trip_pattern_records), \
+                           (pattern_trips_table, pattern_trip_records)):
+        for batch_start in range(0, len(records), CONST_BATCH_SIZE_INITIAL):
+            session.execute(table.insert(), \
+                records[batch_start:batch_start + CONST_BATCH_SIZE_INITIAL])
+
+    print('          -> ' + str(len(pattern_trips)) + ' trips follow ' \
+        + str(len(patterns)) + ' trip patterns (' + str(len(trip_pattern_records)) + ' rows).')
+
+
+def _trip_patterns(rows, patterns):
+    """Yield (trip key, pattern key) for stop_times rows in (trip_key, stop_sequence) order
+
+    Rows are (trip_key, stop_sequence, stop_key, shape_dist_traveled). A trip's
+    pattern is its sequence of (stop_sequence, stop_key, shape_dist_traveled) -
+    new patterns are added to 'patterns' (pattern -> pattern key).
+    """
+    for trip_key, trip_rows in groupby(rows, key=itemgetter(0)):
+        pattern = tuple(tuple(row[1:]) for row in trip_rows)
+        pattern_key = patterns.setdefault(pattern, len(patterns) + 1)
+        yield trip_key, pattern_key
+
+
+def _staging_table(model):
+    """Return a Table for the staging copy of the model's table (e.g. 'stop_times__next')
+    """
+    return model.__table__.to_metadata(
+        db.MetaData(), name=model.__table__.name + CONST_STAGING_SUFFIX
+        )
+
+
+def _create_staging_table(session, model):
+    """(Re)Create an empty staging copy of the model's table
+
+    'CREATE TABLE ... LIKE' copies the column definitions AND the indexes of the
+    live table, so the indexes are built on the staging table as rows are loaded
+    (unless they are deferred - see _drop_deferred_indexes()).
+    """
+    table_name = model.__table__.name
+    print('        Creating Staging Table ' + table_name + CONST_STAGING_SUFFIX + '.')
+    # A leftover staging table means an earlier load failed part way through.
+    session.execute(db.text( \
+        'DROP TABLE IF EXISTS ' + table_name + CONST_STAGING_SUFFIX))
+    session.execute(db.text( \
+        'CREATE TABLE ' + table_name + CONST_STAGING_SUFFIX + ' LIKE ' + table_name))
+
+
+def _swap_staging_tables(session_maker, models):
+    """Swap the live tables for the freshly loaded staging tables
+
+    All the tables are swapped in a single 'RENAME TABLE' statement, which MySQL
+    runs atomically - API queries see either the old dataset or the new, never a
+    partially loaded table. The old tables are then dropped.
+    """
+    print('----------------------------------------')
+    print('Swapping Staging Tables. Time is: ' + datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    table_names = [model.__table__.name for model in models]
+
+    session = session_maker()
+    try:
+        session.execute(db.text('DROP TABLE IF EXISTS ' \
+            + ', '.join([name + CONST_OLD_SUFFIX for name in table_names])))
+        session.execute(db.text('RENAME TABLE ' \
+            + ', '.join([ \
+                name + ' TO ' + name + CONST_OLD_SUFFIX + ', ' \
+                + name + CONST_STAGING_SUFFIX + ' TO ' + name \
+                for name in table_names])))
+        print('        -> Swapped Tables ' + ', '.join(table_names) + '.')
+        session.execute(db.text('DROP TABLE ' \
+            + ', '.join([name + CONST_OLD_SUFFIX for name in table_names])))
+        print('        -> Old Tables Dropped.')
+    finally:
+        session.close()
+
+
 def _truncate_tables(session_maker):
     """Truncate (Delete All Rows From) the all GTFS Tables
     """
@@ -490,47 +2092,136 @@ def _truncate_table(session, model):
 #===============================================================================
 #===============================================================================
 
-def main():
-    """Load Data the National transport Authority GTFS Data for Dublin Bus
+def _parse_args(argv=None):
+    """Parse the jt_gtfs_loader command line options
 
+    Called with an empty list to get the default options.
+    """
+    parser = argparse.ArgumentParser(
+        prog='jt_dl',
+        description='Load the latest NTA GTFS Schedule Data into the Journeyti.me database.'
+        )
+    parser.add_argument(
+        '--insert-mode', action='append', default=[], metavar='[FILE=]MODE',
+        help='How rows are written to the db: ' + ', '.join(CONST_INSERT_MODES) \
+            + ' (default ' + CONST_INSERT_MODE_ORM + '). Either one mode for every file, ' \
+            + 'or FILE=MODE for a single file (e.g. stop_times.txt=infile). Repeatable.'
+        )
+    parser.add_argument(
+        '--in-place', action='store_true',
+        help='Truncate and reload the live tables rather than loading staging tables ' \
+            + 'and swapping them in (the API sees partially loaded tables during the load).'
+        )
+    parser.add_argument(
+        '--workers', type=int, default=1, metavar='N',
+        help='Number of worker processes loading the large files (' \
+            + ', '.join(CONST_PARALLEL_GTFS_FILES) + ') in parallel. ' \
+            + 'The default (1) loads every file one after another.'
+        )
+    parser.add_argument(
+        '--shards', type=int, default=1, metavar='N',
+        help='Split ' + ', '.join(CONST_SHARDED_GTFS_FILES) + ' into N shards, ' \
+            + 'loaded concurrently by N worker processes (default 1, no sharding). ' \
+            + 'Not used by the \'' + CONST_INSERT_MODE_INFILE + '\' insert mode.'
+        )
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Load ' + ', '.join(CONST_INCREMENTAL_GTFS_KEYS) + ' by applying only the ' \
+            + 'inserts, updates and deletes needed to bring the live tables up to date.'
+        )
+    parser.add_argument(
+        '--batch-size', type=int, default=None, metavar='N',
+        help='Write (and commit) the rows in batches of exactly N rows. By default the ' \
+            + 'batch size adapts to the commit throughput, starting at ' \
+            + str(CONST_BATCH_SIZE_INITIAL) + ' rows. Use a fixed size for benchmarking.'
+        )
+    parser.add_argument(
+        '--defer-indexes', action='store_true',
+        help='Drop the indexes on the tables for ' + ', '.join(CONST_DEFERRED_INDEX_GTFS_FILES) \
+            + ' before loading them and build the indexes once each load is complete.'
+        )
+    parser.add_argument(
+        '--extract', action='store_true',
+        help='Extract every file from the downloaded .zip before loading, rather than ' \
+            + 'reading the files straight from the .zip.'
+        )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume a failed load - files it loaded are not loaded again, and the ' \
+            + 'file it was loading continues from the last batch it committed.'
+        )
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Load every file, even those unchanged since the last successful load.'
+        )
+    options = parser.parse_args(argv)
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    if options.shards < 1:
+        parser.error('--shards must be at least 1')
+    if options.batch_size is not None and options.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+
+    # Resolve the '--insert-mode' arguments into a mode per file...
+    options.insert_modes = {}
+    for insert_mode_arg in options.insert_mode:
+        filename, _, insert_mode = insert_mode_arg.rpartition('=')
+        if insert_mode not in CONST_INSERT_MODES:
+            parser.error('invalid insert mode \'' + insert_mode + '\'')
+        if filename and filename not in GTFS_FILE_MODELS:
+            parser.error('unexpected GTFS file \'' + filename + '\'')
+        options.insert_modes[filename] = insert_mode  # '' is the default for all files
+
+    return options
+
+
+def _insert_mode_for_file(options, filename):
+    """Return the insert mode chosen for 'filename' (see _parse_args())
+    """
+    return options.insert_modes.get(
+        filename, options.insert_modes.get('', CONST_INSERT_MODE_ORM)
+        )
 
+
+def _is_incremental_load(options, filename):
+    """Return True if the file is to be loaded incrementally (as a row diff)
     """
+    return options.incremental and filename in CONST_INCREMENTAL_GTFS_KEYS
 
-    start_time = datetime.now()
 
-    print('JT_GTFS_Loader: Start of iteration (' + start_time.strftime('%Y-%m-%d %H:%M:%S') + ')')
+def _create_engine(options):
+    """Create the SQLAlchemy db engine for the loader
+    """
+    connection_string = "mysql+mysqlconnector://" \
+        + credentials['DB_USER'] + ":" + credentials['DB_PASS'] \
+        + "@" \
+        + credentials['DB_SRVR'] + ":" + credentials['DB_PORT']\
+        + "/" + credentials['DB_NAME'] + "?charset=utf8mb4"
+    #print('Connection String: ' + connectionString + '\n')
 
-    import_dir = os.path.join(jt_gtfs_module_dir, 'import')
+    # The client side of 'LOAD DATA LOCAL INFILE' is disabled by default in the
+    # MySQL connector - only switch it on if an 'infile' load was asked for.
+    connect_args = {}
+    if CONST_INSERT_MODE_INFILE in options.insert_modes.values():
+        connect_args['allow_local_infile'] = True
 
-    print('\tRegistering start with cronitor.')
-    # The DudeWMB Data Loader uses the 'Cronitor' web service (https://cronitor.io/)
-    # to monitor the running data loader process.  This way if there is a failure
-    # in the job etc. our team is notified by email.  In addition, if the job
-    # or the EC2 instance suspends for some reason, cronitor informs us of the
-    # lack of activity so we can log in and investigate.
-    # Send a request to log the start of a run
-    cronitor_uri = credentials['cronitor']['TelemetryURL']
-    requests.get(cronitor_uri + "?state=run")
+    return db.create_engine(connection_string, connect_args=connect_args)
 
-    # Download the GTFS Schedule Data File (it comes down as a ".zip")
-    gtfs_schedule_data_file = download_gtfs_schedule_data(import_dir)
 
-    # Extract the contents of the GTFS Schedule Data .zip to the import directory...
-    extract_gtfs_data_from_zip(gtfs_schedule_data_file, import_dir, cronitor_uri)
+def _load_gtfs_data(import_dir, options, cronitor_uri, fingerprints, unchanged_files, run_metrics):
+    """Load the (changed) GTFS Txt Files to the db, then notify the API server
 
+    The fingerprints of the files are saved once the load succeeds.
+    Returns True if the load succeeded.
+    """
+    load_succeeded = False
     # The following functions require a db commection...
     connection = None
     try:
         print("\tCreating SQLAlchemy db engine.")
         # We only want to initialise the engine and create a db connection once
         # as its expensive (i.e. time consuming)
-        connection_string = "mysql+mysqlconnector://" \
-            + credentials['DB_USER'] + ":" + credentials['DB_PASS'] \
-            + "@" \
-            + credentials['DB_SRVR'] + ":" + credentials['DB_PORT']\
-            + "/" + credentials['DB_NAME'] + "?charset=utf8mb4"
-        #print('Connection String: ' + connectionString + '\n')
-        engine = db.create_engine(connection_string)
+        engine = _create_engine(options)
 
         print('')
         # engine.begin() runs a transaction
@@ -538,9 +2229,14 @@ def main():
 
             session_maker = sessionmaker(bind=engine)
 
-            # With the CSV files (bizarrely, with a .txt extension) extracted to disk,
-            # we import the content to the db.
-            import_gtfs_txt_files_to_db(import_dir, session_maker)
+            # With the CSV files (bizarrely, with a .txt extension) in the .zip (or
+            # extracted to disk), we import the content to the db.
+            import_gtfs_txt_files_to_db( \
+                import_dir, session_maker, options, unchanged_files, run_metrics)
+
+        # Next time round, we compare the files we download against these...
+        _save_fingerprints(import_dir, fingerprints)
+        load_succeeded = True
     except (SQLAlchemyError, DBAPIError):
         # if there is any problem, print the traceback
         print("ERROR Database Error")
@@ -548,6 +2244,12 @@ def main():
         print('\tRegistering error with cronitor.')
         # Send a Cronitor request to signal our process has failed.
         requests.get(cronitor_uri + "?state=fail")
+    except ValueError as gtfs_data_error:
+        # The GTFS data is inconsistent (e.g. a row refers to an undefined id)
+        print("ERROR GTFS Data Error: " + str(gtfs_data_error))
+        print('\tRegistering error with cronitor.')
+        # Send a Cronitor request to signal our process has failed.
+        requests.get(cronitor_uri + "?state=fail")
     finally:
         # Make sure to close the connection - a memory leak on this would kill
         # us...
@@ -559,21 +2261,155 @@ def main():
     # now that we've loaded a fresh dataset.
     requests.get(credentials['GTFS_LOADER']['JTAPI_SRVR'] + '/update_valid_route_shortnames.do')
 
+    return load_succeeded
+
+
+def _peak_rss_mb():
+    """Return the peak resident memory (MB) of this process and its worker processes
+
+    (The peak of the largest worker, as 'getrusage' reports for the children.)
+    """
+    # ru_maxrss is in KB on Linux
+    return round(max( \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024, 1)
+
+
+def _save_run_report(import_dir, run_metrics):
+    """Save the metrics for this run as a json report (one file per run)
+    """
+    report_dir = os.path.join(import_dir, CONST_REPORT_DIR)
+    os.makedirs(report_dir, exist_ok=True)
+    report_file = os.path.join(report_dir, 'gtfs_load_' \
+        + datetime.fromisoformat(run_metrics['started_at']).strftime('%Y%m%d_%H%M%S') + '.json')
+    _save_json_file(report_file, run_metrics)
+    print('\tRun report saved to ' + report_file)
+
+
+def _record_run_history(options, run_metrics):
+    """Add a summary of this run (and the full report) to the 'gtfs_load_history' table
+
+    Best effort - a failure here is logged but doesn't fail the run.
+    """
+    engine = None
+    try:
+        engine = _create_engine(options)
+        GtfsLoadHistory.__table__.create(engine, checkfirst=True)
+        with engine.begin() as connection:
+            connection.execute(GtfsLoadHistory.__table__.insert(), { \
+                'started_at': datetime.fromisoformat(run_metrics['started_at']), \
+                'status': run_metrics['status'], \
+                'elapsed_s': run_metrics['elapsed_s'], \
+                'rows_loaded': sum( \
+                    file_metrics['rows'] or 0 \
+                    for file_metrics in run_metrics.get('files', {}).values()), \
+                'peak_rss_mb': run_metrics['peak_rss_mb'], \
+                'report': json.dumps(run_metrics, sort_keys=True)})
+    except (SQLAlchemyError, DBAPIError):
+        print('WARNING: Unable to record the run in gtfs_load_history')
+        print(traceback.format_exc())
+    finally:
+        if engine is not None:
+            engine.dispose()
+
+
+def main(argv=None):
+    """Load Data the National transport Authority GTFS Data for Dublin Bus
+
+
+    """
+    options = _parse_args(argv)
+
+    start_time = datetime.now()
+
+    print('JT_GTFS_Loader: Start of iteration (' + start_time.strftime('%Y-%m-%d %H:%M:%S') + ')')
+
+    import_dir = os.path.join(jt_gtfs_module_dir, 'import')
+
+    # The metrics for each stage of the run - saved as a json report, and to the
+    # run history table, at the end of the run.
+    run_metrics = { \
+        'started_at': start_time.isoformat(timespec='seconds'), \
+        'argv': sys.argv[1:] if argv is None else list(argv), \
+        'download': {}}
+
+    print('\tRegistering start with cronitor.')
+    # The DudeWMB Data Loader uses the 'Cronitor' web service (https://cronitor.io/)
+    # to monitor the running data loader process.  This way if there is a failure
+    # in the job etc. our team is notified by email.  In addition, if the job
+    # or the EC2 instance suspends for some reason, cronitor informs us of the
+    # lack of activity so we can log in and investigate.
+    # Send a request to log the start of a run
+    cronitor_uri = credentials['cronitor']['TelemetryURL']
+    requests.get(cronitor_uri + "?state=run")
+
+    # Download the GTFS Schedule Data File (it comes down as a ".zip")
+    gtfs_schedule_data_file = download_gtfs_schedule_data( \
+        import_dir, run_metrics['download'], cronitor_uri)
+
+    stage_start_time = time.perf_counter()
+    if options.extract:
+        # Extract the contents of the GTFS Schedule Data .zip to the import directory...
+        valid_zip = extract_gtfs_data_from_zip(gtfs_schedule_data_file, import_dir, cronitor_uri)
+    else:
+        # ... or (by default) read the files straight out of the .zip.
+        valid_zip = verify_gtfs_zip(gtfs_schedule_data_file, cronitor_uri)
+    run_metrics['extract_s'] = round(time.perf_counter() - stage_start_time, 3)
+
+    if not valid_zip:
+        # No valid .zip - don't load the (stale) files left in the import directory.
+        # (the failure is already registered with cronitor)
+        run_metrics['status'] = 'invalid_zip'
+        _finish_run(import_dir, options, run_metrics, start_time)
+        sys.exit(1)
+
+    # The NTA don't publish new schedule data every day. Fingerprint the GTFS
+    # files and compare them with the files from the last successful load - only
+    # the files that have changed need to be loaded.
+    stage_start_time = time.perf_counter()
+    fingerprints = _gtfs_txt_file_fingerprints(import_dir)
+    unchanged_files = []
+    if not options.force:
+        unchanged_files = _unchanged_gtfs_txt_files(fingerprints, _load_fingerprints(import_dir))
+    run_metrics['fingerprint_s'] = round(time.perf_counter() - stage_start_time, 3)
+    run_metrics['unchanged_files'] = unchanged_files
+
+    if len(fingerprints) > 0 and len(unchanged_files) == len(fingerprints):
+        print('\tGTFS Schedule Data is unchanged since the last load. Nothing to do!')
+        run_metrics['status'] = 'unchanged'
+    elif _load_gtfs_data( \
+            import_dir, options, cronitor_uri, fingerprints, unchanged_files, run_metrics):
+        run_metrics['status'] = 'complete'
+    else:
+        run_metrics['status'] = 'failed'
+
     print('\nRegistering completion with cronitor.')
     # Send a Cronitor request to signal our process has completed.
     requests.get(cronitor_uri + "?state=complete")
 
+    _finish_run(import_dir, options, run_metrics, start_time)
+    sys.exit()
+
+
+def _finish_run(import_dir, options, run_metrics, start_time):
+    """Record the run's metrics (report and history) and print the elapsed time
+    """
     # (following returns a timedelta object)
     elapsed_time = datetime.now() - start_time
 
+    run_metrics['elapsed_s'] = round(elapsed_time.total_seconds(), 3)
+    run_metrics['peak_rss_mb'] = _peak_rss_mb()
+    _save_run_report(import_dir, run_metrics)
+    _record_run_history(options, run_metrics)
+
     # returns (minutes, seconds)
     #minutes = divmod(elapsedTime.seconds, 60)
     minutes = divmod(elapsed_time.total_seconds(), 60)
-    print('Iteration Complete! (Elapsed time:', minutes[0], 'minutes', minutes[1], 'seconds)\n')
+    outcome = 'Aborted!' if run_metrics['status'] == 'invalid_zip' else 'Complete!'
+    print('Iteration', outcome, '(Elapsed time:', minutes[0], 'minutes', minutes[1], 'seconds)\n')
     print('--------------------------------------------------------------------------------')
     print('================================================================================')
     print('--------------------------------------------------------------------------------\n')
-    sys.exit()
 
 if __name__ == '__main__':
     main()
@@ -3,30 +3,38 @@
 """
 
 # Standard Library Imports
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from datetime import time as dt_time
+from itertools import groupby
 import json
 import logging
+from operator import itemgetter
 from pathlib import Path
 import pickle
 import os
+import re
 import sys
 import struct
+import threading
+import unicodedata
 import time
 import unittest
 import zlib
 
 # Related Third Party Imports
 from flask import Response
+import joblib
 import numpy as np
-import pandas as pd
 import requests as rq
-from sqlalchemy import asc, text, func
+from sqlalchemy import asc, desc, event, text, func, or_
 #from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound  # Exceptions
 
 
 # Local Application Imports
-from models import Routes, Stop, StopTime, Trips
+from models import PatternTrip, RouteName, Routes, Stop, StopTime, TripPattern, Trips
 
 # According to the article here:
 #   https://towardsdatascience.com
@@ -67,6 +75,123 @@ def load_credentials():
 credentials = load_credentials()
 CONST_DUBLIN_CC = (credentials['DUBLIN_CC']['lat'], credentials['DUBLIN_CC']['lon'])
 
+# Mean earth radius (km) - the same radius used by the 'haversine' module...
+CONST_EARTH_RADIUS_KM = 6371.0088
+# GTFS times are 'service day' times - trips running past midnight carry on
+# counting (e.g. '25:10:00'), so a day's stop times span more than 24 hours.
+CONST_SECONDS_PER_DAY = 86400
+# Stops are indexed (in memory) on a grid of cells this many degrees square - at
+# Dublin's latitude a cell is roughly 550m (north-south) by 330m (east-west).
+CONST_STOP_INDEX_CELL_DEG = 0.005
+# The in-memory timetable is read from stop_times this many trips (keys) at a time,
+# and searched (backwards from the requested time) this many stop times at a time.
+CONST_TIMETABLE_TRIPS_PER_QUERY = 5000
+CONST_TIMETABLE_SEARCH_CHUNK = 256
+# Memory budget for the end-to-end models kept in memory (override with
+# 'END_TO_END_MODEL_CACHE_MB' in journeytime.json)
+CONST_END_TO_END_MODEL_CACHE_MB = 512
+# The weather forecast is refreshed this often (seconds), or retried this often
+# after a failure, and requests for it time out after this many seconds...
+CONST_WEATHER_REFRESH_S = 1800
+CONST_WEATHER_RETRY_S = 60
+CONST_WEATHER_TIMEOUT_S = 5
+# ... and if no forecast is available at all, Dublin's mean temperature (K) is used.
+CONST_WEATHER_DEFAULT_TEMP_K = 283.15
+
+
+##########################################################################################
+#  Distances
+##########################################################################################
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great circle distance (km) between points given as lat/lon (degrees)
+
+    Vectorised with NumPy - any of the arguments can be an array (they are
+    broadcast against each other), so a whole file of stops is one call.
+    """
+    lat1, lon1, lat2, lon2 = ( \
+        np.radians(np.asarray(coordinate, dtype=float)) \
+        for coordinate in (lat1, lon1, lat2, lon2))
+
+    half_chord_sq = np.sin((lat2 - lat1) / 2) ** 2 \
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * CONST_EARTH_RADIUS_KM * np.arcsin(np.sqrt(half_chord_sq))
+
+
+##########################################################################################
+#  Times
+##########################################################################################
+
+
+def seconds_after_midnight(value):
+    """Return a time as (integer) seconds after midnight
+
+    Accepts a GTFS time string (e.g. '25:10:00' - times can pass 24:00:00 for
+    trips running after midnight), a time/datetime or a timedelta (as MySQL
+    returns TIME columns).
+    """
+    if isinstance(value, timedelta):
+        return int(value.total_seconds())
+    if isinstance(value, (datetime, dt_time)):
+        return value.hour * 3600 + value.minute * 60 + value.second
+    hours, minutes, seconds = str(value).strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+##########################################################################################
+#  Names
+##########################################################################################
+
+
+def _name_words(name):
+    """Return the (lower case, unaccented) words in a name, ignoring punctuation
+    """
+    if name is None:
+        return []
+    name = unicodedata.normalize('NFKD', str(name).lower())
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return re.findall(r'[a-z0-9]+', name)
+
+
+def route_short_name_key(route_shortname):
+    """Return a route short name in the form it is indexed by ('46a ' -> '46A')
+
+    Google and the GTFS data don't always agree on case or spacing.
+    """
+    if route_shortname is None:
+        return ''
+    return re.sub(r'\s+', '', str(route_shortname)).upper()
+
+
+def route_name_tokens(route_name):
+    """Return the set of (lower case) words in a route long name
+
+    Punctuation is ignored - 'Ballymun - Bray' -> {'ballymun', 'bray'}
+    """
+    return set(_name_words(route_name))
+
+
+def headsign_key(headsign):
+    """Return a headsign in the form it is indexed by (' Clongriffin' -> 'clongriffin')
+    """
+    return ' '.join(_name_words(headsign))
+
+
+def stop_name_key(stop_name):
+    """Return the stop number (or None) and the set of other words in a stop name
+
+    Dublin Bus stop names end with the stop number, which Google usually
+    includes - 'Eden Quay, stop 299' -> (299, {'eden', 'quay'})
+    """
+    words = ' '.join(_name_words(stop_name))
+    stop_number = None
+    match = re.search(r'\bstop (?:no )?(\d+)\b', words)
+    if match:
+        stop_number = int(match.group(1))
+        words = words[:match.start()] + words[match.end():]
+    return stop_number, set(words.split())
+
 
 ##########################################################################################
 #  Extracts (JSON, .CSV)
@@ -476,15 +601,336 @@ def get_valid_route_shortnames(database):
     return valid_route_shortnames
 
 
+class RouteIndex:
+    """In-memory index of routes (by name) and their trips
+
+    Built from the 'route_names' table the loader derives from routes, and the
+    trips table. Looking up the candidate routes and trips for a step is then a
+    dictionary hit rather than a series of queries. Call refresh() after each
+    load of GTFS data - until the first refresh the index is empty and the
+    lookups fall back to querying the database.
+    """
+    def __init__(self):
+        # route short name -> route keys, route key -> long name tokens, and
+        # route key -> trip keys.  Replaced as one (see refresh()).
+        self._index = ({}, {}, {})
+
+    def __len__(self):
+        return len(self._index[1])
+
+    def refresh(self, database):
+        """(Re)Build the index from the database
+        """
+        routes_by_short_name = {}
+        long_name_tokens = {}
+        for row in database.session.query(RouteName.route_key, RouteName.short_name, \
+                                          RouteName.long_name_tokens).all():
+            routes_by_short_name.setdefault(row.short_name, []).append(row.route_key)
+            long_name_tokens[row.route_key] = set(row.long_name_tokens.split())
+
+        trips_by_route = {}
+        for row in database.session.query(Trips.route_key, Trips.trip_key).all():
+            trips_by_route.setdefault(row.route_key, []).append(row.trip_key)
+
+        # A single assignment, so concurrent lookups see the old index or the new.
+        self._index = (routes_by_short_name, long_name_tokens, trips_by_route)
+        log.info('Route index refreshed: %d routes, %d route shortnames.', \
+            len(long_name_tokens), len(routes_by_short_name))
+
+    def search_for_routes(self, route_name, route_shortname):
+        """Returns the route keys for the supplied names (see _search_for_routes)
+        """
+        routes_by_short_name, long_name_tokens, _ = self._index
+        route_keys = sorted(routes_by_short_name.get(route_short_name_key(route_shortname), []))
+        # A route matches the (google) long name if it has all of its words.
+        name_tokens = route_name_tokens(route_name)
+        route_keys_full_match = \
+            [route_key for route_key in route_keys if name_tokens <= long_name_tokens[route_key]]
+        if len(route_keys_full_match) > 0:
+            return route_keys_full_match, False
+        return route_keys, True
+
+    def trips_for_route_ids(self, route_keys):
+        """Returns the trip keys for the supplied route keys
+        """
+        trips_by_route = self._index[2]
+        return [trip_key for route_key in route_keys \
+                for trip_key in trips_by_route.get(route_key, [])]
+
+
+class StopIndex:
+    """In-memory index of the stops, by name and by position
+
+    Names are indexed by stop number and by word (see stop_name_key()).
+    For position, the stops are bucketed into a grid of cells (CONST_STOP_INDEX_CELL_DEG
+    square). A search looks at the cells in rings around the requested position,
+    moving out a ring at a time until no stop in a further ring could be closer.
+    Call refresh() after each load of GTFS data - until the first refresh the
+    index is empty and stops are found by querying the database.
+    """
+    def __init__(self):
+        # stop keys, lats, lons (arrays), cell -> positions in those arrays, the
+        # latitude (of any stop) furthest from the equator, stop number ->
+        # positions and name word -> positions. Replaced as one (see refresh()).
+        self._index = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0), {}, 0.0, {}, {})
+
+    def __len__(self):
+        return len(self._index[0])
+
+    def refresh(self, database):
+        """(Re)Build the index from the database
+        """
+        rows = database.session.query( \
+            Stop.stop_key, Stop.stop_name, Stop.stop_lat, Stop.stop_lon).all()
+        stop_keys = np.array([row.stop_key for row in rows], dtype=np.int64)
+        lats = np.array([row.stop_lat for row in rows], dtype=float)
+        lons = np.array([row.stop_lon for row in rows], dtype=float)
+
+        cells = {}
+        for position, cell in enumerate(zip( \
+                np.floor(lats / CONST_STOP_INDEX_CELL_DEG).astype(int).tolist(), \
+                np.floor(lons / CONST_STOP_INDEX_CELL_DEG).astype(int).tolist())):
+            cells.setdefault(cell, []).append(position)
+        cells = {cell: np.array(positions) for cell, positions in cells.items()}
+        max_abs_lat = float(np.abs(lats).max()) if len(rows) > 0 else 0.0
+
+        stops_by_number = {}
+        stops_by_word = {}
+        for position, row in enumerate(rows):
+            stop_number, words = stop_name_key(row.stop_name)
+            if stop_number is not None:
+                stops_by_number.setdefault(stop_number, set()).add(position)
+            for word in words:
+                stops_by_word.setdefault(word, set()).add(position)
+
+        # A single assignment, so concurrent lookups see the old index or the new.
+        self._index = (stop_keys, lats, lons, cells, max_abs_lat, stops_by_number, stops_by_word)
+        log.info('Stop index refreshed: %d stops in %d cells, %d stop numbers.', \
+            len(stop_keys), len(cells), len(stops_by_number))
+
+    def identify(self, name, lat, lon):
+        """Returns the 'most likely' stop for a (google) stop name and position
+
+        Returns (stop key, distance km, what the stop was matched on). Stops are
+        matched on stop number, otherwise on having every word of the name - the
+        closest of the stops matched is chosen. If no stop matches the name, the
+        stop nearest the position is chosen.
+        """
+        stop_keys, lats, lons, _, _, stops_by_number, stops_by_word = self._index
+        stop_number, words = stop_name_key(name)
+        matched_on = 'number'
+        positions = stops_by_number.get(stop_number, set())
+        if len(positions) == 0 and len(words) > 0:
+            matched_on = 'name'
+            positions = set.intersection(*(stops_by_word.get(word, set()) for word in words))
+        if len(positions) == 0:
+            return (*self.nearest(lat, lon)[0], 'position')
+
+        positions = np.array(sorted(positions))
+        distances = haversine_km(lat, lon, lats[positions], lons[positions])
+        closest = distances.argmin()
+        return int(stop_keys[positions[closest]]), float(distances[closest]), matched_on
+
+    def nearest(self, lat, lon, k=1):
+        """Returns the (up to) k stops nearest lat/lon - a list of (stop key, distance km)
+        """
+        stop_keys, lats, lons, cells, max_abs_lat = self._index[:5]
+        k = min(k, len(stop_keys))
+        if k < 1:
+            return []
+        lat_cell = int(np.floor(lat / CONST_STOP_INDEX_CELL_DEG))
+        lon_cell = int(np.floor(lon / CONST_STOP_INDEX_CELL_DEG))
+        # A cell is (at least) this wide, where it is narrowest...
+        cell_km = np.radians(CONST_EARTH_RADIUS_KM) * CONST_STOP_INDEX_CELL_DEG \
+            * np.cos(np.radians(max(max_abs_lat, abs(lat))))
+
+        positions = np.empty(0, dtype=int)
+        distances = np.empty(0)
+        ring = 0
+        while True:
+            if 8 * ring > len(cells):
+                # More cells in this ring than there are cells with stops - (the
+                # position is well outside the area served) just check every stop.
+                positions = np.arange(len(stop_keys))
+                distances = haversine_km(lat, lon, lats, lons)
+                break
+            ring_positions = [cells[cell] for cell in _ring_cells(lat_cell, lon_cell, ring) \
+                              if cell in cells]
+            if len(ring_positions) > 0:
+                ring_positions = np.concatenate(ring_positions)
+                positions = np.concatenate((positions, ring_positions))
+                distances = np.concatenate((distances, haversine_km( \
+                    lat, lon, lats[ring_positions], lons[ring_positions])))
+            # Any stop outside the rings searched so far is at least this far away.
+            if len(positions) >= k \
+                and np.partition(distances, k - 1)[k - 1] <= ring * cell_km:
+                break
+            ring += 1
+
+        nearest = np.argsort(distances, kind='stable')[:k]
+        return [(int(stop_keys[positions[i]]), float(distances[i])) for i in nearest]
+
+
+def _ring_cells(lat_cell, lon_cell, ring):
+    """Yield the grid cells 'ring' cells (in either direction) from the given cell
+    """
+    if ring == 0:
+        yield (lat_cell, lon_cell)
+        return
+    for lon_offset in range(-ring, ring + 1):
+        yield (lat_cell - ring, lon_cell + lon_offset)
+        yield (lat_cell + ring, lon_cell + lon_offset)
+    for lat_offset in range(-ring + 1, ring):
+        yield (lat_cell + lat_offset, lon_cell - ring)
+        yield (lat_cell + lat_offset, lon_cell + ring)
+
+
+class Timetable:
+    """In-memory timetable - the times each trip calls at each stop
+
+    Held as NumPy arrays of (time of day, trip key, headsign) grouped by stop,
+    and sorted by time of day within each stop. The latest call at a stop
+    before a given time is then found by binary search. Times are the stop
+    times' arrival_time, as a time of day - calls after midnight by trips from
+    the previous service day (times past 24:00:00) sort with the early morning
+    calls. Call refresh() after each load of GTFS data - until the first
+    refresh the timetable is empty and trips are found by querying the
+    database. The trip patterns (the stops each trip calls at, in order) are
+    held too - but pattern keys are renumbered by every load, so they are only
+    used within the timetable. Rows in the database are found by trip key (a
+    trip keeps its key for good).
+    """
+    def __init__(self):
+        # stop key -> offset of its first call in the arrays, then the times,
+        # trip keys and headsign numbers (arrays), headsign ->
+        # headsign number, trip key -> pattern key (array) and pattern key -> stop
+        # keys (arrays, in stop_sequence order). Replaced as one (see refresh()).
+        self._index = (np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32), \
+            np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), \
+            {}, np.zeros(1, dtype=np.int32), {})
+
+    def __len__(self):
+        return len(self._index[1])
+
+    def refresh(self, database):
+        """(Re)Build the timetable from the database
+        """
+        headsigns = {}
+        chunks = []
+        max_trip_key = database.session.query(func.max(StopTime.trip_key)).scalar() or 0
+        for first_trip_key in range(1, max_trip_key + 1, CONST_TIMETABLE_TRIPS_PER_QUERY):
+            stop_times = database.session.query( \
+                StopTime.stop_key, StopTime.arrival_time, StopTime.trip_key, \
+                StopTime.stop_headsign)
+            stop_times = stop_times.filter(StopTime.trip_key.between( \
+                first_trip_key, first_trip_key + CONST_TIMETABLE_TRIPS_PER_QUERY - 1))
+            # (calls more than a day after the start of the service day are never
+            # candidates - see get_stops_by_route)
+            stop_times = stop_times.filter(StopTime.arrival_time < 2 * CONST_SECONDS_PER_DAY)
+            rows = stop_times.all()
+            if len(rows) == 0:
+                continue
+            stop_keys, times, trip_keys, stop_headsigns = zip(*rows)
+            chunks.append(( \
+                np.array(stop_keys, dtype=np.int64), \
+                np.array(times, dtype=np.int32) % CONST_SECONDS_PER_DAY, \
+                np.array(trip_keys, dtype=np.int32), \
+                np.array([headsigns.setdefault(headsign_key(headsign), len(headsigns)) \
+                          for headsign in stop_headsigns], dtype=np.int32)))
+
+        if len(chunks) > 0:
+            stop_keys, times, trip_keys, headsign_numbers = \
+                (np.concatenate(arrays) for arrays in zip(*chunks))
+        else:
+            stop_keys, times, trip_keys, headsign_numbers = \
+                (np.empty(0, dtype=np.int32) for _ in range(4))
+        order = np.lexsort((trip_keys, times, stop_keys))
+        stop_keys = stop_keys[order]
+        # Stop keys are dense, so the calls for stop key k are at offsets[k]:offsets[k+1]
+        offsets = np.searchsorted(stop_keys, \
+            np.arange((stop_keys[-1] if len(stop_keys) > 0 else 0) + 2))
+
+        # (trip keys are dense too, 0 for a trip without a pattern)
+        trip_patterns = np.zeros(max_trip_key + 1, dtype=np.int32)
+        for row in database.session.query(PatternTrip.trip_key, PatternTrip.pattern_key).all():
+            if row.trip_key <= max_trip_key:
+                trip_patterns[row.trip_key] = row.pattern_key
+        pattern_stops = {}
+        pattern_stop_query = database.session.query(TripPattern.pattern_key, TripPattern.stop_key)
+        pattern_stop_query = pattern_stop_query.order_by( \
+            TripPattern.pattern_key, TripPattern.stop_sequence)
+        for pattern_key, rows in groupby(pattern_stop_query.all(), key=itemgetter(0)):
+            pattern_stops[pattern_key] = np.array([row[1] for row in rows], dtype=np.int64)
+
+        # A single assignment, so concurrent lookups see the old timetable or the new.
+        self._index = (offsets, times[order], trip_keys[order], \
+            headsign_numbers[order], headsigns, trip_patterns, pattern_stops)
+        log.info('Timetable refreshed: %d stop times at %d stops, %d headsigns, %d patterns.', \
+            len(order), np.count_nonzero(np.diff(offsets)), len(headsigns), len(pattern_stops))
+
+    def trips_with_stops_in_order(self, trip_keys, depstop_key, arrstop_key):
+        """Returns the trip keys (of 'trip_keys') calling at depstop and, later on, arrstop
+        """
+        trip_patterns, pattern_stops = self._index[5:]
+        stops_in_order = {}  # pattern key -> True/False
+        for pattern_key in set(trip_patterns[trip_key] for trip_key in trip_keys \
+                               if 0 <= trip_key < len(trip_patterns)):
+            stop_keys = pattern_stops.get(pattern_key, np.empty(0, dtype=np.int64))
+            depstop_positions = np.flatnonzero(stop_keys == depstop_key)
+            arrstop_positions = np.flatnonzero(stop_keys == arrstop_key)
+            stops_in_order[pattern_key] = len(depstop_positions) > 0 \
+                and len(arrstop_positions) > 0 \
+                and depstop_positions[0] < arrstop_positions[-1]
+        return [trip_key for trip_key in trip_keys \
+                if 0 <= trip_key < len(trip_patterns) \
+                and stops_in_order[trip_patterns[trip_key]]]
+
+    def latest_call(self, stop_key, time_s, trip_keys, headsign=None):
+        """Returns the trip key of the latest call at a stop at/before time_s
+
+        Only calls by one of 'trip_keys' (with the headsign, if supplied) are
+        considered. Returns None if there is no such call.
+        """
+        offsets, times, call_trip_keys, headsign_numbers, headsigns = self._index[:5]
+        if stop_key is None or not 0 <= stop_key < len(offsets) - 1:
+            return None
+        headsign_number = None
+        if headsign:
+            headsign_number = headsigns.get(headsign_key(headsign))
+            if headsign_number is None:
+                return None
+        trip_keys = np.unique(np.asarray(trip_keys, dtype=np.int32))
+
+        first = offsets[stop_key]
+        # Calls (at this stop) up to 'last' are at or before time_s...
+        last = first + np.searchsorted( \
+            times[first:offsets[stop_key + 1]], time_s % CONST_SECONDS_PER_DAY, side='right')
+        # ... search back from there, a chunk at a time, for a matching call.
+        while last > first:
+            chunk_first = max(first, last - CONST_TIMETABLE_SEARCH_CHUNK)
+            matches = np.isin(call_trip_keys[chunk_first:last], trip_keys)
+            if headsign_number is not None:
+                matches &= headsign_numbers[chunk_first:last] == headsign_number
+            if matches.any():
+                idx = chunk_first + len(matches) - 1 - matches[::-1].argmax()
+                return int(call_trip_keys[idx])
+            last = chunk_first
+        return None
+
+
 def get_stops_by_route(database, route_name, route_shortname, \
     stop_headsign, jrny_time, \
     departure_stop_name, departure_stop_lat, departure_stop_lon, \
-    arrival_stop_name, arrival_stop_lat, arrival_stop_lon):
+    arrival_stop_name, arrival_stop_lat, arrival_stop_lon, \
+    route_index=None, stop_index=None, timetable=None):
     """Returns an ordered list of stops for a selected section of route Id'd by LineId
 
     Each route_shortname can (potentially) represent a collection of routes
     We identify the 'most likely route' based on a chosen datetime, starting
     from a chosen stop (identified by lat/lon coordinates)
+    Routes and trips are looked up in 'route_index' (a RouteIndex), stops
+    identified in 'stop_index' (a StopIndex) and the most likely trip found in
+    'timetable' (a Timetable), when supplied
     Returns an empty list on error
     Returns a list of 'StepStops' on success
     """
@@ -505,8 +951,8 @@ def get_stops_by_route(database, route_name, route_shortname, \
     # )
     # AND ABS(stops.stop_lat - 53.3351498) < 0.0000005
     # AND ABS(stops.stop_lon - -6.2943145) < 0.0000005
-    # AND arrival_time < CAST('16:54:00' AS TIME)
-    # ORDER BY arrival_time DESC
+    # AND (arrival_time <= 60840 OR arrival_time BETWEEN 86400 AND 147240)
+    # ORDER BY MOD(arrival_time, 86400) DESC
     # LIMIT 1;
 
     # We ASSUME google directions is hot enough to only suggest routes that are
@@ -514,13 +960,21 @@ def get_stops_by_route(database, route_name, route_shortname, \
     # or calendar_dates tables)
 
     def _identify_stop(database, name, lat, lon):
-        """Returns a the 'most likely' Stop (sqlachemy model) for the supplied inputs
+        """Returns the key of the 'most likely' Stop for the supplied inputs
 
         Attempts to identify Stop by exact shortname match first.
         If that fails OR if multiple results are found then select the stop using
         the MySQL 'ST_DISTANCE_SPHERE' method to identify to stop closest to the
         supplied lat/long.
+        With a stop index, the stop is identified (by name, then position) in memory.
         """
+        if stop_index:
+            stop_key, distance_km, matched_on = stop_index.identify(name, lat, lon)
+            log.debug('\tBest match for %s (lat %s, lon %s) is stop key %s, %.0fm away ' \
+                '(stop index, matched on %s)', \
+                name, lat, lon, stop_key, distance_km * 1000, matched_on)
+            return stop_key
+
         stop = None
         position_match_required = False
         try:
@@ -570,13 +1024,16 @@ def get_stops_by_route(database, route_name, route_shortname, \
             log.debug('\tBest match for lat %s and lon %s is stop %s (at lat %s, lon %s)', \
                 lat, lon, stop.stop_name, stop.stop_lat, stop.stop_lon)
 
-        return stop
+        log.debug('\tIdentified stop -> %s (stop key %s)', stop.stop_name, stop.stop_key)
+        return stop.stop_key
 
     log.debug(
         'get_stops_by_route: Starting search for route \"%s\", at %s',
         route_shortname, str(jrny_time))
+    round_trips = _RoundTripCounter(database)
 
     stoptimes_whole_trip = []
+    step_stops  = []
     if (route_shortname is None) or (jrny_time is None) \
         or (departure_stop_name is None) \
         or (departure_stop_lat is None) or (departure_stop_lon is None) \
@@ -586,25 +1043,26 @@ def get_stops_by_route(database, route_name, route_shortname, \
         # ALERT the LERTS!!!!!
         pass
     else:
-        # First - identify the stops!
+        # First - identify the stops! (just their keys - the Stops themselves are
+        # read along with the rest of the stops for the step)
         # Identify the departure stop (by name ideally, if that fails then by lat/lon)
-        depstop = _identify_stop(
+        depstop_key = _identify_stop(
             database, departure_stop_name, departure_stop_lat, departure_stop_lon
             )
-        log.debug('\tIdentified departure stop -> %s', depstop.stop_name)
+        log.debug('\tIdentified departure stop -> %s', depstop_key)
 
         # Identify the departure stop (by name ideally, if that fails then by lat/lon)
-        arrstop = _identify_stop(
+        arrstop_key = _identify_stop(
             database, arrival_stop_name, arrival_stop_lat, arrival_stop_lon
             )
-        log.debug('\tIdentified arrival stop -> %s', arrstop.stop_name)
+        log.debug('\tIdentified arrival stop -> %s', arrstop_key)
 
         #----------
 
         routes_for_shortname, poor_route_matching = \
-            _search_for_routes(database, route_name, route_shortname)
+            _search_for_routes(database, route_name, route_shortname, route_index)
 
-        trips_for_routes = _trips_for_route_ids(database, routes_for_shortname)
+        trips_for_routes = _trips_for_route_ids(database, routes_for_shortname, route_index)
 
         # ***
         # THIS IS THE MAGIC - WHERE ROUTES, STEPS... BECOME A SINGLE TRIP
@@ -614,47 +1072,70 @@ def get_stops_by_route(database, route_name, route_shortname, \
             # Replace the 'poor_route_matching' list with our freshly filtered list
             filtered_trips_list = \
                 _trips_with_stops_in_correct_order(
-                    database, trips_for_routes, depstop, arrstop
+                    database, trips_for_routes, depstop_key, arrstop_key, timetable
                     )
 
             trips_for_routes.clear()
             trips_for_routes.extend(filtered_trips_list)
 
-        trip_from_stoptimes = database.session.query(StopTime.trip_id)
-        #stop_times_query = stop_times_query.join(Stop, Stop.stop_id == StopTime.stop_id)
-        trip_from_stoptimes = trip_from_stoptimes.filter(StopTime.trip_id.in_(trips_for_routes))
-        # Additionally filtering by 'trip_headsign' in most cases ensures we never
-        # mistake an inbound trip for an outbound trip.
-        if stop_headsign:
-            # A lot of the GTFS data have leading spaces, the google data does not...
-            # ... so func.ltrim
-            trip_from_stoptimes = \
-                trip_from_stoptimes.filter(func.ltrim(StopTime.stop_headsign) == stop_headsign)
-        trip_from_stoptimes = trip_from_stoptimes.filter(StopTime.stop_id == depstop.stop_id)
-        trip_from_stoptimes = trip_from_stoptimes.filter(StopTime.arrival_time <= jrny_time)  #!!<-
-        trip_from_stoptimes = trip_from_stoptimes.order_by(text('arrival_time desc'))
-        #log.debug('\tMost likely trip query:', \
-        # trip_from_stoptimes.statement.compile(compile_kwargs={"literal_binds": True}))
-        trip_query_result = trip_from_stoptimes.limit(1).all()
-
-        trip_id = None
-        for row in trip_query_result:
-            trip_id = row[0]
-            log.debug('\tMost likely trip identified: %s', trip_id)
-
-        # At this point we've hopefully identified the * most likely * trip_id for
+        trip_key = None
+        jrny_time_s = seconds_after_midnight(jrny_time)
+        if timetable:
+            # The timetable finds the latest call at the departure stop (by one of
+            # our trips, with the right headsign) by binary search on its calls.
+            trip_key = timetable.latest_call( \
+                depstop_key, jrny_time_s, trips_for_routes, stop_headsign)
+            if trip_key:
+                log.debug('\tMost likely trip identified: %s (timetable)', trip_key)
+        else:
+            # (trips, stops and routes are all identified by their integer keys)
+            trip_from_stoptimes = database.session.query(StopTime.trip_key)
+            #stop_times_query = stop_times_query.join(Stop, Stop.stop_id == StopTime.stop_id)
+            trip_from_stoptimes = trip_from_stoptimes.filter( \
+                StopTime.trip_key.in_(trips_for_routes))
+            # Additionally filtering by 'trip_headsign' in most cases ensures we never
+            # mistake an inbound trip for an outbound trip.
+            if stop_headsign:
+                # A lot of the GTFS data have leading spaces, the google data does not...
+                # ... so func.ltrim
+                trip_from_stoptimes = \
+                    trip_from_stoptimes.filter(func.ltrim(StopTime.stop_headsign) == stop_headsign)
+            trip_from_stoptimes = trip_from_stoptimes.filter(StopTime.stop_key == depstop_key)
+            # Stop times are stored as seconds after midnight, so the time filter is a
+            # plain integer range. Trips from the previous service day still running
+            # after midnight (arrival_time past 24:00:00) are candidates too...
+            trip_from_stoptimes = trip_from_stoptimes.filter(or_( \
+                StopTime.arrival_time <= jrny_time_s, \
+                StopTime.arrival_time.between( \
+                    CONST_SECONDS_PER_DAY, jrny_time_s + CONST_SECONDS_PER_DAY)))  #!!<-
+            # ... ordered by the (wall clock) time they actually reach the stop.
+            trip_from_stoptimes = trip_from_stoptimes.order_by( \
+                desc(func.mod(StopTime.arrival_time, CONST_SECONDS_PER_DAY)))
+            #log.debug('\tMost likely trip query:', \
+            # trip_from_stoptimes.statement.compile(compile_kwargs={"literal_binds": True}))
+            trip_query_result = trip_from_stoptimes.limit(1).all()
+
+            for row in trip_query_result:
+                trip_key = row[0]
+                log.debug('\tMost likely trip identified: %s', trip_key)
+
+        # At this point we've hopefully identified the * most likely * trip for
         # the requested journey! Sweet - now we just return the list of stops for
-        # this trip_id!
-        step_stops  = []
-        if trip_id:
-            stepstops_info_for_trip = \
-                database.session.query(StopTime.stop_sequence, StopTime.shape_dist_traveled, Stop)
+        # this trip!
+        if trip_key:
+            # The stops are read from the trip's pattern (the sequence of stops it
+            # shares with many other trips) rather than from its stop_times. The
+            # pattern is found by trip key - pattern keys change with every load.
+            stepstops_info_for_trip = database.session.query( \
+                TripPattern.stop_sequence, TripPattern.shape_dist_traveled, Stop)
             stepstops_info_for_trip = \
-                stepstops_info_for_trip.join(Stop, StopTime.stop_id == Stop.stop_id)
+                stepstops_info_for_trip.join(Stop, TripPattern.stop_key == Stop.stop_key)
+            stepstops_info_for_trip = stepstops_info_for_trip.join( \
+                PatternTrip, PatternTrip.pattern_key == TripPattern.pattern_key)
             stepstops_info_for_trip = \
-                stepstops_info_for_trip.filter(StopTime.trip_id == trip_id)
+                stepstops_info_for_trip.filter(PatternTrip.trip_key == trip_key)
             stepstops_info_for_trip = \
-                stepstops_info_for_trip.order_by(text('stop_sequence'))
+                stepstops_info_for_trip.order_by(TripPattern.stop_sequence.asc())
             # All stops selected, omit stop_times detail
             stoptimes_whole_trip = stepstops_info_for_trip.all()
 
@@ -662,155 +1143,391 @@ def get_stops_by_route(database, route_name, route_shortname, \
             # 'stoptimes_whole_trip' is in stop_sequence order remember...
             for row in stoptimes_whole_trip:
                 stop = row[2]
-                if (stop.stop_id == depstop.stop_id) or (stops_in_step):
+                if (stop.stop_key == depstop_key) or (stops_in_step):
                     step_stops.append(StepStop(stop, row[0], row[1]))
                     stops_in_step = True
-                if stop.stop_id == arrstop.stop_id:
+                if stop.stop_key == arrstop_key:
                     stops_in_step = False
                     break
 
+    log.debug('get_stops_by_route: Found %d stops in %d database round trips', \
+        len(step_stops), round_trips.stop())
+
     # NOTE step_stops may well be empty.  We can only do our best!!
     return step_stops
 
-def _trips_for_route_ids(database, routes_ids):
-    """Find all the trip_id's for the supplied list of route_id's
+
+class _RoundTripCounter:
+    """Counts the statements sent to the database on a session's connection
+
+    Only counts when debug logging is enabled (see get_stops_by_route).
     """
-    # We now have a list of route_ids, we can use that list to get a list of
+    def __init__(self, database):
+        self.count = 0
+        self._connection = None
+        if log.isEnabledFor(logging.DEBUG):
+            self._connection = database.session.connection()
+            event.listen(self._connection, 'before_cursor_execute', self._statement)
+
+    def _statement(self, *args):
+        self.count += 1
+
+    def stop(self):
+        """Stop counting, returns the count
+        """
+        if self._connection is not None:
+            event.remove(self._connection, 'before_cursor_execute', self._statement)
+            self._connection = None
+        return self.count
+
+def _trips_for_route_ids(database, route_keys, route_index=None):
+    """Find all the trip keys for the supplied list of route keys
+    """
+    if route_index:
+        trip_keys_for_routes = route_index.trips_for_route_ids(route_keys)
+        log.debug('\tFound %d trips for routes (route index).', len(trip_keys_for_routes))
+        return trip_keys_for_routes
+
+    # We now have a list of route keys, we can use that list to get a list of
     # trips for those routes...  we don't cater for 'no trips found' scenario
-    trips = database.session.query(Trips)
-    trips = trips.filter(Trips.route_id.in_(routes_ids))
+    trips = database.session.query(Trips.trip_key)
+    trips = trips.filter(Trips.route_key.in_(route_keys))
 
-        # Extract a list of trip_id's from the 'trips' query result...
-    trip_ids_for_routes = []
+        # Extract a list of trip keys from the 'trips' query result...
+    trip_keys_for_routes = []
     for trip in trips.all():
-        trip_ids_for_routes.append(trip.trip_id)
-    log.debug('\tFound %d trips for routes.', len(trip_ids_for_routes))
+        trip_keys_for_routes.append(trip.trip_key)
+    log.debug('\tFound %d trips for routes.', len(trip_keys_for_routes))
 
-    return trip_ids_for_routes
+    return trip_keys_for_routes
 
 
-def _trips_with_stops_in_correct_order(database, trips_for_routes, depstop, arrstop):
-    """Filter a list of trips_ids, selecting only Trips where depstop preceeds arrstop
+def _trips_with_stops_in_correct_order( \
+        database, trips_for_routes, depstop_key, arrstop_key, timetable=None):
+    """Filter a list of trip keys, selecting only Trips where depstop preceeds arrstop
     """
     # If we didn't get an exact match on routes then it's likely we have both
     # inbound and outbound trips. Filter our trips - removing any trips where the
     # depstop is AFTER the arrstop (this implies a trip in the wrong direction)
-    trips_with_stops_in_correct_order = []
-
-    stoptimes_all_trips_query = database.session.query(StopTime)
-            #stop_times_query = stop_times_query.join(Stop, Stop.stop_id == StopTime.stop_id)
-    stoptimes_all_trips_query = \
-        stoptimes_all_trips_query.filter(StopTime.trip_id.in_(trips_for_routes))
-    stoptimes_all_trips_query = \
-        stoptimes_all_trips_query.order_by(StopTime.trip_id.asc(),StopTime.stop_sequence.asc())
-    stoptimes_all_trips = stoptimes_all_trips_query.all()
-
-    log.debug(
-            'Poor route matching cost us a loop over %d stoptimes records',
-            len(stoptimes_all_trips)
-            )
-
-    # Iterate over the results in trip order
-    wcurr_trip = ''
-    for stoptime in stoptimes_all_trips:
-                # On change of trip...
-        if stoptime.trip_id != wcurr_trip:
-            wcurr_trip = stoptime.trip_id
-            wdepstop_found = False
-            wfinished      = False
-
-        if not wfinished:
-            if stoptime.stop_id == depstop.stop_id:
-                wdepstop_found = True
-
-            if stoptime.stop_id == arrstop.stop_id:
-                # We have found the arrival stop!
-                # If the departure stop was already found for this trip then
-                # the stops are in the correct order and we can proceed. If
-                # not then this trip is a dud - we can just ignore it...
-                if wdepstop_found:
-                    trips_with_stops_in_correct_order.append(stoptime.trip_id)
-                    wfinished = True
+    if timetable:
+        trips_with_stops_in_correct_order = \
+            timetable.trips_with_stops_in_order(trips_for_routes, depstop_key, arrstop_key)
+        log.debug( \
+            '\tFound %d of %d trips with the stops in the correct order (timetable)', \
+            len(trips_with_stops_in_correct_order), len(trips_for_routes))
+        return trips_with_stops_in_correct_order
+
+    # Trips sharing a stop sequence share a trip pattern, so the order of the
+    # stops is checked once per pattern: the pattern must visit the depstop and,
+    # later on, the arrstop.
+    depstop_in_pattern = aliased(TripPattern)
+    arrstop_in_pattern = aliased(TripPattern)
+    trips_query = database.session.query(PatternTrip.trip_key)
+    trips_query = trips_query.join( \
+        depstop_in_pattern, depstop_in_pattern.pattern_key == PatternTrip.pattern_key)
+    trips_query = trips_query.join( \
+        arrstop_in_pattern, arrstop_in_pattern.pattern_key == PatternTrip.pattern_key)
+    trips_query = trips_query.filter(PatternTrip.trip_key.in_(trips_for_routes))
+    trips_query = trips_query.filter(depstop_in_pattern.stop_key == depstop_key)
+    trips_query = trips_query.filter(arrstop_in_pattern.stop_key == arrstop_key)
+    trips_query = trips_query.filter( \
+        depstop_in_pattern.stop_sequence < arrstop_in_pattern.stop_sequence)
+    trips_query = trips_query.distinct()
+
+    trips_with_stops_in_correct_order = [row.trip_key for row in trips_query.all()]
+    log.debug( \
+        '\tFound %d of %d trips with the stops in the correct order', \
+        len(trips_with_stops_in_correct_order), len(trips_for_routes))
 
     return trips_with_stops_in_correct_order
 
 
 def _search_for_routes(
-        database, route_name, route_shortname):
-    """Returns a list of the the 'most likely' Routes (sqlachemy models) for the supplied inputs
+        database, route_name, route_shortname, route_index=None):
+    """Returns a list of the keys of the 'most likely' Routes for the supplied inputs
     Returns a boolean indicating if the match was good (both names) or poor (shortname only)
 
     Attempts to identify Route by exact match on shortname/name first.
     If that fails we load all routes by shortname, and then filter that list
     further using the depstop, arrstop information
     """
-    # Look up routes for supplied shortname/name...
-    routes_base_query = database.session.query(Routes.route_id)
+    if route_index:
+        # The index matches the whole (normalized) shortname, and the words of
+        # the long name - rather than searching for them in the route names.
+        route_keys_by_name, poor_match = \
+            route_index.search_for_routes(route_name, route_shortname)
+        log.debug('\tFound %d routes for shortname \"%s\" / long_name \"%s\" ' \
+            '(route index, poor match: %s)', \
+            len(route_keys_by_name), route_shortname, route_name, poor_match)
+        return route_keys_by_name, poor_match
+
+    # Look up routes for supplied shortname/name... in one query, flagging the
+    # routes whose long name matches too.
+    log.debug('\tSearching for routes based on longname \"%s\" first', route_name)
+    routes_base_query = database.session.query(Routes.route_key, \
+        Routes.route_long_name.ilike(f'%{route_name}%').label('long_name_match'))
     #routes_base_query = routes_base_query.filter(Routes.route_short_name == route_shortname)
     # 'ilike' is case insensitive
     routes_base_query = routes_base_query.filter(Routes.route_short_name.ilike(f'%{route_shortname}%'))
     routes_base_query = routes_base_query.order_by(text('route_id asc'))
+    routes_by_shortname = routes_base_query.all()
 
-    route_ids_by_name = []
+    route_keys_by_name = [route.route_key for route in routes_by_shortname if route.long_name_match]
     poor_match = False
 
-    #routes_full_match = routes_base_query.filter(Routes.route_long_name == route_name)
-    log.debug('\tSearching for routes based on longname \"%s\" first', route_name)
-    routes_full_match = routes_base_query.filter(Routes.route_long_name.ilike(f'%{route_name}%'))
-    if routes_full_match.count() > 0:
+    if len(route_keys_by_name) > 0:
         # Great! This is the best solution - we found a full match - just grab
         # all these routes...
-        for route in routes_full_match.all():
-            route_ids_by_name.append(route.route_id)
-
         log.debug('\tFound %d routes on exact match shortname \"%s\" / long_name \"%s\"', \
-            len(route_ids_by_name), route_shortname, route_name)
+            len(route_keys_by_name), route_shortname, route_name)
     else:
         # Awww... no exact match found.  What we do next is attempt to match on
         # just shortname. Testing has revealed many cases where the route
         # shortname is in the data - but the long name has been altered (e.g.
         # for the 155 our database shows a long name of "St.Margaret's Road -
         # Outside Train Station" but the google directions returns "Ballymun to Bray"
-        for route in routes_base_query.all():
+        for route in routes_by_shortname:
             # BUT this gives us BOTH inbound and outbound routes.  Which is bad
             # naturally... we only want to consider trips where the bus is going
             # in the correct direction!
-            route_ids_by_name.append(route.route_id)
+            route_keys_by_name.append(route.route_key)
 
         poor_match = True
 
         log.debug('\tFound %d routes matched on shortname \"%s\" only', \
-            len(route_ids_by_name), route_shortname)
+            len(route_keys_by_name), route_shortname)
 
-    return route_ids_by_name, poor_match
+    return route_keys_by_name, poor_match
 
 
-def weather_information(inputtime):
-    """Return the predicted temperature at the provided time.
+def _fetch_open_weather_forecast(timeout_s):
+    """Fetch the hourly forecast (four days from now) for Dublin from open-weather
 
-    Uses the open-weather weather prediction service.
+    Returns a list of (unix timestamp, temperature K) - one per hour.
     """
-    # Call the weather prediction service
-    # This returns hourly weather predictions for four days from now
     url=credentials['open-weather']['url'] \
         + '?lat=' + str(CONST_DUBLIN_CC[0]) \
         + '&lon=' + str(CONST_DUBLIN_CC[1]) \
         + '&appid=' + credentials['open-weather']['api-key']
-    weather_json = rq.get(url).json()
+    response = rq.get(url, timeout=timeout_s)
+    response.raise_for_status()
+    weather_json = response.json()
     # Following produces a lot of json... only enable when required.
     #log.debug(weather_json)
-    #weatherforecast_json = \
-    # request_weatherforecast_data(latitude=str(position_lat), longitude=str(position_lng))
+    return [(each_hour_data['dt'], each_hour_data['main']['temp']) \
+            for each_hour_data in weather_json['list']]
+
+
+class WeatherForecast:
+    """Hourly temperature forecast, held in memory and refreshed in the background
+
+    The forecast is fetched (by 'fetch', called with a timeout in seconds) when
+    first used, then refreshed every 'refresh_interval_s' by a background thread
+    - so a prediction never waits on the weather service. If a refresh fails the
+    last forecast is used until one succeeds (the nearest forecast hour to a
+    time is used, however stale). If no forecast has ever been fetched we fall
+    back to CONST_WEATHER_DEFAULT_TEMP_K - and after a failed fetch, lookups
+    don't try again for 'retry_interval_s' (the background thread retries).
+    Tests and benchmarks replace 'jt_utils.weather_forecast' with a forecast
+    using a local 'fetch' (and background=False).
+    """
+    def __init__(self, fetch=_fetch_open_weather_forecast, \
+                 refresh_interval_s=CONST_WEATHER_REFRESH_S, \
+                 timeout_s=CONST_WEATHER_TIMEOUT_S, \
+                 retry_interval_s=CONST_WEATHER_RETRY_S, background=True):
+        self._fetch = fetch
+        self.refresh_interval_s = refresh_interval_s
+        self.retry_interval_s = retry_interval_s
+        self.timeout_s = timeout_s
+        self._background = background
+        self._thread = None
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        # forecast times (unix timestamps) and temperatures (arrays, in time
+        # order). Replaced as one (see refresh()).
+        self._forecast = (np.empty(0, dtype=np.int64), np.empty(0))
+        self.fetched_at = None
+        self.failed_at = None
+
+    def refresh(self):
+        """Fetch the forecast now (raises an exception if the fetch fails)
+        """
+        try:
+            forecast_hours = sorted(self._fetch(self.timeout_s))
+            if len(forecast_hours) == 0:
+                raise ValueError('Empty weather forecast')
+        except Exception:
+            self.failed_at = time.time()
+            raise
+        # A single assignment, so concurrent lookups see the old forecast or the new.
+        self._forecast = ( \
+            np.array([forecast_time for forecast_time, _ in forecast_hours], dtype=np.int64), \
+            np.array([temperature for _, temperature in forecast_hours], dtype=float))
+        self.fetched_at = time.time()
+        log.debug('Weather forecast refreshed: %d hours.', len(forecast_hours))
+
+    def temperature_at(self, when):
+        """Return the forecast temperature (K) at 'when' (a datetime)
+        """
+        if self.fetched_at is None and (self.failed_at is None \
+                or time.time() - self.failed_at >= self.retry_interval_s):
+            # Nothing fetched yet - try now (one lookup at a time, the others
+            # use the default temperature rather than wait).
+            if self._fetch_lock.acquire(blocking=False):
+                try:
+                    self.refresh()
+                except (rq.RequestException, OSError, KeyError, ValueError) as err:
+                    log.warning('Weather forecast unavailable, using default temperature: %s', err)
+                finally:
+                    self._fetch_lock.release()
+        if self._background:
+            self._start_refreshing()
+        if self.fetched_at is None:
+            return CONST_WEATHER_DEFAULT_TEMP_K
+
+        forecast_times, temperatures = self._forecast
+        idx = int(np.searchsorted(forecast_times, when.timestamp()))
+        # The nearest forecast hour (before or after)...
+        if idx == len(forecast_times) or (idx > 0 and \
+            when.timestamp() - forecast_times[idx - 1] < forecast_times[idx] - when.timestamp()):
+            idx -= 1
+        return float(temperatures[idx])
+
+    def _start_refreshing(self):
+        """Start the background refresh thread (if not already running in this process)
+        """
+        # (after a fork, the thread is not running in the child process)
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread( \
+                    target=self._refresh_forever, name='weather-forecast', daemon=True)
+                self._thread.start()
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval_s if self.fetched_at is not None \
+                       else self.retry_interval_s)
+            try:
+                self.refresh()
+            except Exception as err:  # pylint: disable=broad-except
+                # Keep the (stale) forecast we have - and keep trying.
+                log.warning('Weather forecast refresh failed: %s', err)
+
+
+# The weather forecast used by the predictions.
+weather_forecast = WeatherForecast()
+
+
+def weather_information(inputtime):
+    """Return the predicted temperature at the provided time.
+
+    'inputtime' is a datetime, or an hour (of today, or tomorrow if that hour
+    has already passed). Uses the open-weather weather prediction service (see
+    WeatherForecast).
+    """
+    when = inputtime
+    if not isinstance(inputtime, datetime):
+        now = datetime.now()
+        when = now.replace(hour=inputtime, minute=0, second=0, microsecond=0)
+        if when.hour < now.hour:
+            when += timedelta(days=1)
 
-    # Loop over the hourly data - find the first hour??? @YC - What about date??
-    predicted_temp = None
-    for each_hour_data in weather_json['list']:
-        forecast_datetime = datetime.fromtimestamp(each_hour_data['dt'])
-        hour=forecast_datetime.hour
-        if hour==inputtime:
-            predicted_temp = each_hour_data['main']['temp']
+    return weather_forecast.temperature_at(when)
 
-    return predicted_temp
+
+class ModelCache:
+    """In-memory, least recently used, cache of the (pickled) models
+
+    Models are kept in memory up to a budget of 'max_bytes' - a model's size is
+    taken to be the size of its pickle (close to its size in memory, as the
+    arrays in a model are pickled as raw bytes). A cached model is reloaded if
+    its pickle has since been modified (or replaced), so retrained models are
+    picked up without a restart.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # pickle path -> (model, (mtime, size) of the pickle) - in LRU order
+        self._models = OrderedDict()
+        self._bytes = 0
+
+    def get(self, filepath):
+        """Return the model pickled in 'filepath', loading it if it's not cached
+        """
+        stat = os.stat(filepath)
+        pickle_version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._models.get(filepath)
+            if cached is not None and cached[1] == pickle_version:
+                self._models.move_to_end(filepath)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        with open(filepath, 'rb') as file:
+            model = pickle.load(file)
+
+        with self._lock:
+            cached = self._models.pop(filepath, None)
+            if cached is not None:
+                self._bytes -= cached[1][1]
+            # (a model bigger than the whole budget is not cached at all)
+            if pickle_version[1] <= self.max_bytes:
+                self._models[filepath] = (model, pickle_version)
+                self._bytes += pickle_version[1]
+                while self._bytes > self.max_bytes:
+                    _, (_, (_, evicted_size)) = self._models.popitem(last=False)
+                    self._bytes -= evicted_size
+                    self.evictions += 1
+        return model
+
+    def stats(self):
+        """Return the cache counters (and current size) as a dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, \
+                    'models': len(self._models), 'bytes': self._bytes, \
+                    'max_bytes': self.max_bytes}
+
+
+def load_shared_model(filepath):
+    """Load a pickled model so its memory can be shared by several processes
+
+    A copy of the pickle is saved (once - and again if the pickle changes) in
+    joblib's format alongside it, and the model loaded from that copy with its
+    NumPy arrays memory-mapped (read only): every process using the model maps
+    the same pages of the file. Estimators which copy their arrays into buffers
+    of their own on loading (e.g. scikit-learn's trees) aren't mapped - but
+    their memory is still shared, copy-on-write, by worker processes forked
+    after the model is loaded (see jt_flask_module).
+    """
+    mmap_filepath = os.path.splitext(filepath)[0] + '.joblib'
+    if not os.path.exists(mmap_filepath) \
+        or os.path.getmtime(mmap_filepath) < os.path.getmtime(filepath):
+        with open(filepath, 'rb') as file:
+            model = pickle.load(file)
+        # (written to a temporary file first - other processes may be loading it)
+        mmap_filepath_tmp = mmap_filepath + '.' + str(os.getpid())
+        try:
+            joblib.dump(model, mmap_filepath_tmp)
+            os.replace(mmap_filepath_tmp, mmap_filepath)
+        except OSError as err:
+            log.warning('Unable to save %s, model will not be memory-mapped: %s', \
+                mmap_filepath, err)
+            return model
+
+    return joblib.load(mmap_filepath, mmap_mode='r')
+
+
+# The end-to-end models (one per line id), shared by all predictions.
+end_to_end_models = ModelCache( \
+    int(credentials.get('END_TO_END_MODEL_CACHE_MB', CONST_END_TO_END_MODEL_CACHE_MB)) \
+    * 1024 * 1024)
 
 
 def predict_journey_time(journey_prediction, model_stop_to_stop):
@@ -820,13 +1537,38 @@ def predict_journey_time(journey_prediction, model_stop_to_stop):
     If the pickle for the prediction model exists we use the end-to-end model.
     Else we use the stop-to-stop model.
     """
-    if journey_prediction.route_shortname_pickle_exists:
-        journey_prediction = _predict_jt_end_to_end(journey_prediction)
-    else:
-        # TODO - should we abort here if not step-stops information exists!
-        journey_prediction = _predict_jt_stop_to_stop(journey_prediction, model_stop_to_stop)
+    return predict_journey_times([(journey_prediction, model_stop_to_stop)])[0]
 
-    return journey_prediction
+
+def predict_journey_times(journey_predictions_and_models):
+    """Predict the journey times for a batch of journeys (e.g. every step of a request)
+
+    'journey_predictions_and_models' is a list of (JourneyPrediction, stop-to-stop
+    model) - the model is used only if no end-to-end model exists for the journey
+    (see predict_journey_time()).
+    The journeys are grouped by model - each end-to-end (line) model and each
+    stop-to-stop model is called once, for all the journeys using it.
+    Returns the list of updated JourneyPrediction models (in the same order).
+    """
+    end_to_end_journeys = {}   # end-to-end model filepath -> [journey_prediction, ...]
+    stop_to_stop_journeys = {} # id(model) -> (model, [journey_prediction, ...])
+    for journey_prediction, model_stop_to_stop in journey_predictions_and_models:
+        if journey_prediction.route_shortname_pickle_exists:
+            end_to_end_journeys.setdefault( \
+                _end_to_end_model_filepath(journey_prediction.route_shortname), \
+                []).append(journey_prediction)
+        else:
+            # (journeys without step stops are not aborted - they are logged and
+            # left without a prediction by _predict_jt_stop_to_stop_batch())
+            stop_to_stop_journeys.setdefault( \
+                id(model_stop_to_stop), (model_stop_to_stop, []))[1].append(journey_prediction)
+
+    for end_to_end_filepath, journey_predictions in end_to_end_journeys.items():
+        _predict_jt_end_to_end_batch(end_to_end_filepath, journey_predictions)
+    for model_stop_to_stop, journey_predictions in stop_to_stop_journeys.values():
+        _predict_jt_stop_to_stop_batch(model_stop_to_stop, journey_predictions)
+
+    return [journey_prediction for journey_prediction, _ in journey_predictions_and_models]
 
 
 def _predict_jt_end_to_end(journey_prediction):
@@ -835,42 +1577,57 @@ def _predict_jt_end_to_end(journey_prediction):
     Returns an updated JourneyPrediction model.
     Uses the end-to-end model
     """
+    _predict_jt_end_to_end_batch( \
+        _end_to_end_model_filepath(journey_prediction.route_shortname), [journey_prediction])
+    return journey_prediction  # Return the updated prediction_request
+
+
+def _end_to_end_model_filepath(lineid):
+    """The end-to-end model (pickle) for the line
+    """
+    return os.path.join(jt_utils_dir, *['pickles', 'end_to_end', lineid+'.pickle'])
+
 
+def _predict_jt_end_to_end_batch(end_to_end_filepath, journey_predictions):
+    """Predict the journey times for journeys on one line, in one call to its end-to-end model
+    """
+    # load the prediction model (usually already in memory)
+    model_for_line = end_to_end_models.get(end_to_end_filepath)
+    log.debug('\tEnd-to-end model cache: %s', end_to_end_models.stats())
+
+    # Pass the features into model and predict time
+    predictions = model_for_line.predict( \
+        np.array([_end_to_end_features(each) for each in journey_predictions]))
+    for journey_prediction, predict_result in zip(journey_predictions, predictions):
+        _set_end_to_end_prediction(journey_prediction, predict_result)
+
+
+def _end_to_end_features(journey_prediction):
+    """Return the end-to-end model input for the journey (one row)
+
+    The columns in the order the model was trained with.
+    """
     # Pull the required information from the JourneyPrediction object.
     duration = journey_prediction.planned_duration_s
     planned_departure_datetime = journey_prediction.planned_departure_datetime
     hour=planned_departure_datetime.hour
     week=planned_departure_datetime.isoweekday()
     month=planned_departure_datetime.month
-    lineid=journey_prediction.route_shortname
-    temperature=weather_information(hour)
-
-    week_sin  = np.sin(2 * np.pi * week/6.0)
-    week_cos  = np.cos(2 * np.pi * week/6.0)
-    hour_sin  = np.sin(2 * np.pi * hour/23.0)
-    hour_cos  = np.cos(2 * np.pi * hour/23.0)
-    month_sin = np.sin(2 * np.pi * month/12.0)
-    month_cos = np.cos(2 * np.pi * month/12.0)
-
-    # load the prediction model
-    end_to_end_filepath= \
-        os.path.join(jt_utils_dir, *['pickles', 'end_to_end', lineid+'.pickle'])
-    with open(end_to_end_filepath, 'rb') as file:
-        model_for_line = pickle.load(file)
-
-    # create a pandas dataframe
-    #dic_list = [{'PLANNED_JOURNEY_TIME':duration,'HOUR':10,'temp':6.8,'week':6,'Month':1}]
-    dic_list = [
-        {'PLANNED_JOURNEY_TIME':duration,
-        'week_sin':week_sin,'week_cos':week_cos,
-        'hour_sin':hour_sin,'hour_cos':hour_cos,
-        'month_sin':month_sin,'month_cos':month_cos,
-        'temp':temperature}
-        ]
-    input_to_pickle_data_frame = pd.DataFrame(dic_list).values
-    # Pass the dataframe into model and predict time
-    # !!! Model returns a NumPy NDArray - not a number! Grab the number from the array...
-    predict_result=model_for_line.predict(input_to_pickle_data_frame)[0]
+    temperature=weather_information(planned_departure_datetime)
+
+    return [duration,                                  # PLANNED_JOURNEY_TIME
+            np.sin(2 * np.pi * week/6.0),              # week_sin
+            np.cos(2 * np.pi * week/6.0),              # week_cos
+            np.sin(2 * np.pi * hour/23.0),             # hour_sin
+            np.cos(2 * np.pi * hour/23.0),             # hour_cos
+            np.sin(2 * np.pi * month/12.0),            # month_sin
+            np.cos(2 * np.pi * month/12.0),            # month_cos
+            temperature]                               # temp
+
+
+def _set_end_to_end_prediction(journey_prediction, predict_result):
+    """Set the predicted (end-to-end) time on the journey (and its step stops)
+    """
     log.debug("\tEnd-to-end prediction result -> %d", predict_result)
     journey_prediction.predicted_duration_s = predict_result
 
@@ -911,99 +1668,110 @@ def _predict_jt_end_to_end(journey_prediction):
                     stepstop_current.shape_dist_traveled - start_distance
                 stepstop_current.predicted_time_from_first_stop_s = cumulative_time
 
-    #journey_prediction.predicted_duration_s = 600
-
-    return journey_prediction  # Return the updated prediction_request
-
 
 def _predict_jt_stop_to_stop(journey_prediction, model_stop_to_stop):
     """Predict the journey timee for journey represented by the 'prediction_request' object
 
     Returns an updated JourneyPrediction model.
-    Uses the stop-to-stop model
-    ASSUMES the stop to stop model is in memory (global) as 'CONST_MODEL_STOP_TO_STOP'
+    Uses the stop-to-stop model (for the month of the departure)
     """
+    _predict_jt_stop_to_stop_batch(model_stop_to_stop, [journey_prediction])
+    return journey_prediction  # Return the updated rediction_request
 
-    duration = journey_prediction.planned_duration_s
-    planned_departure_datetime = journey_prediction.planned_departure_datetime
-    hour=planned_departure_datetime.hour
-    week=planned_departure_datetime.isoweekday()
-    # month=time.month
-    # lineid=journey_prediction.route_shortname
-    temperature=weather_information(hour)
-    #temperature=20
-    week_sin= np.sin(2 * np.pi * week/6.0)
-    week_cos = np.cos(2 * np.pi * week/6.0)
-    hour_sin = np.sin(2 * np.pi * hour/23.0)
-    hour_cos  = np.cos(2 * np.pi * hour/23.0)
-    #  month_sin = np.sin(2 * np.pi * month/12.0)
-    #  month_cos  = np.cos(2 * np.pi * month/12.0)
-
-    list_of_stops_for_journey = journey_prediction.step_stops
 
-    total_dis_m=0.001  # Sensible default - avoid divide by zero error
-    total_time=0
+def _predict_jt_stop_to_stop_batch(model_stop_to_stop, journey_predictions):
+    """Predict the journey times for journeys, in one call to a stop-to-stop model
 
-    if len(list_of_stops_for_journey) > 0:
-        # Assuming we have a stop-to-stop journey breakdown available...
-        # ... portion out the time for the journey based on % fraction of the
-        # total journey distance.
-        start_distance = list_of_stops_for_journey[0].shape_dist_traveled
-        end_distance = list_of_stops_for_journey[-1].shape_dist_traveled
+    All the stop-to-stop segments of all the journeys are predicted together.
+    """
+    features = []
+    journeys_with_stops = []
+    for journey_prediction in journey_predictions:
+        if len(journey_prediction.step_stops) > 0:
+            journeys_with_stops.append(journey_prediction)
+            features.append(_stop_to_stop_features(journey_prediction))
+        else:
+            # There will be cases where we fail to identify a list of stops for a route
+            # In these cases we don't want to crash - we simply ignore the missing information...
+            # Yes... for the stop-to-stop model failing to ID a route is a big problem...
+            log.warning(
+                'No Route Breakdown (stop by stop) found for %s', \
+                journey_prediction.route_shortname
+            )
+    if len(journeys_with_stops) == 0:
+        return
 
-        total_dis_m = end_distance - start_distance
+    # All the segments of all the journeys, in one matrix...
+    all_features = np.concatenate(features)
+    predictions = model_stop_to_stop.predict(all_features) if len(all_features) > 0 \
+        else np.empty(0)
+    log.debug('\tStop-to-stop model: %d journeys, %d segments, one call.', \
+        len(journeys_with_stops), len(all_features))
 
-        cumulative_time = 0
-        for index,stepstop in enumerate(list_of_stops_for_journey):
-            if index != 0:
-                stepstop_prev = list_of_stops_for_journey[index-1]
-                stepstop_now  = stepstop
-
-                stop_prev_dist_from_cc = stepstop_prev.stop.dist_from_cc
-                stop_now_dist_from_cc = stepstop_now.stop.dist_from_cc
-
-                dis_twostop = \
-                    stepstop_now.shape_dist_traveled - stepstop_prev.shape_dist_traveled
-
-                plantime_partial=duration*(dis_twostop/total_dis_m)
-
-                #dic_list = [{'PLANNED_JOURNEY_TIME':duration,'HOUR':10,'temp':6.8,'week':6,'Month':1}]
-                dic_list = [
-                    {'PLANNED_JOURNEY_TIME':plantime_partial, \
-                    'dis_twostop':dis_twostop, \
-                    'dis_prestop_city':stop_prev_dist_from_cc, \
-                    'dis_stopnow_city':stop_now_dist_from_cc, \
-                    'temp':temperature, \
-                    'week_sin':week_sin,'week_cos':week_cos, \
-                    'hour_sin':hour_sin,'hour_cos':hour_cos}
-                    ]
-                input_to_pickle_data_frame = pd.DataFrame(dic_list).values
-                # throw the dataframe into model and predict time
-                # !!! Model returns a NumPy NDArray - not a number! Grab the number from the array...
-                predict_result=model_stop_to_stop.predict(input_to_pickle_data_frame)[0]
-                log.debug("\tStop-to-stop prediction result -> %d", predict_result)
-                cumulative_time += predict_result
+    # ... and the predictions split back out per journey
+    offsets = np.cumsum([len(each) for each in features])[:-1]
+    for journey_prediction, journey_predictions_s in \
+            zip(journeys_with_stops, np.split(predictions, offsets)):
+        _set_stop_to_stop_predictions(journey_prediction, journey_predictions_s)
 
-                # Set the predicted journey distance/time on the current 'StepStop' Object
-                stepstop_now.dist_from_first_stop_m = \
-                    stepstop_now.shape_dist_traveled - start_distance
-                stepstop_now.predicted_time_from_first_stop_s = cumulative_time
 
-                total_time=predict_result+total_time
+def _stop_to_stop_features(journey_prediction):
+    """Return the stop-to-stop model input for the journey, as a NumPy matrix
 
-        # At the end set the total predicted journey time on the journey_prediction object
-        log.debug('Total predicted time for this journey is: %d', total_time)
-        journey_prediction.predicted_duration_s = total_time
-    else:
-        # There will be cases where we fail to identify a list of stops for a route
-        # In these cases we don't want to crash - we simply ignore the missing information...
-        # Yes... for the stop-to-stop model failing to ID a route is a big problem...
-        log.warning(
-            'No Route Breakdown (stop by stop) found for %s', \
-            journey_prediction.route_shortname
-        )
+    One row per pair of consecutive stops (so one fewer rows than step stops),
+    the columns in the order the model was trained with.
+    """
+    duration = journey_prediction.planned_duration_s
+    planned_departure_datetime = journey_prediction.planned_departure_datetime
+    hour=planned_departure_datetime.hour
+    week=planned_departure_datetime.isoweekday()
+    temperature=weather_information(planned_departure_datetime)
 
-    return journey_prediction  # Return the updated rediction_request
+    list_of_stops_for_journey = journey_prediction.step_stops
+    shape_dist_traveled = np.array( \
+        [stepstop.shape_dist_traveled for stepstop in list_of_stops_for_journey], dtype=float)
+    dist_from_cc = np.array( \
+        [stepstop.stop.dist_from_cc for stepstop in list_of_stops_for_journey], dtype=float)
+
+    # Portion out the planned time for the journey based on % fraction of the
+    # total journey distance.
+    total_dis_m = shape_dist_traveled[-1] - shape_dist_traveled[0]
+    dis_twostop = np.diff(shape_dist_traveled)
+    segments = len(dis_twostop)
+
+    return np.column_stack(( \
+        duration * (dis_twostop / total_dis_m),            # PLANNED_JOURNEY_TIME
+        dis_twostop,                                       # dis_twostop
+        dist_from_cc[:-1],                                 # dis_prestop_city
+        dist_from_cc[1:],                                  # dis_stopnow_city
+        np.full(segments, temperature),                    # temp
+        np.full(segments, np.sin(2 * np.pi * week/6.0)),   # week_sin
+        np.full(segments, np.cos(2 * np.pi * week/6.0)),   # week_cos
+        np.full(segments, np.sin(2 * np.pi * hour/23.0)),  # hour_sin
+        np.full(segments, np.cos(2 * np.pi * hour/23.0)))) # hour_cos
+
+
+def _set_stop_to_stop_predictions(journey_prediction, predictions):
+    """Set the predicted stop-to-stop times on the journey (and its step stops)
+
+    'predictions' holds the model's result for each row of
+    _stop_to_stop_features() for the journey.
+    """
+    list_of_stops_for_journey = journey_prediction.step_stops
+    start_distance = list_of_stops_for_journey[0].shape_dist_traveled
+    log.debug("\tStop-to-stop prediction results -> %s", predictions)
+
+    cumulative_times = np.cumsum(predictions)
+    for stepstop_now, cumulative_time in zip(list_of_stops_for_journey[1:], cumulative_times):
+        # Set the predicted journey distance/time on the current 'StepStop' Object
+        stepstop_now.dist_from_first_stop_m = \
+            stepstop_now.shape_dist_traveled - start_distance
+        stepstop_now.predicted_time_from_first_stop_s = cumulative_time
+
+    # At the end set the total predicted journey time on the journey_prediction object
+    total_time = cumulative_times[-1] if len(cumulative_times) > 0 else 0
+    log.debug('Total predicted time for this journey is: %d', total_time)
+    journey_prediction.predicted_duration_s = total_time
 
 
 def time_rounded_to_hrs_mins_as_string(seconds):
@@ -2,7 +2,7 @@
 from re import T
 from tokenize import Double
 from sqlalchemy import Column, DateTime, Float, ForeignKey, func, Integer
-from sqlalchemy import LargeBinary, SmallInteger, String, Table, null
+from sqlalchemy import LargeBinary, SmallInteger, String, Table, Text, null
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.schema import Index
 from sqlalchemy.types import UserDefinedType
@@ -111,10 +111,26 @@ class CalendarDates(Base):
         return '<CalendarDates %r>' % (self.service_id, self.date)
 
 
+# The large GTFS tables (stop_times, shapes and trips) hold a dense integer key in
+# place of each GTFS id (route_id, shape_id, stop_id and trip_id). The GTFS ids are
+# kept in small lookup tables (below), one row per id, with keys assigned by the
+# loader. A key is never reassigned, so it stays valid from one load to the next.
+def _gtfs_id_relationship(lookup_model, key_column):
+    """Return a (read only) relationship to the lookup row holding a key's GTFS id
+
+    Loaded with a join, so serializing a query's results doesn't cost a query per row.
+    """
+    key_name = key_column.split('.')[1]
+    return relationship(lookup_model, \
+        primaryjoin='foreign(' + key_column + ') == ' + lookup_model + '.' + key_name, \
+        viewonly=True, lazy='joined')
+
+
 class Routes(Base):
     __tablename__ = 'routes'
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     route_id = Column(String(32), index=True, unique=True, nullable=False)
+    route_key = Column(Integer, index=True, unique=True, nullable=False)
     agency_id = Column(String(3), nullable=False)
     route_short_name = Column(String(16), nullable=False)
     route_long_name = Column(String(72), nullable=False)
@@ -136,16 +152,19 @@ class Routes(Base):
 class Shapes(Base):
     __tablename__ = 'shapes'
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    shape_id = Column(String(32), nullable=False)
+    shape_key = Column(Integer, nullable=False)
     shape_pt_lat = Column(Float, nullable=False)
     shape_pt_lon = Column(Float, nullable=False)
     shape_pt_sequence = Column(Float, nullable=False)
     shape_dist_traveled = Column(Float, nullable=False)
-    __table_args__ = (Index('idx_shape', 'shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'), )
+    __table_args__ = ( \
+        Index('idx_shape', 'shape_key', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'), )
+
+    gtfs_shape = _gtfs_id_relationship('ShapeKey', 'Shapes.shape_key')
 
     def serialize(self):
         return{
-            'shape_id': self.shape_id,
+            'shape_id': self.gtfs_shape.shape_id,
             'shape_pt_lat': self.shape_pt_lat,
             'shape_pt_lon': self.shape_pt_lon,
             'shape_pt_sequence': self.shape_pt_sequence,
@@ -153,7 +172,7 @@ class Shapes(Base):
         }
 
     def __repr__(self):
-        return '<Routes %r>' % (self.shape_id, self.shape_pt_lat, self.shape_pt_lon)    
+        return '<Routes %r>' % (self.shape_key, self.shape_pt_lat, self.shape_pt_lon)    
 
 
 class Stop(Base):
@@ -166,6 +185,7 @@ class Stop(Base):
     # behavior.
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
     stop_id = Column(String(12), index=True, unique=False, nullable=False)
+    stop_key = Column(Integer, index=True, unique=False, nullable=False)
     stop_name = Column(String(64), unique=False, nullable=False)
     stop_lat = Column(Float, unique=False, nullable=False)
     stop_lon = Column(Float, unique=False, nullable=False)
@@ -197,14 +217,22 @@ class Stop(Base):
     def __repr__(self):
         return '<Stop %r>' % self.stop_name
 
+def _gtfs_time(seconds):
+    """Format seconds after midnight as a GTFS time (HH:MM:SS, hours can pass 24)
+    """
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
 class StopTime(Base):
     __tablename__ = 'stop_times'
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    trip_id = Column(String(32), nullable=False)
-    arrival_time = Column(DateTime, nullable=False)
-    departure_time = Column(DateTime, nullable=False)
+    trip_key = Column(Integer, nullable=False)
+    # Arrival/Departure times are stored as seconds after midnight (GTFS times
+    # for trips running past midnight go beyond 24:00:00, e.g. '25:10:00')
+    arrival_time = Column(Integer, nullable=False)
+    departure_time = Column(Integer, nullable=False)
     #stop_id = Column(String(12), ForeignKey("stops.stop_id"), nullable=False)
-    stop_id = Column(String(12), nullable=False)
+    stop_key = Column(Integer, nullable=False)
     stop_sequence = Column(SmallInteger, nullable=False)
     stop_headsign = Column(String(64), nullable=False)
     pickup_type = Column(SmallInteger, nullable=False)
@@ -212,15 +240,21 @@ class StopTime(Base):
     # Note the American spelling of traveled - it caught me out - but thats what
     # is used in GTFS...
     shape_dist_traveled = Column(Float, nullable=False)
-    __table_args__ = (Index('idx_stop_time', 'trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence'), )
+    __table_args__ = ( \
+        Index('idx_stop_time', \
+              'trip_key', 'arrival_time', 'departure_time', 'stop_key', 'stop_sequence'), \
+        Index('idx_stop_time_stop', 'stop_key', 'arrival_time'), )
+
+    gtfs_trip = _gtfs_id_relationship('TripKey', 'StopTime.trip_key')
+    gtfs_stop = _gtfs_id_relationship('StopKey', 'StopTime.stop_key')
 
     def serialize(self):
        """Return object data in easily serializeable format"""
        return  {
-            'trip_id': self.trip_id,
-            'arrival_time': str(self.arrival_time),
-            'departure_time': str(self.departure_time),
-            'stop_id': self.stop_id,
+            'trip_id': self.gtfs_trip.trip_id,
+            'arrival_time': _gtfs_time(self.arrival_time),
+            'departure_time': _gtfs_time(self.departure_time),
+            'stop_id': self.gtfs_stop.stop_id,
             'stop_sequence': self.stop_sequence,
             'stop_headsign': self.stop_headsign,
             'pickup_type': self.pickup_type,
@@ -229,7 +263,8 @@ class StopTime(Base):
         }
 
     def __repr__(self):
-        return f'StopTime("{self.trip_id}",{self.arrival_time},{self.departure_time},"{self.stop_id}",{self.stop_sequence})'
+        return f'StopTime({self.trip_key},{self.arrival_time},{self.departure_time},' \
+            + f'{self.stop_key},{self.stop_sequence})'
         #return '<StopTime %r>' % (self.trip_id, self.arrival_time, self.departure_time, self.stop_id, self.stop_sequence)
 
 
@@ -256,26 +291,114 @@ class Transfers(Base):
 class Trips(Base):
     __tablename__ = 'trips'
     id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
-    route_id = Column(String(32), nullable=False)
+    route_key = Column(Integer, nullable=False)
     service_id = Column(String(32), nullable=False)
-    trip_id = Column(String(32), nullable=False)
-    shape_id = Column(String(32), nullable=False)
+    trip_key = Column(Integer, nullable=False)
+    shape_key = Column(Integer, nullable=False)
     trip_headsign = Column(String(73), nullable=False)
     direction_id = Column(SmallInteger, nullable=False)
-    __table_args__ = (Index('idx_trip', 'route_id', 'trip_id', 'shape_id'), )
+    __table_args__ = (Index('idx_trip', 'route_key', 'trip_key', 'shape_key'), )
+
+    gtfs_route = _gtfs_id_relationship('RouteKey', 'Trips.route_key')
+    gtfs_trip = _gtfs_id_relationship('TripKey', 'Trips.trip_key')
+    gtfs_shape = _gtfs_id_relationship('ShapeKey', 'Trips.shape_key')
 
     def serialize(self):
         return {
-            'route_id': self.route_id,
+            'route_id': self.gtfs_route.route_id,
             'service_id': self.service_id,
-            'trip_id': self.trip_id,
-            'shape_id': self.shape_id,
+            'trip_id': self.gtfs_trip.trip_id,
+            'shape_id': self.gtfs_shape.shape_id,
             'trip_headsign': self.trip_headsign,
             'direction_id': self.direction_id
         }
 
     def __repr__(self):
-        return '<Trips %r>' % (self.route_id, self.service_id, self.trip_id, self.shape_id, self.trip_headsign)
+        return '<Trips %r>' % ( \
+            self.route_key, self.service_id, self.trip_key, self.shape_key, self.trip_headsign)
+
+
+class TripPattern(Base):
+    """One row per stop of each trip pattern (a distinct, ordered sequence of stops)
+
+    Built by the loader from stop_times - thousands of trips share each pattern.
+    """
+    __tablename__ = 'trip_patterns'
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    pattern_key = Column(Integer, nullable=False)
+    stop_sequence = Column(SmallInteger, nullable=False)
+    stop_key = Column(Integer, nullable=False)
+    shape_dist_traveled = Column(Float, nullable=False)
+    __table_args__ = ( \
+        Index('idx_trip_pattern', 'pattern_key', 'stop_sequence', 'stop_key', unique=True), \
+        Index('idx_trip_pattern_stop', 'stop_key', 'pattern_key', 'stop_sequence'), )
+
+
+class PatternTrip(Base):
+    """Trip -> trip pattern mapping (built by the loader along with trip_patterns)"""
+    __tablename__ = 'pattern_trips'
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    trip_key = Column(Integer, nullable=False)
+    pattern_key = Column(Integer, nullable=False)
+    __table_args__ = (Index('idx_pattern_trip', 'trip_key', 'pattern_key', unique=True), \
+                      Index('idx_pattern_trip_pattern', 'pattern_key'), )
+
+
+class RouteName(Base):
+    """Normalized route names - one row per route, built by the loader from routes
+
+    Read into memory by the API (jt_utils.RouteIndex) to look routes up by name.
+    """
+    __tablename__ = 'route_names'
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    route_key = Column(Integer, nullable=False)
+    short_name = Column(String(32), nullable=False)
+    long_name_tokens = Column(String(128), nullable=False)
+    __table_args__ = (Index('idx_route_name', 'short_name', 'route_key', unique=True), )
+
+
+class RouteKey(Base):
+    """GTFS route_id -> key lookup table"""
+    __tablename__ = 'route_keys'
+    route_key = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    route_id = Column(String(32), index=True, unique=True, nullable=False)
+
+
+class ShapeKey(Base):
+    """GTFS shape_id -> key lookup table"""
+    __tablename__ = 'shape_keys'
+    shape_key = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    shape_id = Column(String(32), index=True, unique=True, nullable=False)
+
+
+class StopKey(Base):
+    """GTFS stop_id -> key lookup table"""
+    __tablename__ = 'stop_keys'
+    stop_key = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    stop_id = Column(String(16), index=True, unique=True, nullable=False)
+
+
+class TripKey(Base):
+    """GTFS trip_id -> key lookup table"""
+    __tablename__ = 'trip_keys'
+    trip_key = Column(Integer, primary_key=True, nullable=False, autoincrement=False)
+    trip_id = Column(String(32), index=True, unique=True, nullable=False)
+
+
+class GtfsLoadHistory(Base):
+    """One row per run of the GTFS loader (jt_gtfs_loader) - 'report' is the full json report"""
+    __tablename__ = 'gtfs_load_history'
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    started_at = Column(DateTime, nullable=False)
+    status = Column(String(16), nullable=False)
+    elapsed_s = Column(Float, nullable=False)
+    rows_loaded = Column(Integer, nullable=False)
+    peak_rss_mb = Column(Float, nullable=True)
+    report = Column(Text, nullable=False)
+    __table_args__ = (Index('idx_gtfs_load_history', 'started_at'), )
+
+    def __repr__(self):
+        return f'GtfsLoadHistory("{self.started_at}","{self.status}",{self.elapsed_s})'
 
 
 class JT_User(Base):
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""benchmark_haversine: Per-row vs vectorised distance from the city center
+
+Times the distance calculation done for every stop by 'import_stops()' - one
+call to the 'haversine' module per stop, against one call to the NumPy
+vectorised 'haversine_km()' for the whole file.
+"""
+
+# Standard Library Imports
+import os
+import random
+import sys
+import timeit
+
+# Related Third Party Imports
+from haversine import haversine
+import numpy as np
+
+# Local Application Imports
+benchmark_haversine_dir = os.path.dirname(__file__)
+benchmark_haversine_parent_dir = os.path.dirname(benchmark_haversine_dir)
+sys.path.insert(0, benchmark_haversine_parent_dir)
+from jt_utils import CONST_DUBLIN_CC, haversine_km
+
+# Roughly the number of stops in the NTA 'combined' stops.txt
+CONST_NUM_STOPS   = 5000
+CONST_REPETITIONS = 20
+
+
+def main():
+    """Run the benchmark, print the timings
+    """
+    # Random stops around Dublin (as strings - as read from stops.txt)...
+    random.seed(47360)
+    rows = [ \
+        [str(CONST_DUBLIN_CC[0] + random.uniform(-0.3, 0.3)), \
+         str(CONST_DUBLIN_CC[1] + random.uniform(-0.3, 0.3))] \
+        for _ in range(CONST_NUM_STOPS)]
+
+    def per_row():
+        return [haversine(CONST_DUBLIN_CC, (float(row[0]), float(row[1]))) for row in rows]
+
+    def vectorised():
+        return haversine_km( \
+            CONST_DUBLIN_CC[0], CONST_DUBLIN_CC[1], \
+            np.array([row[0] for row in rows], dtype=float), \
+            np.array([row[1] for row in rows], dtype=float) \
+            ).tolist()
+
+    # Same answers, first...
+    max_difference = max(abs(a - b) for a, b in zip(per_row(), vectorised()))
+
+    per_row_s = min(timeit.repeat(per_row, number=1, repeat=CONST_REPETITIONS))
+    vectorised_s = min(timeit.repeat(vectorised, number=1, repeat=CONST_REPETITIONS))
+
+    print('Benchmark_Haversine: ' + str(CONST_NUM_STOPS) + ' stops (best of ' \
+        + str(CONST_REPETITIONS) + ')')
+    print('\tPer row (haversine module): ' + f'{per_row_s * 1000:.2f}' + 'ms')
+    print('\tVectorised (haversine_km):  ' + f'{vectorised_s * 1000:.2f}' + 'ms')
+    print('\tSpeedup:                    ' + f'{per_row_s / vectorised_s:.1f}' + 'x')
+    print('\tMax difference:             ' + f'{max_difference:.2e}' + 'km')
+
+if __name__ == '__main__':
+    main()
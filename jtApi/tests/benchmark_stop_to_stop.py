@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""benchmark_stop_to_stop: Per-segment vs batched stop-to-stop predictions
+
+Times the stop-to-stop prediction for the journey steps pickled in 'pickles/'
+(JourneyPrediction-r*.pickle) - one DataFrame and one call to the model for
+each pair of consecutive stops, against one feature matrix and one call to the
+model for the whole step ('_predict_jt_stop_to_stop()').
+
+Uses the stop-to-stop model for July if it is in 'pickles/stop_to_stop/', else
+a stand-in random forest (of the same shape) trained on random data. The weather
+forecast is a local one - no requests are made to open-weather.
+"""
+
+# Standard Library Imports
+import copy
+import glob
+import os
+import pickle
+import sys
+import time
+import timeit
+
+# Related Third Party Imports
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+
+# Local Application Imports
+benchmark_stop_to_stop_dir = os.path.dirname(__file__)
+benchmark_stop_to_stop_parent_dir = os.path.dirname(benchmark_stop_to_stop_dir)
+sys.path.insert(0, benchmark_stop_to_stop_parent_dir)
+import jt_utils
+from jt_utils import WeatherForecast, _predict_jt_stop_to_stop
+
+CONST_MODEL_FILEPATH = os.path.join( \
+    benchmark_stop_to_stop_parent_dir, 'pickles', 'stop_to_stop', 'July.pickle')
+CONST_REPETITIONS = 20
+
+
+def per_segment(journey_prediction, model_stop_to_stop):
+    """The stop-to-stop prediction as it was - one model call per segment
+    """
+    planned_departure_datetime = journey_prediction.planned_departure_datetime
+    hour = planned_departure_datetime.hour
+    week = planned_departure_datetime.isoweekday()
+    temperature = jt_utils.weather_information(planned_departure_datetime)
+    stops = journey_prediction.step_stops
+    total_dis_m = stops[-1].shape_dist_traveled - stops[0].shape_dist_traveled
+
+    total_time = 0
+    for stepstop_prev, stepstop_now in zip(stops[:-1], stops[1:]):
+        dis_twostop = stepstop_now.shape_dist_traveled - stepstop_prev.shape_dist_traveled
+        dic_list = [
+            {'PLANNED_JOURNEY_TIME': \
+                journey_prediction.planned_duration_s*(dis_twostop/total_dis_m), \
+            'dis_twostop':dis_twostop, \
+            'dis_prestop_city':stepstop_prev.stop.dist_from_cc, \
+            'dis_stopnow_city':stepstop_now.stop.dist_from_cc, \
+            'temp':temperature, \
+            'week_sin':np.sin(2 * np.pi * week/6.0),'week_cos':np.cos(2 * np.pi * week/6.0), \
+            'hour_sin':np.sin(2 * np.pi * hour/23.0),'hour_cos':np.cos(2 * np.pi * hour/23.0)}
+            ]
+        total_time += model_stop_to_stop.predict(pd.DataFrame(dic_list).values)[0]
+        stepstop_now.predicted_time_from_first_stop_s = total_time
+
+    journey_prediction.predicted_duration_s = total_time
+    return journey_prediction
+
+
+def main():
+    """Run the benchmark, print the timings
+    """
+    if os.path.exists(CONST_MODEL_FILEPATH):
+        with open(CONST_MODEL_FILEPATH, 'rb') as file:
+            model_stop_to_stop = pickle.load(file)
+    else:
+        random_state = np.random.RandomState(47360)
+        model_stop_to_stop = RandomForestRegressor(n_estimators=50, random_state=random_state)
+        model_stop_to_stop.fit(random_state.rand(5000, 9), random_state.rand(5000) * 120)
+
+    jt_utils.weather_forecast = WeatherForecast( \
+        fetch=lambda timeout_s: [(int(time.time()), 288.15)], background=False)
+
+    journey_predictions = []
+    for filepath in sorted(glob.glob(os.path.join( \
+            benchmark_stop_to_stop_parent_dir, 'pickles', 'JourneyPrediction-r*.pickle'))):
+        with open(filepath, 'rb') as jp_pickle:
+            journey_prediction = pickle.load(jp_pickle)
+        if len(journey_prediction.step_stops) > 1:
+            journey_predictions.append(journey_prediction)
+    segments = sum(len(each.step_stops) - 1 for each in journey_predictions)
+
+    def run(predict):
+        return [predict(copy.deepcopy(each), model_stop_to_stop).predicted_duration_s \
+            for each in journey_predictions]
+
+    # Same answers, first...
+    max_difference = max(abs(a - b) for a, b in \
+        zip(run(per_segment), run(_predict_jt_stop_to_stop)))
+
+    per_segment_s = min(timeit.repeat(lambda: run(per_segment), \
+        number=1, repeat=CONST_REPETITIONS))
+    batched_s = min(timeit.repeat(lambda: run(_predict_jt_stop_to_stop), \
+        number=1, repeat=CONST_REPETITIONS))
+
+    print('Benchmark_Stop_To_Stop: ' + str(len(journey_predictions)) + ' steps, ' \
+        + str(segments) + ' segments (best of ' + str(CONST_REPETITIONS) + ')')
+    print('\tPer segment:    ' + f'{per_segment_s * 1000:.2f}' + 'ms')
+    print('\tBatched:        ' + f'{batched_s * 1000:.2f}' + 'ms')
+    print('\tSpeedup:        ' + f'{per_segment_s / batched_s:.1f}' + 'x')
+    print('\tMax difference: ' + f'{max_difference:.2e}' + 's')
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,14 @@
 """
 
 # Standard Library Imports
+import csv
 from datetime import datetime
 import os
 import sys
+import tempfile
 import traceback
 import unittest
+from zipfile import ZipFile
 
 # Related Third Party Imports
 import sqlalchemy as sqlalchemy_db
@@ -19,9 +22,15 @@ test_jt_gtfs_loader_dir = os.path.dirname(__file__)
 test_jt_gtfs_loader_parent_dir = os.path.dirname(test_jt_gtfs_loader_dir)
 sys.path.insert(0, test_jt_gtfs_loader_parent_dir)
 from jt_utils import load_credentials
+from models import StopTime
 from jt_gtfs_loader \
     import download_gtfs_schedule_data, extract_gtfs_data_from_zip, \
-        import_gtfs_txt_files_to_db
+        import_gtfs_txt_files_to_db, _insert_mode_for_file, _parse_args, \
+        GtfsFileLoad, _shard_byte_ranges, _shard_lines, _gtfs_txt_file_fingerprints, \
+        _load_fingerprints, _save_fingerprints, _unchanged_gtfs_txt_files, _diff_value, \
+        _gtfs_filenames, _open_gtfs_csv, GtfsLoadCheckpoint, BatchSizer, _file_load_metrics, \
+        _infile_column_names, _gtfs_id_columns, CONST_GTFS_KEY_COLUMNS, _trip_patterns, \
+        _split_gtfs_rows_into_chunks, _read_gtfs_rows_chunk
 
 print('Test_jt_gtfs_loader: Loading credentials.')
 credentials = load_credentials()
@@ -54,8 +63,10 @@ class TestBasicFunctions(unittest.TestCase):
         gtfs_schedule_data_file = download_gtfs_schedule_data(import_dir)
         # Check it exists
         self.assertTrue(os.path.exists(gtfs_schedule_data_file))
-        # Download the file again to trigger the 'clear file code'
+        # Download the file again to trigger the 'conditional download code' (the
+        # .zip on disk is kept unless the feed has changed)
         gtfs_schedule_data_file = download_gtfs_schedule_data(import_dir)
+        self.assertTrue(os.path.exists(gtfs_schedule_data_file))
 
         # At the end of this test   - a .zip file remains on disk.
 
@@ -80,6 +91,218 @@ class TestBasicFunctions(unittest.TestCase):
         self.assertTrue(os.path.exists(os.path.join(import_dir, 'transfers.txt')))
         self.assertTrue(os.path.exists(os.path.join(import_dir, 'trips.txt')))
 
+    def test_insert_mode_for_file(self):
+        """Test functions "_parse_args()" and "_insert_mode_for_file()"
+        """
+        # No options - everything is loaded using the orm
+        options = _parse_args([])
+        self.assertEqual(_insert_mode_for_file(options, 'stop_times.txt'), 'orm')
+        # A default mode for all files, overridden for one file
+        options = _parse_args(['--insert-mode', 'core', '--insert-mode', 'stop_times.txt=infile'])
+        self.assertEqual(_insert_mode_for_file(options, 'agency.txt'), 'core')
+        self.assertEqual(_insert_mode_for_file(options, 'stop_times.txt'), 'infile')
+        # Bad modes and unknown files are rejected
+        with self.assertRaises(SystemExit):
+            _parse_args(['--insert-mode', 'turbo'])
+        with self.assertRaises(SystemExit):
+            _parse_args(['--insert-mode', 'frequencies.txt=core'])
+
+    def test_gtfs_file_load(self):
+        """Test GtfsFileLoad creation for staging and 'in place' loads
+        """
+        # Loading in place - rows go straight to the live table
+        file_load = GtfsFileLoad('stop_times.txt', 'orm', False)
+        self.assertEqual(file_load.table.name, 'stop_times')
+        self.assertEqual(file_load.insert_mode, 'orm')
+        # Staging - rows go to the staging table, using a Core insert
+        file_load = GtfsFileLoad('stop_times.txt', 'orm', True)
+        self.assertEqual(file_load.table.name, 'stop_times__next')
+        self.assertEqual(file_load.insert_mode, 'core')
+        self.assertFalse(file_load.defer_indexes)
+        # Deferring indexes - the staging table's indexes are the ones rebuilt
+        file_load = GtfsFileLoad('stop_times.txt', 'core', True, True)
+        self.assertTrue(file_load.defer_indexes)
+        self.assertEqual( \
+            sorted((index.name, index.table.name) for index in file_load.table.indexes), \
+            [('idx_stop_time', 'stop_times__next'), ('idx_stop_time_stop', 'stop_times__next')])
+
+    def test_shard_byte_ranges(self):
+        """Test functions "_shard_byte_ranges()" and "_shard_lines()"
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            gtfs_txt_file = os.path.join(temp_dir, 'stop_times.txt')
+            with open(gtfs_txt_file, 'w', newline='', encoding='utf-8') as gtfs_txt:
+                gtfs_txt.write('trip_id,stop_sequence\r\n')
+                for row_no in range(1000):
+                    gtfs_txt.write('trip_' + str(row_no) + ',' + str(row_no) + '\r\n')
+
+            shards = _shard_byte_ranges(gtfs_txt_file, 7)
+            self.assertEqual(len(shards), 7)
+            # Every data row appears in exactly one shard, in order, header excluded
+            lines = []
+            with open(gtfs_txt_file, 'rb') as gtfs_txt:
+                for shard_start, shard_end in shards:
+                    lines.extend(_shard_lines(gtfs_txt, shard_start, shard_end))
+            self.assertEqual(len(lines), 1000)
+            self.assertEqual(lines[0], 'trip_0,0\r\n')
+            self.assertEqual(lines[-1], 'trip_999,999\r\n')
+
+    def test_unchanged_gtfs_txt_files(self):
+        """Test functions "_gtfs_txt_file_fingerprints()" and "_unchanged_gtfs_txt_files()"
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for filename in ('trips.txt', 'routes.txt'):
+                with open(os.path.join(temp_dir, filename), 'w') as gtfs_txt:
+                    gtfs_txt.write('header\n' + filename + '\n')
+            self.assertEqual(_load_fingerprints(temp_dir), {})
+
+            _save_fingerprints(temp_dir, _gtfs_txt_file_fingerprints(temp_dir))
+            with open(os.path.join(temp_dir, 'trips.txt'), 'a') as gtfs_txt:
+                gtfs_txt.write('another trip\n')
+
+            fingerprints = _gtfs_txt_file_fingerprints(temp_dir)
+            self.assertEqual(sorted(fingerprints), ['routes.txt', 'trips.txt'])
+            self.assertEqual( \
+                _unchanged_gtfs_txt_files(fingerprints, _load_fingerprints(temp_dir)), \
+                ['routes.txt'])
+
+    def test_read_gtfs_txt_from_zip(self):
+        """Test functions "_gtfs_filenames()" and "_open_gtfs_csv()" reading the .zip
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with ZipFile(os.path.join(temp_dir, 'google_transit_combined.zip'), 'w') as gtfs_zip:
+                gtfs_zip.writestr('trips.txt', 'trip_id,trip_headsign\r\nt1,"Quays, Dublin"\r\n')
+            self.assertEqual(_gtfs_filenames(temp_dir), ['trips.txt'])
+            self.assertEqual(list(_gtfs_txt_file_fingerprints(temp_dir)), ['trips.txt'])
+            with _open_gtfs_csv(temp_dir, 'trips.txt') as gtfs_csv:
+                self.assertEqual(list(csv.reader(gtfs_csv))[1], ['t1', 'Quays, Dublin'])
+
+    def test_gtfs_load_checkpoint(self):
+        """Test GtfsLoadCheckpoint save and restore
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(os.path.join(temp_dir, 'trips.txt'), 'w') as gtfs_txt:
+                gtfs_txt.write('header\nrow\n')
+            file_load = GtfsFileLoad('trips.txt', 'core', True)
+            checkpoint = GtfsLoadCheckpoint(temp_dir, file_load)
+            self.assertFalse(checkpoint.restore())
+            checkpoint.deferred_indexes = {'idx_trip': (True, ['trip_id'])}
+            checkpoint.restart()
+            checkpoint.batch_committed(50000)
+            checkpoint.batch_committed(50000)
+
+            # Same file, same table - the progress is restored
+            checkpoint = GtfsLoadCheckpoint(temp_dir, file_load)
+            self.assertTrue(checkpoint.restore())
+            self.assertEqual(checkpoint.rows_committed, 100000)
+            self.assertEqual(checkpoint.batches_committed, 2)
+            # ... with the (UNIQUE) indexes dropped for the load
+            self.assertEqual(checkpoint.deferred_indexes, {'idx_trip': (True, ['trip_id'])})
+            # Loading to a different table - start again
+            checkpoint = GtfsLoadCheckpoint(temp_dir, GtfsFileLoad('trips.txt', 'core', False))
+            self.assertFalse(checkpoint.restore())
+
+    def test_batch_sizer(self):
+        """Test BatchSizer adapting to commit throughput (and the fixed size override)
+        """
+        batch_sizer = BatchSizer()
+        batch_sizer.batch_committed(batch_sizer.size, 1.0)   # 50,000 rows/sec
+        batch_sizer.batch_committed(batch_sizer.size, 1.0)   # 75,000 rows/sec - better
+        batch_sizer.batch_committed(batch_sizer.size, 2.0)   # 56,250 rows/sec - worse
+        self.assertTrue(batch_sizer.settled)
+        self.assertEqual(batch_sizer.sizes_used, [50000, 75000, 112500, 75000])
+        batch_sizer.lock_wait_timeout()
+        self.assertEqual(batch_sizer.size, 37500)
+
+        batch_sizer = BatchSizer(1000)
+        batch_sizer.batch_committed(1000, 1.0)
+        batch_sizer.lock_wait_timeout()
+        self.assertEqual(batch_sizer.sizes_used, [1000])
+        self.assertEqual(_parse_args(['--batch-size', '1000']).batch_size, 1000)
+
+    def test_file_load_metrics(self):
+        """Test function "_file_load_metrics()"
+        """
+        file_load = GtfsFileLoad('stop_times.txt', 'core', True)
+        file_load.stats['insert_s'] = 6.0
+        file_load.stats['commit_latencies_s'] = [0.001 * latency for latency in range(1, 101)]
+        file_load.stats['index_build_s']['idx_stop_time'] = 2.5
+        metrics = _file_load_metrics(file_load, 120000, 20.0)
+        self.assertEqual(metrics['insert_rows_per_sec'], 20000)
+        # Parse time is what's left: 20s - 6s inserting - 5.05s committing - 2.5s indexing
+        self.assertEqual(metrics['parse_s'], 6.45)
+        self.assertEqual(metrics['commits'], 100)
+        self.assertEqual(metrics['commit_latency_ms']['max'], 100.0)
+        self.assertEqual(metrics['index_build_s'], {'idx_stop_time': 2.5})
+
+    def test_trip_patterns(self):
+        """Test function "_trip_patterns()"
+        """
+        # (trip_key, stop_sequence, stop_key, shape_dist_traveled), in trip/stop order
+        rows = [(1, 1, 10, 0.0), (1, 2, 11, 250.5), \
+                (2, 1, 11, 0.0), (2, 2, 10, 250.5), \
+                (3, 1, 10, 0.0), (3, 2, 11, 250.5)]
+        patterns = {}
+        self.assertEqual(list(_trip_patterns(rows, patterns)), [(1, 1), (2, 2), (3, 1)])
+        self.assertEqual(patterns[((1, 10, 0.0), (2, 11, 250.5))], 1)
+        # Patterns found in an earlier batch of rows keep their keys
+        self.assertEqual( \
+            list(_trip_patterns([(4, 1, 11, 0.0), (4, 2, 10, 250.5)], patterns)), [(4, 2)])
+        self.assertEqual(len(patterns), 2)
+
+    def test_diff_value(self):
+        """Test function "_diff_value()"
+        """
+        stop_time_columns = StopTime.__table__.c
+        # Values read from a GTFS file compare equal to the same values read from the db
+        self.assertEqual(_diff_value(stop_time_columns.arrival_time.type, 90605), \
+            _diff_value(stop_time_columns.arrival_time.type, '90605'))
+        self.assertEqual(_diff_value(stop_time_columns.stop_sequence.type, '7'), \
+            _diff_value(stop_time_columns.stop_sequence.type, 7))
+        self.assertEqual(_diff_value(stop_time_columns.shape_dist_traveled.type, '12345.67'), \
+            _diff_value(stop_time_columns.shape_dist_traveled.type, 12345.7))
+        self.assertIsNone(_diff_value(stop_time_columns.stop_headsign.type, ''))
+
+    def test_infile_column_names(self):
+        """Test function "_infile_column_names()"
+        """
+        # The times are read into user variables (and converted to seconds)...
+        columns = _infile_column_names('stop_times.txt')
+        self.assertEqual(columns[:3], ['trip_id', 'arrival_time', 'departure_time'])
+        # ... as are the GTFS ids (stored as keys)
+        self.assertEqual(_gtfs_id_columns('stop_times.txt'), ['trip_id', 'stop_id'])
+        self.assertEqual(_gtfs_id_columns('trips.txt'), ['route_id', 'trip_id', 'shape_id'])
+        for column in columns:
+            if column in CONST_GTFS_KEY_COLUMNS:
+                column = CONST_GTFS_KEY_COLUMNS[column][0]
+            self.assertIn(column, StopTime.__table__.c)
+
+    def test_split_gtfs_rows_into_chunks(self):
+        """Test functions "_split_gtfs_rows_into_chunks()" and "_read_gtfs_rows_chunk()"
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with open(os.path.join(temp_dir, 'stop_times.txt'), 'w') as gtfs_txt:
+                gtfs_txt.write('header\n' \
+                    + 't1,08:00:00,08:00:00,s1,1,,0,0,0\n' \
+                    + 't9,25:00:00,25:00:00,s2,1,,0,0,0\n' \
+                    + 't1,08:05:00,08:05:00,s2,2,,0,0,300\n')
+            id_keys = [(0, 'trip_id', {'t1': 1, 't9': 9}), (3, 'stop_id', {'s1': 4, 's2': 5})]
+            # Trip keys 0-4 and 5-9, times in seconds and ids as keys
+            num_rows, chunk_files = _split_gtfs_rows_into_chunks( \
+                temp_dir, 'stop_times.txt', temp_dir, 2, 5, 0, [1, 2], id_keys)
+            self.assertEqual(num_rows, 3)
+            self.assertEqual( \
+                [[row[:5] for row in _read_gtfs_rows_chunk(chunk_file)] \
+                    for chunk_file in chunk_files], \
+                [[[1, 28800, 28800, 4, '1'], [1, 29100, 29100, 5, '2']], \
+                 [[9, 90000, 90000, 5, '1']]])
+
+            # An id that isn't defined (has no key) - the file, line and id are reported
+            id_keys[0][2].pop('t9')
+            with self.assertRaisesRegex(ValueError, r"stop_times.txt line 3: trip_id 't9'"):
+                _split_gtfs_rows_into_chunks( \
+                    temp_dir, 'stop_times.txt', temp_dir, 2, 5, 0, [1, 2], id_keys)
+
 
 #-------------------------------------------------------------------------------
 
@@ -3,14 +3,18 @@
 """
 
 # Standard Library Imports
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import pickle
 import sys
+import tempfile
 import traceback
 import unittest
 
 # Related Third Party Imports
 import flask_testing
+from haversine import haversine
+import numpy as np
 import sqlalchemy as sqlalchemy_db
 from sqlalchemy.exc import SQLAlchemyError, DBAPIError
 from sqlalchemy.orm import sessionmaker
@@ -26,8 +30,14 @@ from jt_utils \
             query_results_as_compressed_csv, query_results_as_json, \
             get_available_end_to_end_models, get_valid_route_shortnames, \
             get_stops_by_route, weather_information, \
-            predict_journey_time
-from models import Trips
+            predict_journey_time, haversine_km, seconds_after_midnight, \
+            CONST_SECONDS_PER_DAY, \
+            route_name_tokens, route_short_name_key, stop_name_key, \
+            RouteIndex, StopIndex, Timetable, ModelCache, load_shared_model, \
+            WeatherForecast, CONST_WEATHER_DEFAULT_TEMP_K, _predict_jt_stop_to_stop, \
+            predict_journey_times
+import jt_utils
+from models import PatternTrip, Stop, StopTime, TripPattern, Trips
 
 print('Test_JT_Utils: Loading credentials.')
 credentials = load_credentials()
@@ -59,6 +69,38 @@ class TestBasicFunctions(unittest.TestCase):
             "f68d42db4825fd344dd408b4fac20dc3"
             )
 
+    def test_haversine_km(self):
+        """Test function "haversine_km()" against the 'haversine' module
+        """
+        dublin_cc = (53.347269, -6.259107)
+        stops = [(53.3522443611407, -6.26372321891882), (53.2818908, -6.1535539)]
+        distances = haversine_km(dublin_cc[0], dublin_cc[1], \
+            [stop[0] for stop in stops], [stop[1] for stop in stops])
+        for stop, distance in zip(stops, distances):
+            self.assertAlmostEqual(distance, haversine(dublin_cc, stop), places=9)
+        self.assertAlmostEqual(float(haversine_km(*dublin_cc, *dublin_cc)), 0.0)
+
+    def test_seconds_after_midnight(self):
+        """Test function "seconds_after_midnight()"
+        """
+        self.assertEqual(seconds_after_midnight('07:05:09'), 25509)
+        # GTFS times for trips running after midnight pass 24:00:00
+        self.assertEqual(seconds_after_midnight(' 25:10:05'), 90605)
+        self.assertEqual(seconds_after_midnight(datetime(2022, 7, 15, 7, 5, 9).time()), 25509)
+        self.assertEqual(seconds_after_midnight(timedelta(hours=25, minutes=10, seconds=5)), 90605)
+
+    def test_route_names(self):
+        """Test functions "route_short_name_key()" and "route_name_tokens()"
+        """
+        self.assertEqual(route_short_name_key(' 46a '), '46A')
+        self.assertEqual(route_short_name_key(15), '15')
+        self.assertEqual(route_name_tokens('Main Street - Ballycullen Road (Hunter\'s Avenue)'), \
+            {'main', 'street', 'ballycullen', 'road', 'hunter', 's', 'avenue'})
+        self.assertEqual(route_name_tokens(None), set())
+        self.assertEqual(stop_name_key('Eden Quay, stop 299'), (299, {'eden', 'quay'}))
+        self.assertEqual(stop_name_key('Stop No. 281'), (281, set()))
+        self.assertEqual(stop_name_key('Sráid Thomáis'), (None, {'sraid', 'thomais'}))
+
     def test_get_next_chunk_size(self):
         """Test function "get_next_chunk_size()"
         """
@@ -122,6 +164,45 @@ class TestBasicFunctions(unittest.TestCase):
         # I have it hard coded to TK's PC for testing.  Better approach??
         self.assertEqual(len(available_end_to_end_models), 21)
 
+    def test_model_cache(self):
+        """Test class "ModelCache" - LRU eviction on size, reloading changed pickles
+        """
+        with tempfile.TemporaryDirectory() as model_dir:
+            def pickle_model(name, model):
+                filepath = os.path.join(model_dir, name + '.pickle')
+                with open(filepath, 'wb') as file:
+                    pickle.dump(model, file)
+                return filepath
+
+            model_a = pickle_model('a', 'a' * 400)
+            model_b = pickle_model('b', 'b' * 400)
+            model_cache = ModelCache(1000)  # Room for two models
+            self.assertEqual(model_cache.get(model_a), 'a' * 400)
+            self.assertEqual(model_cache.get(model_a), 'a' * 400)
+            model_cache.get(model_b)
+            model_cache.get(pickle_model('c', 'c' * 400))  # Evicts 'a'
+            model_cache.get(model_a)  # Reloaded, evicts 'b'
+            stats = model_cache.stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 4, 2))
+            self.assertEqual(stats['models'], 2)
+            # A retrained (re-pickled) model is reloaded
+            pickle_model('a', 'A' * 300)
+            self.assertEqual(model_cache.get(model_a), 'A' * 300)
+            self.assertEqual(model_cache.stats()['misses'], 5)
+
+    def test_load_shared_model(self):
+        """Test function "load_shared_model()" - arrays are memory-mapped
+        """
+        with tempfile.TemporaryDirectory() as model_dir:
+            filepath = os.path.join(model_dir, 'January.pickle')
+            with open(filepath, 'wb') as file:
+                pickle.dump({'coef': np.arange(9.0)}, file)
+            for _ in range(2):  # (the second load uses the saved copy)
+                model = load_shared_model(filepath)
+                self.assertIsInstance(model['coef'], np.memmap)
+                self.assertEqual(model['coef'].tolist(), list(range(9)))
+            assert os.path.exists(os.path.join(model_dir, 'January.joblib'))
+
     def test_weather_information(self):
         """Test function "weather_information()"
         """
@@ -130,6 +211,104 @@ class TestBasicFunctions(unittest.TestCase):
         self.assertTrue(predicted_temp_k < 313.5)  # 40-degrees-C
         self.assertTrue(predicted_temp_k > 268.15)  # -5-degrees-C
 
+    def test_weather_forecast(self):
+        """Test class "WeatherForecast" (with a local forecast)
+        """
+        start = datetime(2022, 7, 1, 12)
+        hours = [(int((start + timedelta(hours=h)).timestamp()), 280.0 + h) \
+                 for h in range(96)]
+        fetches = []
+        def fetch(timeout_s):
+            fetches.append(timeout_s)
+            if len(fetches) > 1:
+                raise ConnectionError('weather service down')
+            return hours
+
+        forecast = WeatherForecast(fetch=fetch, timeout_s=2, background=False)
+        # Fetched on first use, with the timeout, then looked up in memory
+        self.assertEqual(forecast.temperature_at(start + timedelta(hours=3)), 283.0)
+        self.assertEqual(forecast.temperature_at(start + timedelta(minutes=100)), 282.0)
+        self.assertEqual(forecast.temperature_at(start - timedelta(days=1)), 280.0)
+        self.assertEqual(forecast.temperature_at(start + timedelta(days=9)), 375.0)
+        self.assertEqual(fetches, [2])
+        # A failed refresh keeps the (stale) forecast
+        with self.assertRaises(ConnectionError):
+            forecast.refresh()
+        self.assertEqual(forecast.temperature_at(start), 280.0)
+
+        # Nothing fetched - the default temperature, and no more fetches by
+        # lookups until the retry interval has passed
+        failed_fetches = []
+        def fetch_nothing(timeout_s):
+            failed_fetches.append(timeout_s)
+            return []
+        forecast = WeatherForecast(fetch=fetch_nothing, background=False)
+        for _ in range(5):
+            self.assertEqual(forecast.temperature_at(start), CONST_WEATHER_DEFAULT_TEMP_K)
+        self.assertEqual(len(failed_fetches), 1)
+        forecast.retry_interval_s = 0
+        forecast.temperature_at(start)
+        self.assertEqual(len(failed_fetches), 2)
+
+    def test_predict_jt_stop_to_stop(self):
+        """Test function "_predict_jt_stop_to_stop()" - one model call per step
+        """
+        class SegmentDistanceModel:
+            """Predicts each segment takes its distance (column 'dis_twostop') in s"""
+            def __init__(self):
+                self.calls = []
+            def predict(self, features):
+                self.calls.append(features.shape)
+                return features[:, 1]
+
+        saved_weather_forecast = jt_utils.weather_forecast
+        jt_utils.weather_forecast = WeatherForecast( \
+            fetch=lambda timeout_s: [(0, 290.0)], background=False)
+        try:
+            step_stops = [ \
+                StepStop(Stop(stop_id=str(index), dist_from_cc=1000.0 + index), index + 1, dist) \
+                for index, dist in enumerate([100.0, 250.0, 600.0, 1000.0])]
+            journey_prediction = JourneyPrediction( \
+                '42', False, 300, datetime(2022, 7, 15, 16, 44), step_stops)
+            model = SegmentDistanceModel()
+            _predict_jt_stop_to_stop(journey_prediction, model)
+        finally:
+            jt_utils.weather_forecast = saved_weather_forecast
+
+        self.assertEqual(model.calls, [(3, 9)])
+        self.assertEqual(journey_prediction.predicted_duration_s, 900.0)
+        self.assertEqual( \
+            [step_stop.predicted_time_from_first_stop_s for step_stop in step_stops], \
+            [0, 150.0, 500.0, 900.0])
+        self.assertEqual( \
+            [step_stop.dist_from_first_stop_m for step_stop in step_stops], \
+            [0, 150.0, 500.0, 900.0])
+
+        # A batch of journeys - one call to each model
+        def journey(distances):
+            return JourneyPrediction('42', False, 300, datetime(2022, 7, 15, 16, 44), \
+                [StepStop(Stop(stop_id=str(index), dist_from_cc=1000.0), index + 1, dist) \
+                    for index, dist in enumerate(distances)])
+        journeys = [journey([0.0, 10.0, 30.0]), journey([]), journey([5.0, 45.0]), \
+                    journey([0.0, 7.0])]
+        models = [SegmentDistanceModel(), SegmentDistanceModel()]
+        jt_utils.weather_forecast = WeatherForecast( \
+            fetch=lambda timeout_s: [(0, 290.0)], background=False)
+        try:
+            predictions = predict_journey_times( \
+                [(journeys[0], models[0]), (journeys[1], models[0]), \
+                 (journeys[2], models[0]), (journeys[3], models[1])])
+        finally:
+            jt_utils.weather_forecast = saved_weather_forecast
+
+        self.assertEqual([model.calls for model in models], [[(3, 9)], [(1, 9)]])
+        self.assertEqual( \
+            [prediction.predicted_duration_s for prediction in predictions], \
+            [30.0, 0, 40.0, 7.0])
+        self.assertEqual( \
+            [step_stop.predicted_time_from_first_stop_s for step_stop in journeys[0].step_stops], \
+            [0, 10.0, 30.0])
+
 
 #-------------------------------------------------------------------------------
 
@@ -196,7 +375,7 @@ class TestFunctionsUsingSessionForQuery(unittest.TestCase):
         session = TestBasicFunctions.session_maker()
         trips_query = session.query(Trips)
         trips_query = \
-            trips_query.filter(Trips.trip_id == '3992624.1.10-100-e20-1.214.I')
+            trips_query.filter(Trips.gtfs_trip.has(trip_id='3992624.1.10-100-e20-1.214.I'))
         trips_response = query_results_as_json(Trips, trips_query)
         trips_json = trips_response.json
         self.assertTrue(len(trips_json) > 0)
@@ -250,7 +429,7 @@ class TestFunctionsUsingFlaskSQLAlchemyDbForConn(flask_testing.TestCase):
         assert len(valid_route_shortnames) == 390
 
     @classmethod
-    def _get_list_of_stops_good_match(cls):
+    def _get_list_of_stops_good_match(cls, **kwargs):
         """Get a list of stops for the Number 15 for Testing (good matching)...
         """
         route_name      = 'Main Street - Ballycullen Road (Hunter\'s Avenue)'
@@ -267,12 +446,12 @@ class TestFunctionsUsingFlaskSQLAlchemyDbForConn(flask_testing.TestCase):
                 db, route_name, route_shortname, \
                 stop_headsign, jrny_time, \
                 departure_stop_name, departure_stop_lat, departure_stop_lon, \
-                arrival_stop_name, arrival_stop_lat, arrival_stop_lon \
+                arrival_stop_name, arrival_stop_lat, arrival_stop_lon, **kwargs \
             )
         return stops_by_route
 
     @classmethod
-    def _get_list_of_stops_poor_match(cls):
+    def _get_list_of_stops_poor_match(cls, **kwargs):
         """Get a list of stops for the Number 15 for Testing...
         """
         route_name      = 'this-name-has-been-altered-to-force-poor-match'
@@ -289,7 +468,7 @@ class TestFunctionsUsingFlaskSQLAlchemyDbForConn(flask_testing.TestCase):
                 db, route_name, route_shortname, \
                 stop_headsign, jrny_time, \
                 departure_stop_name, departure_stop_lat, departure_stop_lon, \
-                arrival_stop_name, arrival_stop_lat, arrival_stop_lon \
+                arrival_stop_name, arrival_stop_lat, arrival_stop_lon, **kwargs \
             )
         return stops_by_route
 
@@ -315,6 +494,89 @@ class TestFunctionsUsingFlaskSQLAlchemyDbForConn(flask_testing.TestCase):
         assert stops_by_route[1].stop.stop_name == 'Connolly, stop 497'
         # assert len(valid_route_shortnames) == 390
 
+    def test_get_stops_by_route_in_memory(self):
+        """Test function "get_stops_by_route()" using the in-memory indexes and timetable
+        """
+        in_memory = {'route_index': RouteIndex(), 'stop_index': StopIndex(), \
+                     'timetable': Timetable()}
+        for index in in_memory.values():
+            index.refresh(db)
+        for get_list_of_stops in ( \
+                TestFunctionsUsingFlaskSQLAlchemyDbForConn._get_list_of_stops_good_match, \
+                TestFunctionsUsingFlaskSQLAlchemyDbForConn._get_list_of_stops_poor_match):
+            stops_by_route = get_list_of_stops(**in_memory)
+            assert [step_stop.stop.stop_name for step_stop in stops_by_route] \
+                == [step_stop.stop.stop_name for step_stop in get_list_of_stops()]
+            assert stops_by_route[0].stop.stop_name == 'Eden Quay, stop 299'
+            assert stops_by_route[1].stop.stop_name == 'Connolly, stop 497'
+
+    def test_timetable(self):
+        """Test class "Timetable" - the latest call at a stop
+        """
+        timetable = Timetable()
+        assert timetable.latest_call(1, 60000, [1, 2, 3]) is None  # Empty until refreshed
+        timetable.refresh(db)
+        stop_time = db.session.query(StopTime) \
+            .filter(StopTime.arrival_time.between(1, CONST_SECONDS_PER_DAY - 1)).first()
+        trip_key = timetable.latest_call( \
+            stop_time.stop_key, stop_time.arrival_time, [stop_time.trip_key], \
+            ' ' + stop_time.stop_headsign.upper())
+        assert trip_key == stop_time.trip_key
+        pattern_key = db.session.query(PatternTrip.pattern_key) \
+            .filter(PatternTrip.trip_key == trip_key).scalar()
+        # A second earlier, the trip has not reached the stop yet
+        assert timetable.latest_call( \
+            stop_time.stop_key, stop_time.arrival_time - 1, [stop_time.trip_key]) is None
+        # The trip's first stop comes before its last (but not the other way round)
+        pattern_stops = db.session.query(TripPattern.stop_key) \
+            .filter(TripPattern.pattern_key == pattern_key) \
+            .order_by(TripPattern.stop_sequence).all()
+        first_stop_key, last_stop_key = pattern_stops[0][0], pattern_stops[-1][0]
+        assert timetable.trips_with_stops_in_order( \
+            [trip_key], first_stop_key, last_stop_key) == [trip_key]
+        assert timetable.trips_with_stops_in_order( \
+            [trip_key], last_stop_key, first_stop_key) == []
+
+    def test_route_index(self):
+        """Test class "RouteIndex" - the same routes and trips as the queries
+        """
+        route_index = RouteIndex()
+        assert not route_index  # Empty until refreshed
+        route_index.refresh(db)
+        assert len(route_index) > 0
+        route_keys, poor_match = route_index.search_for_routes( \
+            'Main Street - Ballycullen Road (Hunter\'s Avenue)', 15)
+        assert len(route_keys) > 0
+        assert not poor_match
+        _, poor_match = route_index.search_for_routes( \
+            'this-name-has-been-altered-to-force-poor-match', 15)
+        assert poor_match
+        trips = db.session.query(Trips.trip_key).filter(Trips.route_key.in_(route_keys))
+        assert sorted(route_index.trips_for_route_ids(route_keys)) \
+            == sorted(row.trip_key for row in trips.all())
+
+    def test_stop_index(self):
+        """Test class "StopIndex" - the same nearest stops as checking every stop
+        """
+        stop_index = StopIndex()
+        assert stop_index.nearest(53.3482354, -6.2561569) == []  # Empty until refreshed
+        stop_index.refresh(db)
+        stops = db.session.query(Stop.stop_key, Stop.stop_lat, Stop.stop_lon).all()
+        for lat, lon in ((53.3482354, -6.2561569), (53.3505441, -6.2507091), (51.9, -8.47)):
+            distances = haversine_km(lat, lon, \
+                [stop.stop_lat for stop in stops], [stop.stop_lon for stop in stops])
+            nearest = stop_index.nearest(lat, lon, k=3)
+            for (_, distance), expected_distance in zip(nearest, sorted(distances)[:3]):
+                self.assertAlmostEqual(distance, expected_distance, places=9)
+            assert nearest[0][0] == stops[distances.argmin()].stop_key
+        # Identify stops (by name, then position) - as in get_stops_by_route tests
+        for name, lat, lon, stop_name in ( \
+                ('Eden Quay, stop 299', 53.3482354, -6.2561569, 'Eden Quay, stop 299'), \
+                ('Connolly', 53.3505441, -6.2507091, 'Connolly, stop 497')):
+            stop_key, _, _ = stop_index.identify(name, lat, lon)
+            stop = db.session.query(Stop).filter(Stop.stop_key == stop_key).one()
+            assert stop.stop_name == stop_name
+
     def test_predict_journey_time_end_to_end(self):
         """Test function "predict_journey_time(), expecting and end-to-end model"
         """